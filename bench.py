@@ -0,0 +1,889 @@
+#! /usr/bin/python3
+import gc
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import stem
+
+
+def straight_line_program(lines: int) -> str:
+    """Generate `lines` statements of assignments and puts."""
+    out = [f"v{i} := {i};\n" for i in range(16)]
+    for i in range(16, lines):
+        if i % 4 == 3:
+            out.append(f"put v{i % 16};\n")
+        else:
+            out.append(f"v{i % 16} := {i} + v{(i + 1) % 16} * 3; // stmt {i}\n")
+    return "".join(out)
+
+
+def nested_program(depth: int, body: int) -> str:
+    """Generate `depth` nested while loops, each holding `body` statements."""
+    out = []
+    for level in range(depth):
+        out.append("while (n%d > 0) {\n" % level)
+        for i in range(body):
+            out.append(f"    v{i} := v{i} + {level};\n")
+    out.append("}\n" * depth)
+    return "".join(out)
+
+
+def loop_program(outer: int, inner: int) -> str:
+    """tests/while.stm scaled up, printing only a checksum."""
+    return (f"i := 0;\nsum := 0;\nwhile ({outer} > i) {{\n    i := i + 1;\n    j := 0;\n"
+            f"    while ({inner} > j) {{\n        j := j + 1;\n        sum := sum + i * j;\n    }}\n}}\n"
+            f"put sum;\n")
+
+
+def if_while_program(statements: int, depth: int = 50) -> str:
+    """Runs of `depth` nested blocks, `if` and `while` in turn, one assignment in each."""
+    out = [f"n{level} := {level};\n" for level in range(depth)]
+    count = depth
+    while count < statements:
+        levels = min(depth, max(1, (statements - count) // 2))
+        for level in range(levels):
+            keyword = "if" if level % 2 == 0 else "while"
+            out.append("    " * level + f"{keyword} (n{level} > 0) {{\n")
+            out.append("    " * (level + 1) + f"n{level} := n{level} - 1;\n")
+        for level in reversed(range(levels)):
+            out.append("    " * level + "}\n")
+        count += 2 * levels
+    return "".join(out)
+
+
+def chain_program(statements: int, length: int = 32) -> str:
+    """Assignments of `length` operand arithmetic chains over a few variables."""
+    ops = ["+", "-", "*"]
+    out = [f"c{i} := {i + 1};\n" for i in range(8)]
+    for i in range(8, statements):
+        terms = [f"c{(i + k) % 8}" if k % 2 == 0 else str(i + k) for k in range(length)]
+        expr = terms[0] + "".join(f" {ops[(i + k) % 3]} {terms[k]}" for k in range(1, length))
+        out.append(f"c{i % 8} := {expr};\n")
+    return "".join(out)
+
+
+def many_vars_program(statements: int) -> str:
+    """Every statement assigns a new variable from the two before it."""
+    out = ["x0 := 1;\n", "x1 := 2;\n"]
+    for i in range(2, statements):
+        out.append(f"x{i} := x{i - 1} + x{i - 2};\n")
+    return "".join(out)
+
+
+GENERATORS: Dict[str, Callable[[int], str]] = {
+    "straight": straight_line_program,
+    "if-while": if_while_program,
+    "chain": chain_program,
+    "many-vars": many_vars_program,
+}
+
+
+def invariant_loop_program(outer: int, inner: int) -> str:
+    """Nested loops where `4 + n * m` is invariant in the inner loop and `j` counts it."""
+    return (f"n := 3;\nm := 5;\ni := 0;\nsum := 0;\nwhile ({outer} > i) {{\n    i := i + 1;\n    n := n + 1;\n    j := 0;\n"
+            f"    while ({inner} > j) {{\n        j := j + 1;\n        sum := sum + j * 4 + n * m;\n    }}\n}}\n"
+            f"put sum;\n")
+
+
+def timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def lex_all(src: str) -> int:
+    lexer = stem.Lexer(src, "bench.stm")
+    count = 0
+    while lexer.next()[0] != stem.EOF:
+        count += 1
+    return count
+
+
+def bench_lex(sizes: List[int]) -> List[Tuple[int, float]]:
+    results = []
+    print(f"{'lines':>10} {'seconds':>10} {'us/line':>10}")
+    for lines in sizes:
+        src = straight_line_program(lines)
+        seconds = timed(lambda: lex_all(src))
+        results.append((lines, seconds))
+        print(f"{lines:>10} {seconds:>10.4f} {seconds / lines * 1e6:>10.3f}")
+    return results
+
+
+def parse_all(src: str) -> int:
+    lexer = stem.Lexer(src, "bench.stm")
+    count = 0
+    while stem.parse(lexer, "bench.stm").op_type != stem.EOF:
+        count += 1
+    return count
+
+
+def bench_suite(max_statements: int, output: str) -> None:
+    """Time lexing, parsing and code generation of every generator, write JSON to `output`.
+
+    The parser pulls its tokens from the lexer, so parse time is the time of
+    both minus the time of lexing alone.
+    """
+    sizes = [10 ** n for n in range(2, 7) if 10 ** n <= max_statements]
+    results = []
+    print(f"{'program':>10} {'stmts':>8} {'tokens':>9} {'lex':>8} {'parse':>8} {'codegen':>8}")
+    for name, generator in GENERATORS.items():
+        for statements in sizes:
+            src = generator(statements)
+            tokens = 0
+            program: List[stem.AST] = []
+
+            def lex() -> None:
+                nonlocal tokens
+                tokens = lex_all(src) + 1
+
+            def parse() -> None:
+                lexer = stem.Lexer(src, "bench.stm")
+                while len(program) == 0 or program[-1].op_type != stem.EOF:
+                    program.append(stem.parse(lexer, "bench.stm"))
+
+            lex_seconds = timed(lex)
+            parse_seconds = max(timed(parse) - lex_seconds, 0.0)
+            codegen_seconds = timed(lambda: stem.compile_program(os.devnull, program))
+            results.append({"program": name, "statements": statements, "tokens": tokens,
+                            "lex": lex_seconds, "parse": parse_seconds, "codegen": codegen_seconds})
+            print(f"{name:>10} {statements:>8} {tokens:>9} "
+                  f"{lex_seconds:>8.3f} {parse_seconds:>8.3f} {codegen_seconds:>8.3f}")
+            del src, tokens, program
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(STEM)).stdout.strip()
+    except OSError:
+        commit = ""
+    with open(output, "w") as file:
+        json.dump({"commit": commit, "python": sys.version.split()[0], "results": results}, file, indent=2)
+    print(f"wrote {output}")
+
+
+def bench_compare(old_path: str, new_path: str) -> None:
+    """Print how each phase of two `suite` runs compares, new time over old time."""
+    with open(old_path) as file:
+        old = {(r["program"], r["statements"]): r for r in json.load(file)["results"]}
+    with open(new_path) as file:
+        new = json.load(file)["results"]
+    print(f"{'program':>10} {'stmts':>8} {'lex':>8} {'parse':>8} {'codegen':>8}")
+    for result in new:
+        before = old.get((result["program"], result["statements"]))
+        if before is None:
+            continue
+        ratios = " ".join(f"{result[phase] / max(before[phase], 1e-9):>7.2f}x" for phase in ("lex", "parse", "codegen"))
+        print(f"{result['program']:>10} {result['statements']:>8} {ratios}")
+
+
+def bench_nesting(depths: List[int], body: int) -> List[Tuple[int, float]]:
+    results = []
+    print(f"{'depth':>10} {'stmts':>10} {'seconds':>10} {'us/stmt':>10}")
+    for depth in depths:
+        src = nested_program(depth, body)
+        seconds = timed(lambda: parse_all(src))
+        stmts = depth * (body + 1)
+        results.append((depth, seconds))
+        print(f"{depth:>10} {stmts:>10} {seconds:>10.4f} {seconds / stmts * 1e6:>10.3f}")
+    return results
+
+
+def bench_emit(sizes: List[int]) -> List[Tuple[int, float]]:
+    """Time building and lowering the IR and the single write of the assembly, allocation excluded."""
+    results = []
+    print(f"{'lines':>10} {'generate':>10} {'format':>10} {'us/line':>10}")
+    for lines in sizes:
+        lexer = stem.Lexer(straight_line_program(lines), "bench.stm")
+        program = []
+        while len(program) == 0 or program[-1].op_type != stem.EOF:
+            program.append(stem.parse(lexer, "bench.stm"))
+        operands, _, _ = stem.allocate_ir_registers(stem.IRBuilder(set()).function(program))
+        codegen = stem.Codegen(operands)
+        gc.disable()  # like compile_program
+        generate = timed(lambda: codegen.function(stem.IRBuilder(set()).function(program)))
+        format = timed(lambda: stem.format_asm(codegen.asm))
+        gc.enable()
+        results.append((lines, generate + format))
+        print(f"{lines:>10} {generate:>10.4f} {format:>10.4f} {(generate + format) / lines * 1e6:>10.3f}")
+    return results
+
+
+def walk_value(node: stem.AST | stem.Lexeme, env: Dict[str, int]) -> int:
+    if type(node) == tuple:
+        return env[node[1]] if node[0] == stem.VAR else node[1]  # type: ignore
+    assert isinstance(node, stem.AST)
+    if node.op_type in (stem.VAR, stem.INT):
+        return walk_value(node.left_side, env)  # type: ignore
+    left = walk_value(node.left_side, env)  # type: ignore
+    right = walk_value(node.right_side, env)  # type: ignore
+    if node.op_type == stem.OP_PLUS:
+        return stem.wrap64(left + right)
+    elif node.op_type == stem.OP_MINUS:
+        return stem.wrap64(left - right)
+    elif node.op_type == stem.OP_MULT:
+        return stem.wrap64(left * right)
+    elif node.op_type == stem.OP_SLASH:
+        return stem.checked_divide(left, right, stem.statement_pos(node))[0]
+    elif node.op_type == stem.OP_MOD:
+        return stem.checked_divide(left, right, stem.statement_pos(node))[1]
+    elif node.op_type == stem.OP_EQUAL:
+        return int(left == right)
+    elif node.op_type == stem.OP_GT:
+        return int(left > right)
+    assert False, "unreachable"
+
+
+def walk_program(program: List[stem.AST], env: Dict[str, int], out: io.StringIO) -> None:
+    """Plain tree-walking interpreter, the baseline for the simulators."""
+    for op in program:
+        if op.op_type == stem.OP_ASSIGN:
+            env[op.left_side[1]] = walk_value(op.right_side, env)  # type: ignore
+        elif op.op_type == stem.OP_PUT:
+            out.write("%d\n" % walk_value(op.left_side, env))  # type: ignore
+        elif op.op_type == stem.OP_IF:
+            if walk_value(op.left_side, env):  # type: ignore
+                walk_program(op.right_side, env, out)  # type: ignore
+        elif op.op_type == stem.OP_WHILE:
+            while walk_value(op.left_side, env):  # type: ignore
+                walk_program(op.right_side, env, out)  # type: ignore
+
+
+def bench_sim(outer: int, inner: int) -> Dict[str, float]:
+    path = "bench_loop.stm"
+    with open(path, "w") as file:
+        file.write(loop_program(outer, inner))
+    program = stem.load_program_from_file(path)
+    outputs = {name: io.StringIO() for name in ("tree", "bytecode", "jit")}
+    results = {
+        "tree": timed(lambda: walk_program(program, {}, outputs["tree"])),
+        "bytecode": timed(lambda: stem.run_bytecode(stem.compile_bytecode(program), outputs["bytecode"])),
+        "jit": timed(lambda: stem.run_jit(stem.jit_compile(path), outputs["jit"])),
+        "jit (cached)": timed(lambda: stem.run_jit(stem.jit_compile(path), io.StringIO())),
+    }
+    os.remove(path)
+    assert len({out.getvalue() for out in outputs.values()}) == 1, "simulators disagree"
+    print(f"{outer} x {inner} iterations")
+    print(f"{'engine':>14} {'seconds':>10} {'speedup':>10}")
+    for name, seconds in results.items():
+        print(f"{name:>14} {seconds:>10.4f} {results['tree'] / seconds:>9.1f}x")
+    return results
+
+
+def cpu_hz() -> float:
+    """Nominal clock from /proc/cpuinfo, to turn seconds into cycles."""
+    try:
+        with open("/proc/cpuinfo") as file:
+            for line in file:
+                if line.startswith("cpu MHz"):
+                    return float(line.split(":")[1]) * 1e6
+    except OSError:
+        pass
+    return 0.0
+
+
+STEM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stem.py")
+
+
+def build(src: str, flags: List[str] = []) -> None:
+    """Compile `src` to ./output with `stem.py com`."""
+    path = "bench_program.stm"
+    with open(path, "w") as file:
+        file.write(src)
+    subprocess.run([sys.executable, STEM, "com", *flags, path], stdout=subprocess.DEVNULL, check=True)
+    os.remove(path)
+
+
+def run_output() -> Tuple[float, int]:
+    """Run ./output once, return its wall time and number of write syscalls."""
+    start = time.perf_counter()
+    process = subprocess.Popen(["./output"], stdout=subprocess.DEVNULL)
+    # wait without reaping, so /proc still has the counters of the zombie
+    os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    seconds = time.perf_counter() - start
+    writes = -1
+    try:
+        with open(f"/proc/{process.pid}/io") as file:
+            for line in file:
+                if line.startswith("syscw:"):
+                    writes = int(line.split()[1])
+    except OSError:
+        pass
+    process.wait()
+    return seconds, writes
+
+
+def bench_loop(outer: int, inner: int) -> float:
+    """Compile the scaled up tests/while.stm with `com` and time ./output."""
+    build(loop_program(outer, inner))
+    seconds = min(run_output()[0] for _ in range(3))
+    iterations = outer * inner
+    print(f"{outer} x {inner} iterations: {seconds:.4f}s, {seconds / iterations * 1e9:.2f} ns/iteration", end="")
+    hz = cpu_hz()
+    if hz > 0:
+        print(f", {seconds * hz / iterations:.2f} cycles/iteration at {hz / 1e9:.2f} GHz", end="")
+    print()
+    return seconds
+
+
+def bench_loop_opt(outer: int, inner: int) -> None:
+    """Run time of nested loops compiled with -O, with and without the loop passes."""
+    path = "bench_loops.stm"
+    print(f"{outer} x {inner} iterations")
+    print(f"{'program':>10} {'loop passes':>12} {'seconds':>10} {'ns/iter':>10} {'hoisted':>8} {'reduced':>8}")
+    for name, src in (("while.stm", loop_program(outer, inner)), ("invariant", invariant_loop_program(outer, inner))):
+        with open(path, "w") as file:
+            file.write(src)
+        outputs = set()
+        for loop_passes in (False, True):
+            stats: Dict[str, int] = {}
+            program = stem.fold_constants(stem.load_program_from_file(path), stats)
+            if loop_passes:
+                program = stem.fold_constants(stem.optimize_loops(program, stats), stats)
+            asm = stem.compile_program("bench_loops.asm", program, peephole_stats={})
+            stem.write_executable("bench_loops", asm)
+            seconds = min(timed(lambda: subprocess.run(["./bench_loops"], stdout=subprocess.DEVNULL, check=True))
+                          for _ in range(3))
+            outputs.add(subprocess.run(["./bench_loops"], capture_output=True).stdout)
+            print(f"{name:>10} {'on' if loop_passes else 'off':>12} {seconds:>10.4f} "
+                  f"{seconds / (outer * inner) * 1e9:>10.2f} {stats.get('hoisted', 0):>8} "
+                  f"{stats.get('strength reduced', 0):>8}")
+        assert len(outputs) == 1, "the loop passes changed the output"
+    for leftover in (path, "bench_loops", "bench_loops.asm"):
+        os.remove(leftover)
+
+
+def main_instructions(asm: List[stem.Instr]) -> int:
+    """Instructions of `main`, leaving the runtime out."""
+    start = asm.index(stem.Instr("label", ("main",)))
+    return sum(1 for instr in asm[start:] if instr.op not in ("label", "comment", "raw"))
+
+
+def bench_chains(lengths: List[int], statements: int) -> None:
+    """Instructions generated for `statements` assignments of arithmetic chains of each length."""
+    path = "bench_chains.stm"
+    print(f"{'length':>7} {'instructions':>13} {'with -O':>9} {'per operator':>13}")
+    for length in lengths:
+        with open(path, "w") as file:
+            file.write(chain_program(statements + 8, length))
+        program = stem.load_program_from_file(path)
+        count = main_instructions(stem.generate_program(program))
+        count_optimized = main_instructions(stem.peephole(stem.generate_program(program), {}))
+        print(f"{length:>7} {count:>13} {count_optimized:>9} {count / (statements * (length - 1)):>13.2f}")
+    os.remove(path)
+
+
+def bench_ir(outer: int, inner: int) -> None:
+    """Instructions of `main` and run time of programs compiled with -O, with and without the IR passes."""
+    path = "bench_ir.stm"
+    programs = [("while.stm", loop_program(outer, inner)), ("invariant", invariant_loop_program(outer, inner)),
+                ("if-while", if_while_program(2000))]
+    print(f"{'program':>10} {'IR passes':>10} {'instructions':>13} {'seconds':>10} {'changes':>8}")
+    for name, src in programs:
+        with open(path, "w") as file:
+            file.write(src)
+        outputs = set()
+        for ir_passes in (False, True):
+            ir_stats: Dict[str, int] = {}
+            program = stem.optimize_program(stem.load_program_from_file(path), {})
+            asm = stem.compile_program("bench_ir.asm", program, peephole_stats={},
+                                       ir_stats=ir_stats if ir_passes else None)
+            stem.write_executable("bench_ir", asm)
+            seconds = min(timed(lambda: subprocess.run(["./bench_ir"], stdout=subprocess.DEVNULL, check=True))
+                          for _ in range(3))
+            outputs.add(subprocess.run(["./bench_ir"], capture_output=True).stdout)
+            print(f"{name:>10} {'on' if ir_passes else 'off':>10} {main_instructions(asm):>13} {seconds:>10.4f} "
+                  f"{sum(ir_stats.values()):>8}")
+        assert len(outputs) == 1, "the IR passes changed the output"
+    for leftover in (path, "bench_ir", "bench_ir.asm"):
+        os.remove(leftover)
+
+
+SPILL_OPS = [stem.OP_PLUS, stem.OP_MINUS, stem.OP_MULT, stem.OP_EQUAL, stem.OP_GT, stem.OP_SLASH, stem.OP_MOD]
+
+
+def spill_tree(rng: random.Random, depth: int, pos: stem.POS) -> stem.AST:
+    """A random expression with subtrees on both sides, which the parser never builds.
+
+    It reads v0 to v5, and divides only by d, which is never 0.
+    """
+    if depth == 0 or rng.random() < 0.1:
+        if rng.random() < 0.3:
+            return stem.int_((stem.INT, rng.randrange(-1000, 1000), pos))
+        return stem.var_((stem.VAR, f"v{rng.randrange(6)}", pos))
+    op = rng.choice(SPILL_OPS)
+    right = stem.var_((stem.VAR, "d", pos)) if op in (stem.OP_SLASH, stem.OP_MOD) else \
+        spill_tree(rng, depth - 1, pos)
+    return stem.AST(op, spill_tree(rng, depth - 1, pos), right)
+
+
+def spill_program(rng: random.Random, statements: int, depth: int) -> List[stem.AST]:
+    """`statements` assignments of `spill_tree`s to v0 to v5, each printed."""
+    pos = stem.pack_pos("spills", 1, 1)
+    program = [stem.assign((stem.VAR, f"v{i}", pos), stem.int_((stem.INT, rng.randrange(-50, 50), pos)))
+               for i in range(6)]
+    program.append(stem.assign((stem.VAR, "d", pos), stem.int_((stem.INT, rng.choice([-7, -3, 3, 5, 11]), pos))))
+    for _ in range(statements):
+        name = f"v{rng.randrange(6)}"
+        program.append(stem.assign((stem.VAR, name, pos), spill_tree(rng, depth, pos)))
+        program.append(stem.put(stem.var_((stem.VAR, name, pos))))
+    return program + [stem.eof()]
+
+
+def bench_spills(count: int, seed: int) -> None:
+    """Compile `count` random programs of `spill_tree`s, plain and through the IR passes and the
+    peephole optimizer, and check that they print what the tree-walking interpreter does."""
+    rng = random.Random(seed)
+    spills = {"plain": 0, "passes": 0}
+    for _ in range(count):
+        program = spill_program(rng, 20, 6)
+        expected = io.StringIO()
+        walk_program(program, {}, expected)
+        for name, optimize in (("plain", False), ("passes", True)):
+            asm = stem.compile_program("bench_spills.asm", program, peephole_stats={} if optimize else None,
+                                       ir_stats={} if optimize else None)
+            spills[name] += asm.count(stem.Instr("comment", ("-- spill --",)))
+            stem.write_executable("bench_spills", asm)
+            output = subprocess.run(["./bench_spills"], capture_output=True, text=True).stdout
+            assert output == expected.getvalue(), f"{name} code of a program of seed {seed} disagrees"
+    print(f"{count} programs of seed {seed} agree with the tree-walking interpreter, "
+          f"{spills['plain']} spills plain and {spills['passes']} through the IR passes and peephole")
+    for leftover in ("bench_spills", "bench_spills.asm"):
+        os.remove(leftover)
+
+
+def division_program(count: int, divisor: str) -> str:
+    """`count` iterations summing the quotients and remainders of -count / 2 .. count / 2 by `divisor`."""
+    return (f"i := 0 - {count // 2};\ns := 0;\nt := 0;\nwhile ({count // 2} > i) {{\n    i := i + 1;\n"
+            f"    s := s + i / {divisor};\n    t := t + i % {divisor};\n}}\nput s;\nput t;\n")
+
+
+def bench_div(count: int, divisors: List[int]) -> None:
+    """Run time of divisions by constants, strength reduced, against the same divisors in a variable, for idiv."""
+    path = "bench_div.stm"
+    print(f"{count} iterations of a quotient and a remainder")
+    print(f"{'divisor':>10} {'constant':>10} {'idiv':>10} {'ns/iter':>8} {'ns/iter':>8} {'speedup':>8}")
+    for divisor in divisors:
+        outputs = set()
+        times = []
+        for src in (division_program(count, str(divisor)), f"d := {divisor};\n" + division_program(count, "d")):
+            with open(path, "w") as file:
+                file.write(src)
+            asm = stem.compile_program("bench_div.asm", stem.load_program_from_file(path))
+            stem.write_executable("bench_div", asm)
+            times.append(min(timed(lambda: subprocess.run(["./bench_div"], stdout=subprocess.DEVNULL, check=True))
+                             for _ in range(3)))
+            outputs.add(subprocess.run(["./bench_div"], capture_output=True).stdout)
+        assert len(outputs) == 1, "the constant divisor changed the output"
+        print(f"{divisor:>10} {times[0]:>10.4f} {times[1]:>10.4f} {times[0] / count * 1e9:>8.2f} "
+              f"{times[1] / count * 1e9:>8.2f} {times[1] / times[0]:>7.2f}x")
+    for leftover in (path, "bench_div", "bench_div.asm"):
+        os.remove(leftover)
+
+
+def bench_put(count: int) -> None:
+    """Syscalls and wall time of `count` puts, buffered and unbuffered."""
+    src = f"i := 0;\nwhile ({count} > i) {{\n    i := i + 1;\n    put i;\n}}\n"
+    print(f"{count} puts")
+    print(f"{'mode':>12} {'seconds':>10} {'writes':>10}")
+    for mode, flags in (("buffered", []), ("unbuffered", ["--unbuffered"])):
+        build(src, flags)
+        seconds, writes = min(run_output() for _ in range(3))
+        print(f"{mode:>12} {seconds:>10.4f} {writes:>10}")
+
+
+# the `put` of COMPILER_VERSION 5, as gcc -O0 compiles it: a counter in
+# memory and two 128 bits multiplications per digit, for `./bench.py format`
+OLD_PUT = """\
+put:
+        push    rbp
+        mov     rbp, rsp
+        sub     rsp, 64
+        mov     QWORD [rbp-56], rdi
+        mov     DWORD [rbp-4], 1
+        mov     eax, DWORD [rbp-4]
+        cdqe
+        mov     edx, 32
+        sub     rdx, rax
+        mov     BYTE [rbp-48+rdx], 10
+.L2:
+        mov     rcx, QWORD [rbp-56]
+        mov     rdx, 7378697629483820647
+        mov     rax, rcx
+        imul    rdx
+        sar     rdx, 2
+        mov     rax, rcx
+        sar     rax, 63
+        sub     rdx, rax
+        mov     rax, rdx
+        sal     rax, 2
+        add     rax, rdx
+        add     rax, rax
+        sub     rcx, rax
+        mov     rdx, rcx
+        mov     eax, edx
+        lea     ecx, [rax+48]
+        mov     eax, DWORD [rbp-4]
+        lea     edx, [rax+1]
+        mov     DWORD [rbp-4], edx
+        cdqe
+        mov     edx, 31
+        sub     rdx, rax
+        mov     eax, ecx
+        mov     BYTE [rbp-48+rdx], al
+        mov     rcx, QWORD [rbp-56]
+        mov     rdx, 7378697629483820647
+        mov     rax, rcx
+        imul    rdx
+        mov     rax, rdx
+        sar     rax, 2
+        sar     rcx, 63
+        mov     rdx, rcx
+        sub     rax, rdx
+        mov     QWORD [rbp-56], rax
+        cmp     QWORD [rbp-56], 0
+        jg      .L2
+        mov     eax, DWORD [rbp-4]
+        cdqe
+        mov     edx, DWORD [rbp-4]
+        movsxd  rdx, DWORD edx
+        mov     ecx, 32
+        sub     rcx, rdx
+        lea     rdx, [rbp-48]
+        add     rcx, rdx
+        mov     rdx, rax
+        mov     rsi, rcx
+        mov     rax, QWORD [outlen]
+        lea     rcx, [rax+rdx]
+        cmp     rcx, OUTBUF_SIZE
+        jbe     .L3
+        push    rsi
+        push    rdx
+        call    flush
+        pop     rdx
+        pop     rsi
+        xor     eax, eax
+.L3:
+        lea     rdi, [outbuf+rax]
+        add     rax, rdx
+        mov     QWORD [outlen], rax
+        mov     rcx, rdx
+        rep movsb
+        leave
+        ret
+"""
+
+
+def format_program(count: int) -> str:
+    """`count` puts of the numbers of 19 digits down to 1 and 0, with either sign."""
+    return (f"i := 0;\nwhile ({count // 20} > i) {{\n    i := i + 1;\n    x := i * 6364136223846793005;\n"
+            "    j := 20;\n    while (j > 0) {\n        put x;\n        x := x / 10;\n        j := j - 1;\n    }\n}\n")
+
+
+def bench_format(count: int) -> None:
+    """Run time of `count` compiled puts of mixed widths, with the old `put` and the current one."""
+    path = "bench_format.stm"
+    with open(path, "w") as file:
+        file.write(format_program(count))
+    runtime = stem.RUNTIME
+    print(f"{count} puts of 1 to 20 characters")
+    print(f"{'put':>8} {'seconds':>10} {'ns/put':>8}")
+    times = []
+    for name, put in (("old", OLD_PUT + runtime[runtime.index("flush:"):]), ("new", runtime)):
+        stem.RUNTIME = put
+        try:
+            asm = stem.compile_program("bench_format.asm", stem.load_program_from_file(path))
+            stem.write_executable("bench_format", asm)
+        finally:
+            stem.RUNTIME = runtime
+        times.append(min(timed(lambda: subprocess.run(["./bench_format"], stdout=subprocess.DEVNULL, check=True))
+                         for _ in range(3)))
+        print(f"{name:>8} {times[-1]:>10.4f} {times[-1] / count * 1e9:>8.2f}")
+    print(f"speedup {times[0] / times[1]:.2f}x")
+    for leftover in (path, "bench_format", "bench_format.asm"):
+        os.remove(leftover)
+
+
+def bench_profile(outer: int, inner: int, count: int) -> None:
+    """Run time of programs compiled with and without `com --profile`, plain and with -O."""
+    path = "bench_profile.stm"
+    profile_path = os.path.abspath("bench_profile.prof")
+    programs = [("while.stm", loop_program(outer, inner)), ("format", format_program(count))]
+    print(f"{'program':>10} {'-O':>4} {'plain':>10} {'profile':>10} {'overhead':>9} {'counters':>9}")
+    for name, src in programs:
+        with open(path, "w") as file:
+            file.write(src)
+        for optimize in (False, True):
+            outputs = set()
+            times = []
+            for profiled in (False, True):
+                program = stem.load_program_from_file(path)
+                if optimize:
+                    program = stem.optimize_program(program, {})
+                asm = stem.compile_program("bench_profile.asm", program, peephole_stats={} if optimize else None,
+                                           ir_stats={} if optimize else None,
+                                           profile_path=profile_path if profiled else "")
+                stem.write_executable("bench_profile", asm)
+                times.append(min(timed(lambda: subprocess.run(["./bench_profile"], stdout=subprocess.DEVNULL,
+                                                              check=True)) for _ in range(3)))
+                outputs.add(subprocess.run(["./bench_profile"], capture_output=True).stdout)
+            assert len(outputs) == 1, "--profile changed the output"
+            counters = len(stem.read_profile(profile_path)[1])
+            print(f"{name:>10} {'on' if optimize else 'off':>4} {times[0]:>10.4f} {times[1]:>10.4f} "
+                  f"{(times[1] / times[0] - 1) * 100:>8.1f}% {counters:>9}")
+    for leftover in (path, profile_path, "bench_profile", "bench_profile.asm"):
+        os.remove(leftover)
+
+
+def bench_build(sizes: List[int]) -> None:
+    """End to end latency of `com` with the built-in backend and with yasm and ld."""
+    backends = [("built-in", ["--no-cache"])]
+    if shutil.which("yasm") and shutil.which("ld"):
+        backends.append(("yasm + ld", ["--no-cache", "--yasm"]))
+    else:
+        print("yasm or ld is not installed, timing the built-in backend only")
+    print(f"{'lines':>10} {'backend':>10} {'seconds':>10}")
+    for lines in sizes:
+        src = straight_line_program(lines)
+        for name, flags in backends:
+            seconds = min(timed(lambda: build(src, flags)) for _ in range(3))
+            print(f"{lines:>10} {name:>10} {seconds:>10.4f}")
+
+
+def bench_modules(count: int, lines: int) -> None:
+    """`com` of one program split into `count` modules of `lines` statements, cold and incremental."""
+    directory = "bench_modules"
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    for n in range(count):
+        with open(os.path.join(directory, f"m{n}.stm"), "w") as file:
+            file.write(straight_line_program(lines))
+    main = os.path.join(directory, "main.stm")
+    with open(main, "w") as file:
+        file.write("".join(f"use m{n};\n" for n in range(count)))
+    whole = os.path.join(directory, "whole.stm")
+    with open(whole, "w") as file:
+        file.write("".join(straight_line_program(lines) for _ in range(count)))
+    output = os.path.join(directory, "output")
+
+    def com(path: str, *flags: str) -> None:
+        subprocess.run([sys.executable, STEM, "com", *flags, "-o", output, path], stdout=subprocess.DEVNULL, check=True)
+
+    def cold(*flags: str) -> None:
+        shutil.rmtree(f"{output}.modules", ignore_errors=True)
+        com(main, *flags)
+
+    jobs = os.cpu_count() or 1
+    print(f"{count} modules of {lines} statements, {jobs} CPUs")
+    print(f"{'build':>28} {'seconds':>10}")
+    builds = [("one file, no modules", lambda: com(whole, "--no-cache")),
+              ("modules, cold, -j 1", lambda: cold("-j", "1"))]
+    if jobs > 1:
+        builds.append((f"modules, cold, -j {jobs}", lambda: cold("-j", str(jobs))))
+    builds.append(("modules, nothing changed", lambda: com(main)))
+    for name, action in builds:
+        print(f"{name:>28} {min(timed(action) for _ in range(3)):>10.4f}")
+    with open(os.path.join(directory, "m0.stm"), "a") as file:
+        file.write("put 1;\n")
+    print(f"{'modules, one changed':>28} {timed(lambda: com(main)):>10.4f}")
+    shutil.rmtree(directory)
+
+
+def bench_memory(sizes: List[int]) -> None:
+    """Bytes per AST node after parsing, and the peak RSS of a whole `com`."""
+    path = "bench_memory.stm"
+    print(f"{'program':>10} {'stmts':>8} {'nodes':>9} {'bytes/node':>11} {'com peak RSS':>13}")
+    for name in ("straight", "chain"):
+        for statements in sizes:
+            with open(path, "w") as file:
+                file.write(GENERATORS[name](statements))
+            gc.collect()
+            tracemalloc.start()
+            program = stem.load_program_from_file(path)
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            nodes = stem.count_nodes(program)
+            del program
+            process = subprocess.Popen([sys.executable, STEM, "com", "--no-cache", "-o", "bench_memory", path],
+                                       stdout=subprocess.DEVNULL)
+            _, _, usage = os.wait4(process.pid, 0)
+            process.returncode = 0
+            print(f"{name:>10} {statements:>8} {nodes:>9} {allocated / nodes:>11.1f} "
+                  f"{usage.ru_maxrss / 1024:>10.1f} MiB")
+    for leftover in (path, "bench_memory", "bench_memory.asm", "bench_memory.o"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def bench_stream(sizes: List[int], whole_max: int) -> None:
+    """Wall time and peak RSS of `com` on generated programs of `sizes` MiB.
+
+    Up to `whole_max` MiB the same program also goes through `--time-phases`,
+    which keeps the whole program in memory instead of streaming it.
+    """
+    path = "bench_stream.stm"
+    block = straight_line_program(10000)
+    print(f"{'MiB':>6} {'mode':>8} {'seconds':>10} {'peak RSS':>13}")
+    for size in sizes:
+        with open(path, "w") as file:
+            for _ in range(-(-(size << 20) // len(block))):
+                file.write(block)
+        modes = [("stream", [])]
+        if size <= whole_max:
+            modes.append(("whole", ["--time-phases"]))
+        for mode, flags in modes:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, STEM, "com", "--no-cache", *flags, "-o", "bench_stream", path],
+                                       stdout=subprocess.DEVNULL)
+            _, _, usage = os.wait4(process.pid, 0)
+            process.returncode = 0
+            print(f"{size:>6} {mode:>8} {time.perf_counter() - start:>10.2f} {usage.ru_maxrss / 1024:>9.1f} MiB")
+    for leftover in (path, "bench_stream", "bench_stream.asm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def watch_request(socket_path: str, argv: List[str]) -> None:
+    """Send one command line to the `watch` listening on `socket_path` and wait for it to finish."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps({"cwd": os.getcwd(), "argv": argv}).encode() + b"\n")
+        with client.makefile("rb") as answers:
+            answer = json.loads(answers.readline())
+    assert answer["ok"], answer["log"]
+
+
+def bench_watch(count: int) -> None:
+    """Latency of `com` as a new process against a request to a running `watch`, after an edit."""
+    path = "bench_watch.stm"
+    socket_path = os.path.abspath("bench_watch.sock")
+    src = loop_program(100, 100)
+    server = subprocess.Popen([sys.executable, STEM, "watch", "--socket", socket_path], stdout=subprocess.DEVNULL)
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    modes: List[Tuple[str, Callable[[], object]]] = [
+        ("process", lambda: subprocess.run([sys.executable, STEM, "com", "-o", "bench_watch", path],
+                                           stdout=subprocess.DEVNULL, check=True)),
+        ("watch", lambda: watch_request(socket_path, ["com", "-o", "bench_watch", path])),
+    ]
+    print(f"`com` of tests/while.stm scaled down, edited before every build, {count} builds")
+    print(f"{'mode':>8} {'min ms':>8} {'median ms':>10}")
+    for mode, build_once in modes:
+        times = []
+        for i in range(count):
+            with open(path, "w") as file:
+                file.write(src + f"// edit {mode} {i} {time.time()}\n")
+            times.append(timed(build_once) * 1000)
+        times.sort()
+        print(f"{mode:>8} {times[0]:>8.2f} {times[len(times) // 2]:>10.2f}")
+    server.terminate()
+    server.wait()
+    for leftover in (path, "bench_watch", "bench_watch.asm"):
+        os.remove(leftover)
+
+
+def usage() -> None:
+    print("ERROR: usage ./bench.py [BENCHMARK]")
+    print("BENCHMARKS:")
+    print("    lex: lexer throughput from 1k to 1M lines")
+    print("    nesting: parse time of nested while blocks, depth 1 to 64")
+    print("    emit: code generation and assembly formatting from 1k to 100k lines")
+    print("    build: `com` latency of the built-in backend against yasm and ld")
+    print("    suite [-o FILE] [--max N]: lex, parse and codegen time of generated programs")
+    print("        from 10^2 to N (default 10^6) statements, written as JSON to FILE (default bench.json)")
+    print("    compare OLD NEW: phase times of the suite run NEW relative to OLD")
+    print("    modules: `com` of a program split into 16 modules, cold and after changing one")
+    print("    memory: bytes per AST node and peak RSS of `com`, 10^4 and 10^5 statements")
+    print("    stream [MiB...]: time and peak RSS of `com` streaming generated programs of 2, 8 and 32 MiB,")
+    print("        or the given sizes, against holding the whole program in memory up to 8 MiB")
+    print("    sim: tree walking vs bytecode vs jit on a scaled up tests/while.stm")
+    print("    loop: run time of the compiled scaled up tests/while.stm")
+    print("    loopopt: compiled nested loops with and without loop invariant code motion")
+    print("        and strength reduction")
+    print("    chains: instructions generated for arithmetic chains of 2 to 512 operands")
+    print("    ir: instructions and run time of programs compiled with -O, with and without the IR passes")
+    print("    watch: latency of `com` as a new process against a request to `stem.py watch`")
+    print("    put: write syscalls and run time of 10^6 compiled `put`")
+    print("    div: run time of divisions by constants against idiv, 10^7 iterations")
+    print("    spills [COUNT] [SEED]: compile COUNT (default 300) random programs whose expressions spill")
+    print("        scratch registers, check their output against the tree-walking interpreter")
+    print("    format: run time of 10^7 compiled `put` of mixed widths, old and new formatting")
+    print("    profile: run time of compiled programs with and without the counters of `com --profile`")
+
+
+def main() -> None:
+    argv = sys.argv[1:]
+    if len(argv) < 1:
+        usage()
+        exit(1)
+    benchmark, argv = stem.shift(argv)
+    if benchmark == "lex":
+        bench_lex([10 ** n for n in range(3, 7)])
+    elif benchmark == "nesting":
+        bench_nesting([2 ** n for n in range(7)], 200)
+    elif benchmark == "emit":
+        bench_emit([10 ** n for n in range(3, 6)])
+    elif benchmark == "build":
+        bench_build([10, 1000, 10000])
+    elif benchmark == "suite":
+        output = "bench.json"
+        max_statements = 10 ** 6
+        while len(argv) > 0:
+            arg, argv = stem.shift(argv)
+            if arg in ("-o", "--max") and len(argv) > 0:
+                value, argv = stem.shift(argv)
+                if arg == "-o":
+                    output = value
+                else:
+                    max_statements = int(float(value))
+            else:
+                usage()
+                exit(1)
+        bench_suite(max_statements, output)
+    elif benchmark == "compare":
+        if len(argv) != 2:
+            usage()
+            exit(1)
+        bench_compare(argv[0], argv[1])
+    elif benchmark == "modules":
+        bench_modules(16, 2000)
+    elif benchmark == "memory":
+        bench_memory([10 ** 4, 10 ** 5])
+    elif benchmark == "stream":
+        bench_stream([int(size) for size in argv] or [2, 8, 32], 8)
+    elif benchmark == "sim":
+        bench_sim(1000, 1000)
+    elif benchmark == "loop":
+        bench_loop(10000, 10000)
+    elif benchmark == "loopopt":
+        bench_loop_opt(10000, 10000)
+    elif benchmark == "chains":
+        bench_chains([2, 8, 32, 128, 512], 100)
+    elif benchmark == "ir":
+        bench_ir(10000, 10000)
+    elif benchmark == "watch":
+        bench_watch(20)
+    elif benchmark == "put":
+        bench_put(10 ** 6)
+    elif benchmark == "div":
+        bench_div(10 ** 7, [2, 16, 7, 10, 641, 1000003])
+    elif benchmark == "spills":
+        bench_spills(int(argv[0]) if argv else 300, int(argv[1]) if len(argv) > 1 else 0)
+    elif benchmark == "format":
+        bench_format(10 ** 7)
+    elif benchmark == "profile":
+        bench_profile(10000, 10000, 10 ** 7)
+    else:
+        print(f"ERROR: unknown benchmark {benchmark}")
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
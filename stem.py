@@ -1,14 +1,53 @@
 #! /usr/bin/python3
+import gc
+import hashlib
+import io
+import json
+import marshal
+import os
+import re
+import resource
+import shutil
+import signal
+import socket
+import struct
 import sys
 import subprocess
-from typing import List, Dict, Tuple, no_type_check
+import time
+import tracemalloc
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from types import CodeType
+from typing import Callable, Iterable, Iterator, List, Dict, NamedTuple, Set, TextIO, Tuple
 
 
-POS = Tuple[str, int, int]
+# A position packs (line << 32 | column) << 16 | index in `source_files`
+# into one int, `unpack_pos` gives back (file, line, column).
+POS = int
 Lexeme = Tuple[int, str | int, POS]
 
+source_files: List[str] = []
+source_file_indices: Dict[str, int] = {}
+
+
+def source_file_index(file_path: str) -> int:
+    if file_path not in source_file_indices:
+        source_file_indices[file_path] = len(source_files)
+        source_files.append(file_path)
+    return source_file_indices[file_path]
+
+
+def pack_pos(file_path: str, line: int, col: int) -> POS:
+    return (line << 32 | col) << 16 | source_file_index(file_path)
+
+
+def unpack_pos(pos: POS) -> Tuple[str, int, int]:
+    return source_files[pos & 0xFFFF], pos >> 48, pos >> 16 & 0xFFFFFFFF
+
 
 class AST:
+    __slots__ = ("op_type", "left_side", "right_side")
+
     def __init__(self, op_type: int, left_side: 'AST' | Lexeme | None = None,
                  right_side: 'AST' | Lexeme | List['AST | Lexeme'] | None = None):
         self.op_type = op_type
@@ -20,11 +59,35 @@ class AST:
 Program = List[AST]
 
 
-def run_and_write(lst: List[str]) -> None:
+# resource usage of every subprocess run_and_write waited for, see Phase
+child_usages: List[resource.struct_rusage] = []
+
+
+def run_and_write(lst: List[str]) -> int:
     for el in lst:
         print(el, end=" ")
     print()
-    subprocess.run(lst)
+    process = subprocess.Popen(lst)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    child_usages.append(usage)
+    return process.returncode
+
+
+class PausedGC:
+    """Turns the cyclic garbage collector off for a `with` block.
+
+    What the compiler builds is acyclic, reference counting frees it, and the
+    collector would only rescan the whole AST over and over.
+    """
+
+    def __enter__(self) -> None:
+        self.was_enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc: object) -> None:
+        if self.was_enabled:
+            gc.enable()
 
 
 iota__ = -1
@@ -44,6 +107,7 @@ OP_ASSIGN = iota(True)
 OP_PLUS = iota()
 OP_MINUS = iota()
 OP_SLASH = iota()
+OP_MOD = iota()
 OP_MULT = iota()
 OP_PUT = iota()
 OP_EQUAL = iota()
@@ -55,6 +119,7 @@ OP_CLOSE_BRACKET = iota()
 OP_OPEN_PAREN = iota()
 OP_CLOSE_PAREN = iota()
 OP_SEMICOLON = iota()
+OP_USE = iota()
 COUNT_OPS = iota()
 
 VAR = iota()
@@ -63,7 +128,7 @@ EOF = iota()
 EOBrack = iota()
 
 # OPERATIONS #####
-assert COUNT_OPS == 15, "number of expected op in operations"
+assert COUNT_OPS == 17, "number of expected op in operations"
 
 
 def assign(x: AST | Lexeme, y: AST | Lexeme) -> AST:
@@ -82,6 +147,14 @@ def mult(x: AST | Lexeme, y: AST | Lexeme) -> AST:
     return AST(OP_MULT, x, y)
 
 
+def div(x: AST | Lexeme, y: AST | Lexeme) -> AST:
+    return AST(OP_SLASH, x, y)
+
+
+def mod(x: AST | Lexeme, y: AST | Lexeme) -> AST:
+    return AST(OP_MOD, x, y)
+
+
 def equal(x: AST | Lexeme, y: AST | Lexeme) -> AST:
     return AST(OP_EQUAL, x, y)
 
@@ -102,6 +175,10 @@ def put(x: AST | Lexeme) -> AST:
     return AST(OP_PUT, x)
 
 
+def use(module: Lexeme) -> AST:
+    return AST(OP_USE, module)
+
+
 def eof() -> AST:
     return AST(EOF)
 
@@ -115,134 +192,126 @@ def int_(x: Lexeme) -> AST:
 def var_(x: Lexeme) -> AST:
     return AST(VAR, x)
 
-lexer_line = 0
-lexer_col = 0
+KEYWORDS: Dict[str, int] = {
+    "put": OP_PUT,
+    "if": OP_IF,
+    "while": OP_WHILE,
+    "use": OP_USE,
+}
 
+PUNCTUATION: Dict[str, int] = {
+    '+': OP_PLUS,
+    '-': OP_MINUS,
+    '*': OP_MULT,
+    '/': OP_SLASH,
+    '%': OP_MOD,
+    '(': OP_OPEN_PAREN,
+    ')': OP_CLOSE_PAREN,
+    '{': OP_OPEN_BRACKET,
+    '}': OP_CLOSE_BRACKET,
+    '=': OP_EQUAL,
+    '>': OP_GT,
+    ';': OP_SEMICOLON,
+    ':=': OP_ASSIGN,
+}
 
-def left_strip(string: str) -> tuple[int, int, str]:
-    col = 0
-    line = 0
-    while (col + line) < len(string) and string[col + line].isspace():
-        if string[col + line] == '\n':
-            line, col = line + 1, 0
-        else:
-            col += 1
-    return col, line, string[col + line:]
+# One match per token: skip blanks and `//` comments, then grab the token.
+TOKEN_RE = re.compile(r"""
+    (?:\s+|//[^\n]*)*
+    (?:
+        (?P<int>\d+)
+      | (?P<word>[^\W\d_][^\W_]*)
+      | (?P<punct>:=|[-+*/%(){}=>;])
+    )?
+""", re.VERBOSE)
 
 
 class Lexer:
+    """Tokenize `src` by moving an integer cursor over the immutable buffer."""
 
     def __init__(self, src: str, file_path: str):
         self.src = src
         self.file_path = file_path
+        self.cursor = 0
+        self.line = 1
+        self.line_start = 0
+        self.file_index = source_file_index(file_path)
+        # position of column 0 of the current line
+        self.line_pos = pack_pos(file_path, 1, 0)
 
     def next(self) -> Lexeme:
-        global lexer_line
-        global lexer_col
-
-        assert COUNT_OPS == 15, "Op count changed in Lexer().next()"
-
-        saved_col, saved_line, self.src = left_strip(self.src)
-        lexer_line += saved_line
-        if saved_line > 0:
-            lexer_col = saved_col
-        else:
-            lexer_col += saved_col
+        assert COUNT_OPS == 17, "Op count changed in Lexer().next()"
 
-        pos = (self.file_path, lexer_line, lexer_col)
+        src = self.src
+        match = TOKEN_RE.match(src, self.cursor)
+        assert match is not None, "TOKEN_RE always matches"
+        kind = match.lastgroup
+        start = match.start(kind) if kind is not None else match.end()
 
-        if len(self.src) == 0:
-            return EOF, "EOF", pos
+        newlines = src.count('\n', self.cursor, start)
+        if newlines:
+            self.line += newlines
+            self.line_start = src.rindex('\n', self.cursor, start) + 1
+            self.line_pos = self.line << 48 | self.file_index
+        self.cursor = match.end()
+        pos = self.line_pos | (start - self.line_start + 1) << 16
 
-        if self.src[0] == '+':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_PLUS, '+', pos
-        elif self.src[0] == '-':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_MINUS, '-', pos
-        elif self.src[0] == '*':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_MULT, '*', pos
-        elif self.src[0] == '(':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_OPEN_PAREN, '(', pos
-        elif self.src[0] == ')':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_CLOSE_PAREN, ')', pos
-
-        elif self.src[0] == '{':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_OPEN_BRACKET, '{', pos
-        elif self.src[0] == '}':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_CLOSE_BRACKET, '}', pos
-        elif self.src[0] == '=':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_EQUAL, '=', pos
-        elif self.src[0] == '>':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_GT, '>', pos
-        elif self.src[0] == ';':
-            self.src = self.src[1:]
-            lexer_col += 1
-            return OP_SEMICOLON, ';', pos
-        elif self.src[0] == '/':
-            if self.src[1] == '/':
-                i = 0
-                while self.src[i] != '\n':
-                    i += 1
-                lexer_line += 1
-                self.src = self.src[i:]
-                return self.next()
-            else:
-                assert False, "TODO, not implemented yet."
-        elif self.src[0] == ':':
-            if self.src[1] == '=':
-                self.src = self.src[2:]
-                lexer_col += 2
-                return OP_ASSIGN, ':=', pos
-            else:
-                print(f"\"{self.file_path}\":{lexer_line}:{lexer_col}: "
-                      f"ERROR: `{self.src[0]}` is not a recognizable token")
+        if kind == "punct":
+            token = sys.intern(match.group(kind))
+            return PUNCTUATION[token], token, pos
+        elif kind == "word":
+            token = sys.intern(match.group(kind))
+            return KEYWORDS.get(token, VAR), token, pos
+        elif kind == "int":
+            value = int(match.group(kind))
+            if value >= 1 << 64:
+                # below that the literal wraps to 64 bits, see wrap64
+                file, line, col = unpack_pos(pos)
+                print(f"{file}:{line}:{col}: ERROR: `{match.group(kind)}` does not fit in 64 bits")
                 exit(1)
-        elif self.src[0].isalpha():
-            token = ""
-            i = 0
-            while i < len(self.src) and self.src[i].isalnum():
-                token += self.src[i]
-                i += 1
-            self.src = self.src[len(token):]
-            lexer_col += i
-            if token == "put":
-                return OP_PUT, token, pos
-            if token == "if":
-                return OP_IF, token, pos
-            if token == "while":
-                return OP_WHILE, token, pos
-            else:
-                return VAR, token, pos
-        elif self.src[0].isnumeric():
-            token = ""
-            i = 0
-            while i < len(self.src) and self.src[i].isnumeric():
-                token += self.src[i]
-                i += 1
-            self.src = self.src[len(token):]
-            lexer_col += i
-            return INT, int(token), pos
+            return INT, value, pos
+        elif start == len(src):
+            return EOF, "EOF", pos
         else:
-            print(f"\"{self.file_path}\":{lexer_line}:{lexer_col}: ERROR: `{self.src[0]}` is not a recognizable token")
+            file, line, col = unpack_pos(pos)
+            print(f"\"{file}\":{line}:{col}: ERROR: `{src[start]}` is not a recognizable token")
             exit(1)
-            return -1, "ERROR", pos
+
+
+# `com` streams the programs longer than one chunk, see stream_compile
+LEX_CHUNK_SIZE = 1 << 20
+
+
+class StreamLexer(Lexer):
+    """A Lexer reading `file` about `chunk_size` characters at a time.
+
+    The buffer always ends at the end of a line, which no token crosses, so
+    running out of it only means reading on.
+    """
+
+    def __init__(self, file: TextIO, file_path: str, chunk_size: int = LEX_CHUNK_SIZE):
+        super().__init__("", file_path)
+        self.file = file
+        self.chunk_size = chunk_size
+        self.at_end = False
+        self.fill()
+
+    def fill(self) -> None:
+        """Drop the lexed part of the buffer and append the next lines of the file."""
+        chunk = self.file.read(self.chunk_size)
+        if chunk and not chunk.endswith("\n"):
+            chunk += self.file.readline()
+        self.at_end = chunk == ""
+        self.src = self.src[self.cursor:] + chunk
+        self.line_start -= self.cursor
+        self.cursor = 0
+
+    def next(self) -> Lexeme:
+        lexeme = Lexer.next(self)
+        while lexeme[0] == EOF and not self.at_end:
+            self.fill()
+            lexeme = Lexer.next(self)
+        return lexeme
 
 
 def parse_primary(lexer: Lexer) -> Lexeme:
@@ -250,85 +319,50 @@ def parse_primary(lexer: Lexer) -> Lexeme:
     return lexeme
 
 
-def parse_if(lexer: Lexer, source: str) -> Tuple[AST, List[AST]]:
+def parse_condition(lexer: Lexer, source: str, keyword: str) -> AST:
     global in_paren
-    global in_bracket
     paren = lexer.next()
     if paren[0] != OP_OPEN_PAREN:
-        file, l, c = paren[2]
-        print(f"{file}:{l}:{c}: ERROR: after expected `(` after `if`, but got `{paren[1]}`")
+        file, l, c = unpack_pos(paren[2])
+        print(f"{file}:{l}:{c}: ERROR: after expected `(` after `{keyword}`, but got `{paren[1]}`")
         exit(1)
     in_paren += 1
-    condition = parse(lexer, source)
+    return parse(lexer, source)
+
+
+def parse_block(lexer: Lexer, source: str) -> List[AST]:
+    """Parse statements up to the matching `}` straight from `lexer`."""
+    global in_bracket
     bracket = lexer.next()
     if bracket[0] != OP_OPEN_BRACKET:
-        file, l, c = bracket[2]
+        file, l, c = unpack_pos(bracket[2])
         print(f"{file}:{l}:{c}: ERROR: after expected `%s` after `)`, but got `{bracket[1]}`" % "{")
         exit(1)
-    current_bracket = in_bracket
     in_bracket += 1
-    met_bracket = in_bracket
     body = []
-    token = lexer.next()
-    src = str(token[1])
-
-    while current_bracket != met_bracket:
-        token = lexer.next()
-        if token is None:
-            print("token was equal to none, whatever that means TODO: improve this error message")
-            exit(1)
-        if token[0] == OP_OPEN_BRACKET:
-            met_bracket += 1
-        elif token[0] == OP_CLOSE_BRACKET:
-            met_bracket -= 1
-        src += " " + str(token[1])
-    lexer = Lexer(src, source)
     expr = parse(lexer, source)
     while expr.op_type != EOBrack:
+        if expr.op_type == EOF:
+            file, l, c = unpack_pos(bracket[2])
+            print(f"{file}:{l}:{c}: ERROR: `%s` is never closed" % "{")
+            exit(1)
+        if expr.op_type == OP_USE:
+            file, l, c = unpack_pos(expr.left_side[2])  # type: ignore
+            print(f"{file}:{l}:{c}: ERROR: `use` can only appear at the top level of a program")
+            exit(1)
         body.append(expr)
         expr = parse(lexer, source)
-    return condition, body
+    return body
 
 
-def parse_while(lexer: Lexer, source: str) -> Tuple[AST, List[AST]]:
-    global in_paren
-    global in_bracket
-    paren = lexer.next()
-    if paren[0] != OP_OPEN_PAREN:
-        file, l, c = paren[2]
-        print(f"{file}:{l}:{c}: ERROR: after expected `(` after `while`, but got `{paren[1]}`")
-        exit(1)
-    in_paren += 1
-    condition = parse(lexer, source)
-    bracket = lexer.next()
-    if bracket[0] != OP_OPEN_BRACKET:
-        file, l, c = bracket[2]
-        print(f"{file}:{l}:{c}: ERROR: after expected `%s` after `)`, but got `{bracket[1]}`" % "{")
-        exit(1)
+def parse_if(lexer: Lexer, source: str) -> Tuple[AST, List[AST]]:
+    condition = parse_condition(lexer, source, "if")
+    return condition, parse_block(lexer, source)
 
-    current_bracket = in_bracket
-    in_bracket += 1
-    met_bracket = in_bracket
-    body = []
-    token = lexer.next()
-    src = str(token[1])
 
-    while current_bracket != met_bracket:
-        token = lexer.next()
-        if token is None:
-            print("token was equal to none, whatever that means TODO: improve this error message")
-            exit(1)
-        if token[0] == OP_OPEN_BRACKET:
-            met_bracket += 1
-        elif token[0] == OP_CLOSE_BRACKET:
-            met_bracket -= 1
-        src += " " + str(token[1])
-    lexer = Lexer(src, source)
-    expr = parse(lexer, source)
-    while expr.op_type != EOBrack:
-        body.append(expr)
-        expr = parse(lexer, source)
-    return condition, body
+def parse_while(lexer: Lexer, source: str) -> Tuple[AST, List[AST]]:
+    condition = parse_condition(lexer, source, "while")
+    return condition, parse_block(lexer, source)
 
 
 in_paren = 0
@@ -339,12 +373,24 @@ def parse(lexer: Lexer, source: str) -> AST:
     global in_paren
     global in_bracket
     lvalue = parse_primary(lexer)
-    assert COUNT_OPS == 15, "Op count changed in parse()"
+    assert COUNT_OPS == 17, "Op count changed in parse()"
     if lvalue[0] == EOF:
         return eof()
     if lvalue[0] == OP_PUT:
-        rvalue = parse(lexer, source)
+        rvalue = parse_operand(lexer, source, lvalue)
         return put(rvalue)
+    elif lvalue[0] == OP_USE:
+        module = lexer.next()
+        if module[0] != VAR:
+            file, l, c = unpack_pos(module[2])
+            print(f"{file}:{l}:{c}: ERROR: expected a module name after `use`, but got `{module[1]}`")
+            exit(1)
+        semicolon = lexer.next()
+        if semicolon[0] != OP_SEMICOLON:
+            file, l, c = unpack_pos(semicolon[2])
+            print(f"{file}:{l}:{c}: ERROR: expected `;` after `use {module[1]}`, but got `{semicolon[1]}`")
+            exit(1)
+        return use(module)
     #    elif lvalue[0] == OP_SEMICOLON:
     #        return semicolon()
     elif lvalue[0] == OP_IF:
@@ -359,7 +405,7 @@ def parse(lexer: Lexer, source: str) -> AST:
         assert False, "TODO: Not implemented yet"
     elif lvalue[0] == OP_CLOSE_PAREN:
         if in_paren < 0:
-            file, l, c = lvalue[2]
+            file, l, c = unpack_pos(lvalue[2])
             print(f"{file}:{l}:{c}: ERROR: no parenthesis before `)`")
             exit(1)
         in_paren -= 1
@@ -371,7 +417,7 @@ def parse(lexer: Lexer, source: str) -> AST:
     elif lvalue[0] == OP_CLOSE_BRACKET:
         in_bracket -= 1
         if in_bracket < 0:
-            file, l, c = lvalue[2]
+            file, l, c = unpack_pos(lvalue[2])
             print("%s:%s:%s: ERROR: no bracket before `}`" % (str(file), str(l), str(c)))
             exit(1)
         return eobrack()
@@ -379,22 +425,28 @@ def parse(lexer: Lexer, source: str) -> AST:
         op_token = lexer.next()
         if op_token is not None:
             if op_token[0] == OP_PLUS:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return plus(lvalue, rvalue)
             elif op_token[0] == OP_MINUS:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return minus(lvalue, rvalue)
             elif op_token[0] == OP_MULT:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return mult(lvalue, rvalue)
+            elif op_token[0] == OP_SLASH:
+                rvalue = parse_operand(lexer, source, op_token)
+                return div(lvalue, rvalue)
+            elif op_token[0] == OP_MOD:
+                rvalue = parse_operand(lexer, source, op_token)
+                return mod(lvalue, rvalue)
             elif op_token[0] == OP_ASSIGN:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return assign(lvalue, rvalue)
             elif op_token[0] == OP_EQUAL:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return equal(lvalue, rvalue)
             elif op_token[0] == OP_GT:
-                rvalue = parse(lexer, source)
+                rvalue = parse_operand(lexer, source, op_token)
                 return gt(lvalue, rvalue)
             elif op_token[0] == OP_OPEN_PAREN:
                 # @TODO: implement OPEN_PAREN
@@ -402,7 +454,7 @@ def parse(lexer: Lexer, source: str) -> AST:
                 assert False, "TODO: Not implemented yet"
             elif op_token[0] == OP_CLOSE_PAREN:
                 if in_paren < 0:
-                    file, l, c = lvalue[2]
+                    file, l, c = unpack_pos(lvalue[2])
                     print(f"{file}:{l}:{c}: ERROR: no parenthesis before `)`")
                     exit(1)
                 in_paren -= 1
@@ -413,7 +465,7 @@ def parse(lexer: Lexer, source: str) -> AST:
             elif op_token[0] == OP_CLOSE_BRACKET:
                 in_bracket -= 1
                 if in_bracket < 0:
-                    file, l, c = lvalue[2]
+                    file, l, c = unpack_pos(lvalue[2])
                     print(f"{file}:{l}:{c}: ERROR: no bracket before " + "`}`")
                     exit(1)
                 return eobrack()
@@ -424,7 +476,7 @@ def parse(lexer: Lexer, source: str) -> AST:
                 return eof()
             else:
 
-                file, l, c = op_token[2]
+                file, l, c = unpack_pos(op_token[2])
                 print(
                     f"./{file}:{l}:{c} ERROR: unexpected binary operation `{op_token[1]}`,"
                     f" the value before was `{lvalue[1]}`, maybe you forgot `;` ?")
@@ -435,342 +487,4473 @@ def parse(lexer: Lexer, source: str) -> AST:
         return int_(lvalue)
 
 
-def load_program_from_file(prog_path: str) -> Program:
-    file = open(prog_path, "r")
-    program = []
+def parse_operand(lexer: Lexer, source: str, before: Lexeme) -> AST:
+    """`parse` what comes after `before`, which must be a value."""
+    rvalue = parse(lexer, source)
+    if rvalue.op_type in (EOF, EOBrack):
+        file, l, c = unpack_pos(before[2])
+        print(f"{file}:{l}:{c}: ERROR: expected a value after `{before[1]}`")
+        exit(1)
+    return rvalue
+
+
+def parse_statements(lexer: Lexer, prog_path: str) -> Iterator[AST]:
+    """Yield the top level statements of the program one at a time, the EOF last."""
     expr = AST(-1)
-    lexer = Lexer(file.read(), prog_path)
     while expr.op_type != EOF:
         expr = parse(lexer, prog_path)
-        program.append(expr)
-    return program
-
-
-var_dict: Dict[str, str] = {}
-
-rbp_sub = 0
-addr_num = 0
-
-f = open("output.asm", "w")
-
-
-@no_type_check
-def compile_program(file_name, program, rec=False):
-    """Open a file and write assembly code in it."""
-    global rbp_sub
-    global var_dict
-    global f
-    global addr_num
-
-    if not rec:
-        f.write("BITS 64\n")
-        f.write("%define SYS_EXIT 60\n")
-        f.write("segment .text\n")
-        f.write("global _start\n")
-        f.write("put:\n")
-        f.write("        push    rbp\n")
-        f.write("        mov     rbp, rsp\n")
-        f.write("        sub     rsp, 64\n")
-        f.write("        mov     QWORD [rbp-56], rdi\n")
-        f.write("        mov     DWORD [rbp-4], 1\n")
-        f.write("        mov     eax, DWORD [rbp-4]\n")
-        f.write("        cdqe\n")
-        f.write("        mov     edx, 32\n")
-        f.write("        sub     rdx, rax\n")
-        f.write("        mov     BYTE [rbp-48+rdx], 10\n")
-        f.write(".L2:\n")
-        f.write("        mov     rcx, QWORD [rbp-56]\n")
-        f.write("        mov     rdx, 7378697629483820647\n")
-        f.write("        mov     rax, rcx\n")
-        f.write("        imul    rdx\n")
-        f.write("        sar     rdx, 2\n")
-        f.write("        mov     rax, rcx\n")
-        f.write("        sar     rax, 63\n")
-        f.write("        sub     rdx, rax\n")
-        f.write("        mov     rax, rdx\n")
-        f.write("        sal     rax, 2\n")
-        f.write("        add     rax, rdx\n")
-        f.write("        add     rax, rax\n")
-        f.write("        sub     rcx, rax\n")
-        f.write("        mov     rdx, rcx\n")
-        f.write("        mov     eax, edx\n")
-        f.write("        lea     ecx, [rax+48]\n")
-        f.write("        mov     eax, DWORD [rbp-4]\n")
-        f.write("        lea     edx, [rax+1]\n")
-        f.write("        mov     DWORD [rbp-4], edx\n")
-        f.write("        cdqe\n")
-        f.write("        mov     edx, 31\n")
-        f.write("        sub     rdx, rax\n")
-        f.write("        mov     eax, ecx\n")
-        f.write("        mov     BYTE [rbp-48+rdx], al\n")
-        f.write("        mov     rcx, QWORD [rbp-56]\n")
-        f.write("        mov     rdx, 7378697629483820647\n")
-        f.write("        mov     rax, rcx\n")
-        f.write("        imul    rdx\n")
-        f.write("        mov     rax, rdx\n")
-        f.write("        sar     rax, 2\n")
-        f.write("        sar     rcx, 63\n")
-        f.write("        mov     rdx, rcx\n")
-        f.write("        sub     rax, rdx\n")
-        f.write("        mov     QWORD [rbp-56], rax\n")
-        f.write("        cmp     QWORD [rbp-56], 0\n")
-        f.write("        jg      .L2\n")
-        f.write("        mov     eax, DWORD [rbp-4]\n")
-        f.write("        cdqe\n")
-        f.write("        mov     edx, DWORD [rbp-4]\n")
-        f.write("        movsxd  rdx, DWORD edx\n")
-        f.write("        mov     ecx, 32\n")
-        f.write("        sub     rcx, rdx\n")
-        f.write("        lea     rdx, [rbp-48]\n")
-        f.write("        add     rcx, rdx\n")
-        f.write("        mov     rdx, rax\n")
-        f.write("        mov     rsi, rcx\n")
-        f.write("        mov     edi, 1\n")
-        f.write("        mov     rax, 1\n")
-        f.write("        syscall\n")
-        f.write("        nop\n")
-        f.write("        leave\n")
-        f.write("        ret\n")
-        f.write("main:\n")
-        f.write("        push    rbp\n")
-        f.write("        mov     rbp, rsp\n")
-        f.write("        sub     rsp, 16\n")
-
-
-    assert COUNT_OPS == 15, "Op count changed in compile_program()"
+        yield expr
+
+
+def parse_program(lexer: Lexer, prog_path: str) -> Program:
+    return list(parse_statements(lexer, prog_path))
+
+
+def stream_program(prog_path: str) -> Iterator[AST]:
+    """Yield the top level statements of `prog_path`, read in chunks."""
+    with open(prog_path, "r") as file:
+        yield from parse_statements(StreamLexer(file, prog_path), prog_path)
+
+
+def load_module(prog_path: str) -> Program:
+    if source_cache is not None:
+        return source_cache.program(prog_path)
+    with open(prog_path, "r") as file:
+        return parse_program(Lexer(file.read(), prog_path), prog_path)
+
+
+def module_path(user_path: str, name: str) -> str:
+    """Path of the module `name` that the file `user_path` uses."""
+    return os.path.normpath(os.path.join(os.path.dirname(user_path), name + ".stm"))
+
+
+def inline_modules(program: Program, prog_path: str, users: Tuple[str, ...] = ()) -> Program:
+    """`program` with the code of the module it names in place of every `use`."""
+    if not any(op.op_type == OP_USE for op in program):
+        return program
+    users += (os.path.normpath(prog_path),)
+    inlined = []
     for op in program:
-        addr_num += 1
-        ip = addr_num
+        if op.op_type != OP_USE:
+            inlined.append(op)
+            continue
+        path = module_path(prog_path, op.left_side[1])  # type: ignore
+        file, l, c = unpack_pos(op.left_side[2])  # type: ignore
+        if path in users:
+            print(f"{file}:{l}:{c}: ERROR: module `{op.left_side[1]}` uses itself through "  # type: ignore
+                  + " -> ".join(users[users.index(path):] + (path,)))
+            exit(1)
+        if not os.path.isfile(path):
+            print(f"{file}:{l}:{c}: ERROR: cannot find module `{op.left_side[1]}` at {path}")  # type: ignore
+            exit(1)
+        # without the EOF of the module, which would end the program
+        inlined += inline_modules(load_module(path), path, users)[:-1]
+    return inlined
 
-        if op.op_type == EOF:
-            f.close()
-            f = open("output.asm", "a")
-            f.write("        mov rax, SYS_EXIT\n")
-            f.write("        mov rdi, 0\n")
-            f.write("        syscall\n")
-            f.write("_start:\n")
-            f.write("        call main\n")
-            f.close()
-            return
-        elif op.op_type == OP_ASSIGN:
-            tmp = op.left_side
-            to_save = op.left_side[1]
-            if type(op.right_side) == AST:
-                if op.right_side.op_type in (INT, VAR):
-                    if op.right_side.op_type == INT:
-                        tmp = op.right_side.left_side[1]
-                    else:
-                        rhs = op.right_side.left_side[1]
-                        if not rhs in var_dict.keys():
-                            print("ERROR: can not assign value not introduced before") # TODO make this english
-                            exit(1)
-                        tmp = var_dict[rhs]
-                else:
-                    tmp = [op.right_side]
-                    string = compile_program(file_name, tmp, rec=True)
-                    f.write(string)
-                    tmp = "rax"
-            if not to_save in var_dict:
-                rbp_sub += 8  # this is increased during reassignment
-                var_dict[op.left_side[1]] = f"QWORD [rsp + {rbp_sub}]"
-            f.write("       ;; -- assign %s -- \n" % to_save)
-            f.write(" ")
-            f.write(f"       mov     {var_dict[to_save]}, {tmp}\n")
-
-        elif op.op_type == OP_PLUS:
-            if type(op.left_side) == tuple:
-                if type(op.left_side[1]) == str:
-                    var1 = var_dict[op.left_side[1]]
-                elif type(op.left_side[1]) == int:
-                    var1 = op.left_side[1]
-            else:
-                assert False, "unreachable"
-            if op.right_side.op_type == VAR:
-                var2 = var_dict[op.right_side.left_side[1]]
-            elif op.right_side.op_type == INT:
-                var2 = op.right_side.left_side[1]
-            else:
-                string = compile_program(file_name, [op.right_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var2 = "rcx"
-            string = "        ;;-- plus --\n"
-            string += "        mov     rax, %s\n" % var1
-            string += "        mov     rbx, %s\n" % var2
-            string += "        add     rax, rbx\n"
-            return string
-
-        elif op.op_type == OP_MINUS:
-            if type(op.left_side) == tuple:
-                if type(op.left_side[1]) == str:
-                    var1 = var_dict[op.left_side[1]]
-                elif type(op.left_side[1]) == int:
-                    var1 = op.left_side[1]
-            else:
-                assert False, "unreachable"
-            if op.right_side.op_type == VAR:
-                var2 = var_dict[op.right_side.left_side[1]]
-            elif op.right_side.op_type == INT:
-                var2 = op.right_side.left_side[1]
-            else:
-                string = compile_program(file_name, [op.right_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var2 = "rcx"
-            string = "        ;;-- minus --\n"
-            string += "        mov     rax, %s\n" % var1
-            string += "        mov     rbx, %s\n" % var2
-            string += "        sub     rax, rbx\n"
-            return string
-
-        elif op.op_type == OP_MULT:
-            if type(op.left_side) == tuple:
-                if type(op.left_side[1]) == str:
-                    var1 = var_dict[op.left_side[1]]
-                elif type(op.left_side[1]) == int:
-                    var1 = op.left_side[1]
-            else:
-                assert False, "unreachable"
-            if op.right_side.op_type == VAR:
-                var2 = var_dict[op.right_side.left_side[1]]
-            elif op.right_side.op_type == INT:
-                var2 = op.right_side.left_side[1]
-            else:
-                string = compile_program(file_name, [op.right_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var2 = "rcx"
-
-            string = "        ;;-- mult --\n"
-            string += "        mov     rax, %s\n" % var1
-            string += "        mov     rbx, %s\n" % var2
-            string += "        mul     rbx\n"
-            return string
-
-        elif op.op_type == OP_EQUAL:
-            if type(op.left_side) == tuple:
-                if type(op.left_side[1]) == str:
-                    var1 = var_dict[op.left_side[1]]
-                elif type(op.left_side[1]) == int:
-                    var1 = op.left_side[1]
-            else:
-                assert False, "unreachable"
-            if op.right_side.op_type == VAR:
-                var2 = var_dict[op.right_side.left_side[1]]
-            elif op.right_side.op_type == INT:
-                var2 = op.right_side.left_side[1]
-            else:
-                string = compile_program(file_name, [op.right_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var2 = "rcx"
-
-            string = "        ;;-- equal --\n"
-            string += "        mov     rax, %s\n" % var1
-            string += "        cmp     rax, %s\n" % var2
-            string += "        sete    al      \n"
-            string += "        movzx   rax, al\n"
-            return string
-
-        elif op.op_type == OP_GT:
-            if type(op.left_side) == tuple:
-                if type(op.left_side[1]) == str:
-                    var1 = var_dict[op.left_side[1]]
-                elif type(op.left_side[1]) == int:
-                    var1 = op.left_side[1]
-            else:
-                assert False, "unreachable"
-            if op.right_side.op_type == VAR:
-                var2 = var_dict[op.right_side.left_side[1]]
-            elif op.right_side.op_type == INT:
-                var2 = op.right_side.left_side[1]
+
+def load_program_from_file(prog_path: str) -> Program:
+    """Parse `prog_path` and the modules it uses into one program."""
+    return inline_modules(load_module(prog_path), prog_path)
+
+
+# OPTIMIZATIONS #####
+# Passes rewrite a Program into an equivalent one and count what they did
+# in `stats`, which `-O` reports.
+
+def is_constant(node: AST | Lexeme) -> bool:
+    if type(node) == tuple:
+        return node[0] == INT
+    return node.op_type == INT  # type: ignore
+
+
+def constant_value(node: AST | Lexeme) -> int:
+    if type(node) == tuple:
+        return node[1]  # type: ignore
+    return node.left_side[1]  # type: ignore
+
+
+def evaluate(op_type: int, left: int, right: int) -> int:
+    """Value of `left op right`, the way the generated code computes it.
+
+    A division must not be one the generated code faults on, see division_error.
+    """
+    assert COUNT_OPS == 17, "Op count changed in evaluate()"
+    if op_type == OP_PLUS:
+        return wrap64(left + right)
+    elif op_type == OP_MINUS:
+        return wrap64(left - right)
+    elif op_type == OP_MULT:
+        return wrap64(left * right)
+    elif op_type == OP_SLASH:
+        return divide(left, right)[0]
+    elif op_type == OP_MOD:
+        return divide(left, right)[1]
+    elif op_type == OP_EQUAL:
+        return int(left == right)
+    elif op_type == OP_GT:
+        return int(left > right)
+    assert False, "unreachable"
+
+
+def fold_expr(node: AST | Lexeme, env: Dict[str, int], stats: Dict[str, int]) -> AST | Lexeme:
+    """Fold `node` using the known values in `env`, keeping its shape.
+
+    Literals come out wrapped to 64 bits, like the generated code reads them.
+    """
+    if type(node) == tuple:
+        if node[0] == VAR and node[1] in env:
+            stats["propagated"] += 1
+            return INT, env[node[1]], node[2]  # type: ignore
+        if node[0] == INT and wrap64(node[1]) != node[1]:  # type: ignore
+            return INT, wrap64(node[1]), node[2]  # type: ignore
+        return node
+    assert isinstance(node, AST)
+    if node.op_type == VAR:
+        if node.left_side[1] in env:  # type: ignore
+            return int_(fold_expr(node.left_side, env, stats))  # type: ignore
+        return node
+    elif node.op_type == INT:
+        if wrap64(node.left_side[1]) != node.left_side[1]:  # type: ignore
+            return int_(fold_expr(node.left_side, env, stats))  # type: ignore
+        return node
+    left = fold_expr(node.left_side, env, stats)  # type: ignore
+    right = fold_expr(node.right_side, env, stats)  # type: ignore
+    if is_constant(left) and is_constant(right) and not (
+            node.op_type in (OP_SLASH, OP_MOD) and division_error(constant_value(left), constant_value(right))):
+        stats["folded"] += 1
+        value = evaluate(node.op_type, constant_value(left), constant_value(right))
+        return int_((INT, value, left[2]))  # type: ignore
+    return AST(node.op_type, left, right)  # type: ignore
+
+
+def may_fault(node: AST | Lexeme) -> bool:
+    """Whether evaluating `node` may divide by zero or overflow, unless its divisors are constants other than 0 and -1."""
+    # binary nodes hold a lexeme on the left, so only the right side nests
+    while type(node) != tuple and node.op_type not in (INT, VAR):  # type: ignore
+        if node.op_type in (OP_SLASH, OP_MOD) and not (  # type: ignore
+                is_constant(node.right_side) and constant_value(node.right_side) not in (0, -1)):  # type: ignore
+            return True
+        node = node.right_side  # type: ignore
+    return False
+
+
+def assigned_vars(program: List[AST]) -> Set[str]:
+    names: Set[str] = set()
+    for op in program:
+        if op.op_type == OP_ASSIGN:
+            names.add(op.left_side[1])  # type: ignore
+        elif op.op_type in (OP_IF, OP_WHILE):
+            names |= assigned_vars(op.right_side)  # type: ignore
+    return names
+
+
+def never_taken(body: List[AST], pos: POS) -> List[AST]:
+    """What stays of a `body` that never runs, at `pos`.
+
+    The variables it assigns still count as assigned in the code after it,
+    and are read there as 0 when nothing else assigned them, so an `if`
+    that is never taken assigns them 0 instead.
+    """
+    names = assigned_vars(body)
+    if not names:
+        return []
+    zero = int_((INT, 0, pos))
+    return [if_(zero, [assign((VAR, name, pos), zero) for name in sorted(names)])]  # type: ignore
+
+
+def is_never_taken(op: AST) -> bool:
+    """Whether `op` is what `never_taken` left."""
+    return op.op_type == OP_IF and is_constant(op.left_side) and constant_value(op.left_side) == 0 and \
+        all(assigned.op_type == OP_ASSIGN and is_constant(assigned.right_side)  # type: ignore
+            and constant_value(assigned.right_side) == 0 for assigned in op.right_side)  # type: ignore
+
+
+def fold_block(program: List[AST], env: Dict[str, int], stats: Dict[str, int]) -> List[AST]:
+    """Fold a block, updating `env` to the values known after it."""
+    assert COUNT_OPS == 17, "Op count changed in fold_block()"
+    folded = []
+    for op in program:
+        if op.op_type == OP_ASSIGN:
+            value = fold_expr(op.right_side, env, stats)  # type: ignore
+            if is_constant(value):
+                env[op.left_side[1]] = constant_value(value)  # type: ignore
             else:
-                string = compile_program(file_name, [op.right_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var2 = "rcx"
+                env.pop(op.left_side[1], None)  # type: ignore
+            folded.append(assign(op.left_side, value))  # type: ignore
+        elif op.op_type == OP_PUT:
+            folded.append(put(fold_expr(op.left_side, env, stats)))  # type: ignore
+        elif op.op_type == OP_IF:
+            cond = fold_expr(op.left_side, env, stats)  # type: ignore
+            body_env = dict(env)
+            body = fold_block(op.right_side, body_env, stats)  # type: ignore
+            for name in list(env):
+                if body_env.get(name) != env[name]:
+                    del env[name]
+            folded.append(if_(cond, body))  # type: ignore
+        elif op.op_type == OP_WHILE:
+            entry = fold_expr(op.left_side, env, {"folded": 0, "propagated": 0})  # type: ignore
+            if is_constant(entry) and constant_value(entry) == 0:
+                # false on entry, the body never runs
+                stats["dead loops"] += 1
+                folded += never_taken(op.right_side, statement_pos(op))  # type: ignore
+                continue
+            # Anything the body assigns is unknown at the loop header.
+            for name in assigned_vars(op.right_side):  # type: ignore
+                env.pop(name, None)
+            cond = fold_expr(op.left_side, env, stats)  # type: ignore
+            body = fold_block(op.right_side, dict(env), stats)  # type: ignore
+            folded.append(while_(cond, body))  # type: ignore
+        elif op.op_type == OP_USE:
+            # the module may assign any variable
+            env.clear()
+            folded.append(op)
+        else:
+            folded.append(op)
+    return folded
+
+
+def fold_constants(program: Program, stats: Dict[str, int]) -> Program:
+    """Constant folding and propagation through straight-line code."""
+    stats.setdefault("folded", 0)
+    stats.setdefault("propagated", 0)
+    stats.setdefault("dead loops", 0)
+    return fold_block(program, {}, stats)
+
 
-            string = "        ;;-- gt --\n"
-            string += "        mov     rax, %s\n" % var1
-            string += "        cmp     rax, %s\n" % var2
-            string += "        setg    al      \n"
-            string += "        movzx   rax, al\n"
-            return string
+def expr_vars(node: AST | Lexeme, names: Set[str]) -> Set[str]:
+    """Add the variables `node` reads to `names`."""
+    # binary nodes of the parser hold a lexeme on the left, so mostly the right side nests
+    while type(node) != tuple and node.op_type not in (INT, VAR):  # type: ignore
+        if type(node.left_side) != tuple:  # type: ignore
+            expr_vars(node.left_side, names)  # type: ignore
+        elif node.left_side[0] == VAR:  # type: ignore
+            names.add(node.left_side[1])  # type: ignore
+        node = node.right_side  # type: ignore
+    if type(node) != tuple:
+        node = node.left_side  # type: ignore
+    if node[0] == VAR:  # type: ignore
+        names.add(node[1])  # type: ignore
+    return names
 
 
+def read_vars(program: List[AST], names: Set[str]) -> Set[str]:
+    """Add the variables `program` reads anywhere, nested blocks included, to `names`."""
+    for op in program:
+        if op.op_type == OP_ASSIGN:
+            expr_vars(op.right_side, names)  # type: ignore
         elif op.op_type == OP_PUT:
-            if op.left_side.op_type == VAR:
-                var = var_dict[op.left_side.left_side[1]]
-            elif op.left_side.op_type == INT:
-                var = op.left_side.left_side[1]
+            expr_vars(op.left_side, names)  # type: ignore
+        elif op.op_type in (OP_IF, OP_WHILE):
+            expr_vars(op.left_side, names)  # type: ignore
+            read_vars(op.right_side, names)  # type: ignore
+    return names
+
+
+class DeadCodeEliminator:
+    """Removal of branches that cannot run and of stores nothing reads.
+
+    Liveness is computed backwards over the blocks. At a loop header it is
+    taken to be what is live after the loop plus everything the loop reads,
+    a superset of the exact answer that needs no fixed point. A `use` may
+    read any of the `shared` variables. A division that may fault stays,
+    read or not, see may_fault.
+    """
+
+    def __init__(self, stats: Dict[str, int], shared: Set[str]):
+        self.stats = stats
+        self.shared = shared
+        stats.setdefault("constant branches", 0)
+        stats.setdefault("dead loops", 0)
+        stats.setdefault("dead stores", 0)
+
+    def block(self, program: List[AST], live: Set[str]) -> List[AST]:
+        """`program` without its dead code, `live` going from the variables live after it to those live before."""
+        assert COUNT_OPS == 17, "Op count changed in DeadCodeEliminator.block()"
+        kept: List[AST] = []
+        for op in reversed(program):
+            if op.op_type == OP_ASSIGN:
+                if op.left_side[1] not in live and not may_fault(op.right_side):  # type: ignore
+                    self.stats["dead stores"] += 1
+                    continue
+                live.discard(op.left_side[1])  # type: ignore
+                expr_vars(op.right_side, live)  # type: ignore
+                kept.append(op)
+            elif op.op_type == OP_PUT:
+                expr_vars(op.left_side, live)  # type: ignore
+                kept.append(op)
+            elif op.op_type == OP_IF:
+                cond = op.left_side
+                if is_never_taken(op):
+                    kept.append(op)
+                    continue
+                if is_constant(cond):  # type: ignore
+                    self.stats["constant branches"] += 1
+                    if constant_value(cond) != 0:  # type: ignore
+                        kept += reversed(self.block(op.right_side, live))  # type: ignore
+                    else:
+                        kept += never_taken(op.right_side, statement_pos(op))  # type: ignore
+                    continue
+                after = set(live)
+                body = self.block(op.right_side, live)  # type: ignore
+                live |= after
+                if not body and not may_fault(cond):  # type: ignore
+                    continue
+                expr_vars(cond, live)  # type: ignore
+                kept.append(if_(cond, body))  # type: ignore
+            elif op.op_type == OP_WHILE:
+                cond = op.left_side
+                if is_constant(cond) and constant_value(cond) == 0:  # type: ignore
+                    self.stats["dead loops"] += 1
+                    kept += never_taken(op.right_side, statement_pos(op))  # type: ignore
+                    continue
+                expr_vars(cond, live)  # type: ignore
+                read_vars(op.right_side, live)  # type: ignore
+                header = set(live)
+                body = self.block(op.right_side, live)  # type: ignore
+                live |= header
+                kept.append(while_(cond, body))  # type: ignore
+            elif op.op_type == OP_USE:
+                live |= self.shared
+                kept.append(op)
             else:
-                string = compile_program(file_name, [op.left_side], rec=True)
-                f.write(string)
-                f.write("        mov     rcx, rax")
-                var = "rcx"
-            f.write("        ;; -- put %s --\n" % op.left_side)
-            f.write("        mov     rdi, %s\n" % var)
-            f.write("        call    put\n")
+                kept.append(op)
+        kept.reverse()
+        return kept
 
-        elif op.op_type == OP_IF:
-            f.write("        ;; -- if --\n")
-            cond = compile_program(file_name, [op.left_side], rec=True)
-            tmp_ip = ip
-            f.write(cond)
-            f.write("        and     rax, rax\n")
-            f.write("        jz      addr_%d\n" % tmp_ip)
-            f.write("addr_%d:\n" % tmp_ip)
-            compile_program(file_name, op.right_side, True)
 
+def eliminate_dead_code(program: Program, stats: Dict[str, int], exported: bool = False) -> Program:
+    """Dead branch, dead loop and dead store elimination.
+
+    The variables of a module are `exported`, the program that uses it reads
+    them once it returns.
+    """
+    shared = read_vars(program, assigned_vars(program))
+    return DeadCodeEliminator(stats, shared).block(program, set(shared) if exported else set())
+
+
+def map_exprs(program: List[AST], fn: Callable[[AST | Lexeme], AST | Lexeme]) -> List[AST]:
+    """Copy of `program` with every expression, nested blocks included, replaced by fn(expression)."""
+    assert COUNT_OPS == 17, "Op count changed in map_exprs()"
+    mapped = []
+    for op in program:
+        if op.op_type == OP_ASSIGN:
+            mapped.append(assign(op.left_side, fn(op.right_side)))  # type: ignore
+        elif op.op_type == OP_PUT:
+            mapped.append(put(fn(op.left_side)))  # type: ignore
+        elif op.op_type == OP_IF:
+            mapped.append(if_(fn(op.left_side), map_exprs(op.right_side, fn)))  # type: ignore
         elif op.op_type == OP_WHILE:
-            f.write('        ;; -- while --\n')
-            tmp_ip = ip
-            f.write("        jmp addr_%d\n" % tmp_ip)
-            f.write("addr_%d:\n" % (tmp_ip + 1))
-            compile_program(file_name, op.right_side, rec=True)
-            f.write("addr_%d:\n" % tmp_ip)
-            cond = compile_program(file_name, [op.left_side], rec=True)
-            f.write(cond)
-            f.write("        cmp   rax, 0\n")
-            f.write("        jne   addr_%d\n" % (tmp_ip + 1))
+            mapped.append(while_(fn(op.left_side), map_exprs(op.right_side, fn)))  # type: ignore
+        else:
+            mapped.append(op)
+    return mapped
+
+
+def expr_key(node: AST | Lexeme) -> Tuple:
+    """Hashable shape of an expression, equal for expressions computing the same."""
+    if type(node) == tuple:
+        return node[0], node[1]  # type: ignore
+    if node.op_type in (INT, VAR):  # type: ignore
+        return expr_key(node.left_side)  # type: ignore
+    return node.op_type, expr_key(node.left_side), expr_key(node.right_side)  # type: ignore
+
+
+def is_leaf(node: AST | Lexeme) -> bool:
+    return type(node) != tuple and node.op_type in (INT, VAR)  # type: ignore
+
+
+def count_assignments(program: List[AST], counts: Dict[str, int]) -> Dict[str, int]:
+    for op in program:
+        if op.op_type == OP_ASSIGN:
+            counts[op.left_side[1]] = counts.get(op.left_side[1], 0) + 1  # type: ignore
+        elif op.op_type in (OP_IF, OP_WHILE):
+            count_assignments(op.right_side, counts)  # type: ignore
+    return counts
+
+
+class LoopOptimizer:
+    """Loop invariant code motion and strength reduction of `while` loops.
+
+    What moves out of a loop goes into fresh variables assigned right before
+    it. Their names hold an underscore, which no program can spell. A
+    division that may fault stays where it is, the loop may never run it.
+    """
+
+    def __init__(self, stats: Dict[str, int]):
+        self.stats = stats
+        self.temps = 0
+        stats.setdefault("hoisted", 0)
+        stats.setdefault("strength reduced", 0)
+
+    def temp(self, kind: str, pos: POS, preheader: List[AST], value: AST) -> Lexeme:
+        self.temps += 1
+        name = (VAR, f"{kind}_{self.temps}", pos)
+        preheader.append(assign(name, value))
+        return name
+
+    def block(self, program: List[AST]) -> List[AST]:
+        optimized = []
+        for op in program:
+            if op.op_type == OP_WHILE:
+                optimized += self.loop(op)
+            elif op.op_type == OP_IF:
+                optimized.append(if_(op.left_side, self.block(op.right_side)))  # type: ignore
+            else:
+                optimized.append(op)
+        return optimized
+
+    def loop(self, loop: AST) -> List[AST]:
+        """The loop with its inner loops optimized, after its preheader."""
+        assigned = assigned_vars(loop.right_side)  # type: ignore
+
+        def invariant(node: AST | Lexeme) -> bool:
+            if type(node) == tuple:
+                return node[0] != VAR or node[1] not in assigned
+            if node.op_type in (INT, VAR):  # type: ignore
+                return invariant(node.left_side)  # type: ignore
+            return invariant(node.left_side) and invariant(node.right_side)  # type: ignore
+
+        preheader: List[AST] = []
+        hoisted: Dict[Tuple, Lexeme] = {}
+
+        def hoist(node: AST | Lexeme) -> AST | Lexeme:
+            """Replace the largest invariant subexpressions of `node` by variables."""
+            if type(node) == tuple or is_leaf(node):
+                return node
+            assert isinstance(node, AST)
+            if invariant(node) and not may_fault(node):
+                key = expr_key(node)
+                if key not in hoisted:
+                    hoisted[key] = self.temp("licm", node.left_side[2], preheader, node)  # type: ignore
+                    self.stats["hoisted"] += 1
+                return var_(hoisted[key])
+            return AST(node.op_type, node.left_side, hoist(node.right_side))  # type: ignore
+
+        cond = hoist(loop.left_side)  # type: ignore
+        body = map_exprs(loop.right_side, hoist)  # type: ignore
+
+        # basic induction variables, assigned once per iteration `i := i + c`,
+        # `i := c + i` or `i := i - c` with c invariant
+        counts = count_assignments(body, {})
+        inductions: Dict[str, Tuple[int, Lexeme, int]] = {}
+        for index, op in enumerate(body):
+            if op.op_type != OP_ASSIGN or counts[op.left_side[1]] != 1:  # type: ignore
+                continue
+            name, value = op.left_side[1], op.right_side  # type: ignore
+            if value.op_type not in (OP_PLUS, OP_MINUS) or not is_leaf(value.right_side):  # type: ignore
+                continue
+            left, right = value.left_side, value.right_side.left_side  # type: ignore
+            if left[:2] == (VAR, name) and invariant(right):
+                inductions[name] = (index, right, 1 if value.op_type == OP_PLUS else -1)  # type: ignore
+            elif value.op_type == OP_PLUS and right[:2] == (VAR, name) and invariant(left):  # type: ignore
+                inductions[name] = (index, left, 1)
+
+        # i * k with k invariant is kept in an accumulator `s`, set to i * k
+        # before the loop and stepped right after every update of i
+        accumulators: Dict[Tuple, Lexeme] = {}
+        updates: Dict[int, List[AST]] = {}
+
+        def reduce(node: AST | Lexeme) -> AST | Lexeme:
+            if type(node) == tuple or is_leaf(node):
+                return node
+            assert isinstance(node, AST)
+            if node.op_type == OP_MULT and is_leaf(node.right_side):
+                left, right = node.left_side, node.right_side.left_side  # type: ignore
+                if left[0] == VAR and left[1] in inductions and invariant(right):  # type: ignore
+                    induction, factor = left, right
+                elif right[0] == VAR and right[1] in inductions and invariant(left):  # type: ignore
+                    induction, factor = right, left
+                else:
+                    return AST(node.op_type, node.left_side, reduce(node.right_side))  # type: ignore
+                key = (induction[1], factor[0], factor[1])  # type: ignore
+                if key not in accumulators:
+                    accumulators[key] = self.accumulator(induction, factor, inductions, preheader, updates)  # type: ignore
+                self.stats["strength reduced"] += 1
+                return var_(accumulators[key])
+            return AST(node.op_type, node.left_side, reduce(node.right_side))  # type: ignore
+
+        if inductions:
+            cond = reduce(cond)
+            body = map_exprs(body, reduce)
+            for index in sorted(updates, reverse=True):
+                body[index + 1:index + 1] = updates[index]
+        return preheader + [while_(cond, self.block(body))]  # type: ignore
+
+    def accumulator(self, induction: Lexeme, factor: Lexeme, inductions: Dict[str, Tuple[int, Lexeme, int]],
+                    preheader: List[AST], updates: Dict[int, List[AST]]) -> Lexeme:
+        index, step, sign = inductions[induction[1]]  # type: ignore
+        pos = induction[2]
+        acc = self.temp("iv", pos, preheader, AST(OP_MULT, induction, var_(factor) if factor[0] == VAR else int_(factor)))
+        if step[0] == INT and factor[0] == INT:
+            value = wrap64(sign * step[1] * factor[1])  # type: ignore
+            update = plus(acc, int_((INT, value, pos)))
+        else:
+            if step[:2] == (INT, 1):
+                increment = factor
+            else:
+                increment = self.temp("licm", pos, preheader, AST(OP_MULT, step, var_(factor) if factor[0] == VAR else int_(factor)))
+            update = AST(OP_PLUS if sign == 1 else OP_MINUS, acc, var_(increment) if increment[0] == VAR else int_(increment))
+        updates.setdefault(index, []).append(assign(acc, update))
+        return acc
+
+
+def optimize_loops(program: Program, stats: Dict[str, int]) -> Program:
+    """Loop invariant code motion and strength reduction of induction variables."""
+    return LoopOptimizer(stats).block(program)
+
+
+def optimize_program(program: Program, stats: Dict[str, int], exported: bool = False) -> Program:
+    """Run every optimization pass of `-O` over `program`, a module if `exported`."""
+    program = fold_constants(program, stats)
+    program = eliminate_dead_code(program, stats, exported)
+    program = optimize_loops(program, stats)
+    # fold what the loop passes set up before the loops, then drop what
+    # that left unread
+    program = fold_constants(program, stats)
+    return eliminate_dead_code(program, stats, exported)
+
+
+# REGISTER ALLOCATION #####
+# Variables live in registers that neither the `put` runtime nor the scratch
+# code of `compile_program` (rax, rbx, rcx, rdx) touch, callee saved first.
+ALLOCATABLE_REGISTERS = ["r12", "r13", "r14", "r15", "r8", "r9", "r10"]
+
+
+class FlowNode:
+    """One program point of `main`, in the order `compile_program` emits them."""
+
+    def __init__(self, defs: Set[str], uses: Set[str]):
+        self.defs = defs
+        self.uses = uses
+        self.succs: List[int] = []
+        self.live_in: Set[str] = set()
+        self.live_out: Set[str] = set()
+
 
+def expr_uses(node: AST | Lexeme | None, defined: Set[str]) -> Set[str]:
+    """Variables read by `node`, all of which must be assigned before."""
+    if node is None:
+        return set()
+    if type(node) == tuple:
+        if node[0] != VAR:
+            return set()
+        name, pos = node[1], node[2]  # type: ignore
+        if name not in defined:
+            file, l, c = unpack_pos(pos)
+            print(f"{file}:{l}:{c}: ERROR: variable `{name}` is used before being assigned")
+            exit(1)
+        return {name}  # type: ignore
+    assert isinstance(node, AST)
+    return expr_uses(node.left_side, defined) | expr_uses(node.right_side, defined)  # type: ignore
+
+
+def flow_block(nodes: List[FlowNode], program: List[AST], defined: Set[str],
+               shared: Set[str] = set(), exported: bool = False) -> None:
+    """Append the program points of `program`.
+
+    A program with modules keeps its `shared` variables in memory across
+    every `use`, and a module that is `exported` hands all of them back at
+    its end.
+    """
+    assert COUNT_OPS == 17, "Op count changed in flow_block()"
+    for op in program:
+        if op.op_type == EOF:
+            nodes.append(FlowNode(set(), set(shared) if exported else set()))
+        elif op.op_type == OP_USE:
+            # every shared variable goes to memory before the call and comes
+            # back after it, so all of them are live there at once
+            nodes.append(FlowNode(set(shared), set(shared)))
+            nodes[-1].succs.append(len(nodes))
+        elif op.op_type == OP_ASSIGN:
+            uses = expr_uses(op.right_side, defined)  # type: ignore
+            defined.add(op.left_side[1])  # type: ignore
+            nodes.append(FlowNode({op.left_side[1]}, uses))  # type: ignore
+            nodes[-1].succs.append(len(nodes))
+        elif op.op_type == OP_PUT:
+            nodes.append(FlowNode(set(), expr_uses(op.left_side, defined)))
+            nodes[-1].succs.append(len(nodes))
+        elif op.op_type == OP_IF:
+            cond = FlowNode(set(), expr_uses(op.left_side, defined))
+            nodes.append(cond)
+            cond.succs.append(len(nodes))
+            flow_block(nodes, op.right_side, defined, shared, exported)  # type: ignore
+            cond.succs.append(len(nodes))
+        elif op.op_type == OP_WHILE:
+            enter = FlowNode(set(), set())
+            nodes.append(enter)
+            uses = expr_uses(op.left_side, defined)
+            body = len(nodes)
+            flow_block(nodes, op.right_side, defined, shared, exported)  # type: ignore
+            enter.succs.append(len(nodes))
+            nodes.append(FlowNode(set(), uses))
+            nodes[-1].succs += [body, len(nodes)]
         else:
             print(op, "is unreachable")
             assert False, "unreachable"
 
 
-def usage() -> None:
-    print("ERROR: usage ./stem.py [SUBCOMMAND] <program>")
-    print("SUBCOMMANDS:")
-    print("    com: compile the program")
-    print("    sim: simulate the program")
+def solve_liveness(nodes: List[FlowNode]) -> List[FlowNode]:
+    changed = True
+    while changed:
+        changed = False
+        for node in reversed(nodes):
+            live_out: Set[str] = set()
+            for succ in node.succs:
+                live_out |= nodes[succ].live_in
+            live_in = node.uses | (live_out - node.defs)
+            if live_in != node.live_in or live_out != node.live_out:
+                node.live_in, node.live_out = live_in, live_out
+                changed = True
+    return nodes
 
 
-def shift(lst: List[str]) -> Tuple[str, List[str]]:
-    return lst[0], lst[1:]
+def stream_intervals(statements: Iterable[AST]) -> Tuple[Dict[str, List[int]], Set[str]]:
+    """Live intervals counted in top level statements, and the variables read before any assignment.
 
+    Only what one statement needs is held at a time, which makes the
+    intervals coarser than those of `allocate_ir_registers`, never wrong.
+    """
+    intervals: Dict[str, List[int]] = {}
+    undefined: Set[str] = set()
+    defined: Set[str] = set()
+    assigned: Set[str] = set()  # on every path
+    for point, op in enumerate(statements):
+        nodes: List[FlowNode] = []
+        flow_block(nodes, [op], defined)
+        nodes.append(FlowNode(set(), set()))
+        solve_liveness(nodes)
+        for node in nodes:
+            for name in node.uses | node.defs:
+                if name in intervals:
+                    intervals[name][1] = point
+                else:
+                    intervals[name] = [point, point]
+        for name in nodes[0].live_in - assigned:
+            # set to 0 before the first statement
+            undefined.add(name)
+            intervals[name][0] = 0
+        if op.op_type == OP_ASSIGN:
+            assigned.add(op.left_side[1])  # type: ignore
+    return intervals, undefined
 
-def main() -> None:
-    argv = sys.argv
-    assert len(argv) > 1
-    prg_name, argv = shift(argv)
-    if len(argv) < 1:
-        usage()
-        exit(1)
 
-    subcommand, argv = shift(argv)
-    prg_path, argv = shift(argv)
+def linear_scan(intervals: Dict[str, List[int]]) -> Tuple[Dict[str, str], int]:
+    """Operands of the variables live over `intervals` and the stack frame size of the spilled ones."""
+    operands: Dict[str, str] = {}
+    spilled: List[str] = []
+    free = list(reversed(ALLOCATABLE_REGISTERS))
+    active: List[str] = []
+    for name in sorted(intervals, key=lambda name: (intervals[name][0], name)):
+        start, end = intervals[name]
+        for other in [other for other in active if intervals[other][1] < start]:
+            active.remove(other)
+            free.append(operands[other])
+        if free:
+            operands[name] = free.pop()
+            active.append(name)
+            continue
+        victim = max(active, key=lambda other: intervals[other][1])
+        if intervals[victim][1] > end:
+            operands[name] = operands[victim]
+            active.remove(victim)
+            active.append(name)
+            spilled.append(victim)
+        else:
+            spilled.append(name)
+    for slot, name in enumerate(spilled):
+        operands[name] = f"QWORD [rbp - {8 * (slot + 1)}]"
+    frame_size = (8 * len(spilled) + 15) // 16 * 16
+    return operands, frame_size
 
-    print("[INFO] Started lexing and parsing")
-    program = load_program_from_file(prg_path)
 
-    print("[INFO] Started generating")
-    if subcommand == "sim":
-        pass
-    elif subcommand == "com":
-        compile_program("output.asm", program)
-        run_and_write(["yasm", "-f", "elf64", "output.asm"])
-        run_and_write(["ld", "-o", "output", "output.o"])
+# IR #####
+# A three address code between the AST and the assembly. A BasicBlock ends
+# with `jmp`, a branch or `exit`, and its instructions read variables,
+# temporaries `%N` and integer constants. A temporary is assigned once and
+# read once, in the same block, and the temporaries of a block are read in
+# the reverse order of their assignments, like a stack. `IR_PASSES` rewrite
+# the IR under -O, then `Codegen` lowers it to x86-64.
+
+class IRInstr(NamedTuple):
+    """`dest = op args`, with `dest` "" for the instructions that assign nothing.
+
+    `div` and `mod` without a `dest` only stay for the fault they may raise,
+    their third argument is the source position the error points to.
+    """
+    op: str
+    dest: str = ""
+    args: Tuple[str, ...] = ()
+
+
+IR_BINARY = {OP_PLUS: "add", OP_MINUS: "sub", OP_MULT: "mul", OP_SLASH: "div", OP_MOD: "mod",
+             OP_EQUAL: "eq", OP_GT: "gt"}
+IR_BINARY_OPS = set(IR_BINARY.values())
+# a comparison and the branch on its result in one
+IR_FUSED_BRANCHES = {"eq": "beq", "gt": "bgt"}
+IR_TERMINATORS = {"jmp", "br", "beq", "bgt", "exit"}
+# how many of the first arguments of each instruction are read, the rest are labels or names
+IR_READS = {"copy": 1, "put": 1, "br": 1, "beq": 2, "bgt": 2, **{op: 2 for op in IR_BINARY_OPS}}
+
+
+def is_temp(operand: str) -> bool:
+    return operand[0] == "%"
+
+
+def is_const(operand: str) -> bool:
+    return operand[0] in "-0123456789"
+
+
+class BasicBlock:
+    __slots__ = ("label", "instrs")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.instrs: List[IRInstr] = []
+
+    def targets(self) -> List[str]:
+        """Labels the last instruction jumps to, none for `exit` or a block that falls through."""
+        if not self.instrs or self.instrs[-1].op not in IR_TERMINATORS:
+            return []
+        last = self.instrs[-1]
+        if last.op == "jmp":
+            return [last.args[0]]
+        if last.op == "br":
+            return list(last.args[1:])
+        return list(last.args[2:])
+
+
+class IRFunction:
+    """The blocks of `main` or of a module, entered at the first one.
+
+    A program with modules keeps its `shared` variables in memory across
+    every `use`, and a module that is `exported` hands all of them back at
+    its end. Another module may have assigned any of them, so nothing is
+    reported as used before being assigned then. The last block of a
+    top level statement built on its own, see `program_chunks`, falls
+    through into the code of the next statement instead of ending with a
+    terminator.
+    """
+
+    def __init__(self, blocks: List[BasicBlock], shared: Set[str] = set(), exported: bool = False):
+        self.blocks = blocks
+        self.shared = shared
+        self.exported = exported
+
+    def predecessors(self) -> Dict[str, List[str]]:
+        preds: Dict[str, List[str]] = {block.label: [] for block in self.blocks}
+        for block in self.blocks:
+            for target in block.targets():
+                preds[target].append(block.label)
+        return preds
+
+
+def ir_reads(instr: IRInstr, function: IRFunction) -> List[str]:
+    """Variables and temporaries `instr` reads."""
+    if instr.op == "use":
+        return sorted(function.shared)
+    if instr.op == "exit":
+        return sorted(function.shared) if function.exported else []
+    return [arg for arg in instr.args[:IR_READS.get(instr.op, 0)] if not is_const(arg)]
+
+
+def ir_writes(instr: IRInstr, function: IRFunction) -> List[str]:
+    if instr.op == "use":
+        return sorted(function.shared)
+    return [instr.dest] if instr.dest else []
+
+
+def format_ir(function: IRFunction) -> str:
+    lines = []
+    for block in function.blocks:
+        lines.append(block.label + ":")
+        for instr in block.instrs:
+            lines.append("        " + format_ir_instr(instr))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def format_ir_instr(instr: IRInstr) -> str:
+    text = f"{instr.op} {', '.join(instr.args)}".rstrip()
+    return f"{instr.dest} = {text}" if instr.dest else text
+
+
+class IRBuilder:
+    """Build the IR of top level statements, in the layout `Codegen` lowers it in.
+
+    Every variable must be assigned before it is read, `defined` are the
+    ones assigned so far. Expressions are evaluated deeper operand first
+    (Sethi-Ullman), and straight into the variable they are assigned to
+    when they do not read it. Unless `profile` is None it gets the counter
+    of every statement, `if` branch and `while` back-edge, see PROFILE.
+    """
+
+    def __init__(self, defined: Set[str], profile: List[Tuple[POS, str, int]] | None = None):
+        self.defined = defined
+        self.blocks: List[BasicBlock] = []
+        self.label_num = 0
+        self.temp_num = 0
+        # Sethi-Ullman numbers of the nodes of the current expression by id
+        self.needs: Dict[int, int] = {}
+        self.profile = profile
+        self.counters = 0
+
+    def function(self, program: List[AST], shared: Set[str] = set(), exported: bool = False) -> IRFunction:
+        self.blocks = []
+        self.start(self.new_label())
+        self.count(program, [])
+        self.block(program)
+        return IRFunction(self.blocks, shared, exported)
+
+    def new_label(self) -> str:
+        self.label_num += 1
+        return f"L{self.label_num}"
+
+    def start(self, label: str) -> None:
+        self.blocks.append(BasicBlock(label))
+
+    def emit(self, op: str, dest: str = "", *args: str) -> None:
+        self.blocks[-1].instrs.append(IRInstr(op, dest, args))
+
+    def temp(self) -> str:
+        self.temp_num += 1
+        return f"%{self.temp_num}"
+
+    def count(self, program: List[AST], points: List[Tuple[POS, str]]) -> None:
+        """Bump one counter for the statements of `program` and `points`, which all run as many times."""
+        points = points + [(statement_pos(op), "statement") for op in program if op.op_type != EOF]
+        if self.profile is None or not points:
+            return
+        self.profile += [(pos, kind, self.counters) for pos, kind in points]
+        self.emit("count", "", str(self.counters))
+        self.counters += 1
+
+    def value(self, side: AST | Lexeme) -> str:
+        lexeme = side if type(side) == tuple else side.left_side  # type: ignore
+        if lexeme[0] != VAR:  # type: ignore
+            return str(lexeme[1])  # type: ignore
+        if lexeme[1] not in self.defined:  # type: ignore
+            file, l, c = unpack_pos(lexeme[2])  # type: ignore
+            print(f"{file}:{l}:{c}: ERROR: variable `{lexeme[1]}` is used before being assigned")  # type: ignore
+            exit(1)
+        return lexeme[1]  # type: ignore
+
+    def is_leaf(self, side: AST | Lexeme) -> bool:
+        return type(side) == tuple or side.op_type in (INT, VAR)  # type: ignore
+
+    def is_operand(self, side: AST | Lexeme) -> bool:
+        """Whether an instruction can take `side` as is: a variable or a 32 bits INT."""
+        if not self.is_leaf(side):
+            return False
+        lexeme = side if type(side) == tuple else side.left_side  # type: ignore
+        return lexeme[0] == VAR or -2 ** 31 <= lexeme[1] < 2 ** 31  # type: ignore
+
+    def need(self, side: AST | Lexeme) -> int:
+        """Sethi-Ullman number of `side`: how many registers computing it takes."""
+        if self.is_leaf(side):
+            return 1
+        need = self.needs.get(id(side))
+        if need is None:
+            left, right = side.left_side, side.right_side  # type: ignore
+            if self.is_operand(right):  # type: ignore
+                need = self.need(left)  # type: ignore
+            elif self.is_operand(left):  # type: ignore
+                need = self.need(right)  # type: ignore
+            else:
+                left_need, right_need = self.need(left), self.need(right)  # type: ignore
+                need = max(left_need, right_need) if left_need != right_need else left_need + 1
+            self.needs[id(side)] = need
+        return need
+
+    def expr(self, side: AST | Lexeme, dest: str = "", result: str = "") -> str:
+        """The operand holding the value of `side` unless a leaf, computed in `dest` if given.
+
+        The last instruction writes `result` instead if given, which its
+        operands may read but not the ones before it.
+        """
+        if self.is_leaf(side):
+            return self.value(side)
+        self.needs.clear()
+        return self.compute(side, dest, result)
+
+    def compute(self, side: AST | Lexeme, dest: str, result: str = "") -> str:
+        assert COUNT_OPS == 17, "Op count changed in IRBuilder.compute()"
+        if self.is_operand(side):
+            return self.value(side)
+        if self.is_leaf(side):
+            # no instruction takes a 64 bits constant but mov
+            dest = dest or self.temp()
+            self.emit("copy", dest, self.value(side))
+            return dest
+        left, right = side.left_side, side.right_side  # type: ignore
+        if self.is_operand(right):  # type: ignore
+            a = self.compute(left, dest)  # type: ignore
+            b = self.value(right)  # type: ignore
+        elif self.is_operand(left):  # type: ignore
+            b = self.compute(right, dest)  # type: ignore
+            a = self.value(left)  # type: ignore
+        elif self.need(right) > self.need(left):  # type: ignore
+            b = self.compute(right, dest)  # type: ignore
+            a = self.compute(left, "")  # type: ignore
+        else:
+            a = self.compute(left, dest)  # type: ignore
+            b = self.compute(right, "")  # type: ignore
+        dest = result or dest or self.temp()
+        if side.op_type in (OP_SLASH, OP_MOD):  # type: ignore
+            # where the error of a division by zero points to
+            self.emit(IR_BINARY[side.op_type], dest, a, b, str(statement_pos(side)))  # type: ignore
+        else:
+            self.emit(IR_BINARY[side.op_type], dest, a, b)  # type: ignore
+        return dest
+
+    def block(self, program: List[AST]) -> None:
+        assert COUNT_OPS == 17, "Op count changed in IRBuilder.block()"
+        for op in program:
+            if op.op_type == EOF:
+                self.emit("exit")
+            elif op.op_type == OP_ASSIGN:
+                name = op.left_side[1]  # type: ignore
+                dest = "" if name in expr_vars(op.right_side, set()) else name  # type: ignore
+                value = self.expr(op.right_side, dest, name)  # type: ignore
+                if value != name:
+                    self.emit("copy", name, value)
+                self.defined.add(name)
+            elif op.op_type == OP_PUT:
+                self.emit("put", "", self.expr(op.left_side))  # type: ignore
+            elif op.op_type == OP_IF:
+                then, join = self.new_label(), self.new_label()
+                self.emit("br", "", self.expr(op.left_side), then, join)  # type: ignore
+                self.start(then)
+                self.count(op.right_side, [(statement_pos(op), "then")])  # type: ignore
+                self.block(op.right_side)  # type: ignore
+                self.emit("jmp", "", join)
+                self.start(join)
+            elif op.op_type == OP_WHILE:
+                body, test, done = self.new_label(), self.new_label(), self.new_label()
+                expr_uses(op.left_side, self.defined)  # the condition runs first
+                self.emit("jmp", "", test)
+                self.start(body)
+                self.count(op.right_side, [(statement_pos(op), "loop")])  # type: ignore
+                self.block(op.right_side)  # type: ignore
+                self.emit("jmp", "", test)
+                self.start(test)
+                self.emit("br", "", self.expr(op.left_side), body, done)  # type: ignore
+                self.start(done)
+            elif op.op_type == OP_USE:
+                self.emit("use", "", op.left_side[1])  # type: ignore
+            else:
+                print(op, "is unreachable")
+                assert False, "unreachable"
+
+
+def ir_liveness(function: IRFunction) -> Dict[str, Set[str]]:
+    """What is live at the end of every block, by label."""
+    uses: Dict[str, Set[str]] = {}
+    defs: Dict[str, Set[str]] = {}
+    for block in function.blocks:
+        read: Set[str] = set()
+        written: Set[str] = set()
+        for instr in block.instrs:
+            read.update(name for name in ir_reads(instr, function) if name not in written)
+            written.update(ir_writes(instr, function))
+        uses[block.label], defs[block.label] = read, written
+    live_in: Dict[str, Set[str]] = {block.label: set() for block in function.blocks}
+    live_out: Dict[str, Set[str]] = {block.label: set() for block in function.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(function.blocks):
+            out: Set[str] = set()
+            for target in block.targets():
+                out |= live_in[target]
+            new_in = uses[block.label] | (out - defs[block.label])
+            if new_in != live_in[block.label] or out != live_out[block.label]:
+                live_in[block.label], live_out[block.label] = new_in, out
+                changed = True
+    return live_out
+
+
+def allocate_ir_registers(function: IRFunction) -> Tuple[Dict[str, str], int, Set[str]]:
+    """Linear scan over the live intervals of the variables in `function`.
+
+    Return the operand of every variable, the stack frame size for the
+    spilled ones, and the variables read before any assignment on some path.
+    """
+    live_out = ir_liveness(function)
+    intervals: Dict[str, List[int]] = {}
+    point = sum(len(block.instrs) for block in function.blocks)
+    live: Set[str] = set()
+    for block in reversed(function.blocks):
+        live = {name for name in live_out[block.label] if not is_temp(name)}
+        for instr in reversed(block.instrs):
+            point -= 1
+            written = [name for name in ir_writes(instr, function) if not is_temp(name)]
+            read = [name for name in ir_reads(instr, function) if not is_temp(name)]
+            # the points only go down from here
+            for name in live.union(written, read):
+                if name in intervals:
+                    intervals[name][0] = point
+                else:
+                    intervals[name] = [point, point]
+            live.difference_update(written)
+            live.update(read)
+    return linear_scan(intervals) + (live,)
+
+
+# IR PASSES #####
+# Each pass rewrites an IRFunction in place and returns how many changes it
+# made. `run_passes` repeats them until none changes anything.
+
+def fold_ir(op: str, a: int, b: int) -> int:
+    """Value of `op a, b`, a division must not fault, see division_error."""
+    assert len(IR_BINARY) == 7, "Binary instructions changed in fold_ir()"
+    if op == "add":
+        return wrap64(a + b)
+    if op == "sub":
+        return wrap64(a - b)
+    if op == "mul":
+        return wrap64(a * b)
+    if op == "div":
+        return divide(a, b)[0]
+    if op == "mod":
+        return divide(a, b)[1]
+    if op == "eq":
+        return int(a == b)
+    return int(a > b)
+
+
+def simplify_ir_instr(instr: IRInstr) -> IRInstr:
+    """`instr` as a `copy` if its operands are constant or it adds 0, multiplies by 0 or 1 or divides by 1.
+
+    A division that faults stays, see division_error.
+    """
+    if instr.op not in IR_BINARY_OPS or not instr.dest:
+        return instr
+    a, b = instr.args[:2]
+    if is_const(a) and is_const(b):
+        if instr.op in ("div", "mod") and division_error(int(a), int(b)):
+            return instr
+        return IRInstr("copy", instr.dest, (str(fold_ir(instr.op, int(a), int(b))),))
+    if instr.op == "mul" and "0" in (a, b) or instr.op == "mod" and b == "1":
+        return IRInstr("copy", instr.dest, ("0",))
+    identity = {"add": "0", "sub": "0", "mul": "1", "div": "1"}.get(instr.op)
+    if b == identity:
+        return IRInstr("copy", instr.dest, (a,))
+    if a == identity and instr.op in ("add", "mul"):
+        return IRInstr("copy", instr.dest, (b,))
+    return instr
+
+
+def propagate_copies(function: IRFunction) -> int:
+    """Read `x` instead of `y` after `y = copy x` on every path, then fold constant operations.
+
+    The copies that reach a block are the ones every predecessor hands
+    over, a forward dataflow problem. Only variables and 32 bits constants
+    are propagated, temporaries stay read once.
+    """
+    preds = function.predecessors()
+    copies_in: Dict[str, Dict[str, str] | None] = {block.label: None for block in function.blocks}
+    copies_out: Dict[str, Dict[str, str] | None] = {block.label: None for block in function.blocks}
+    copies_in[function.blocks[0].label] = {}
+
+    def transfer(copies: Dict[str, str], instr: IRInstr) -> None:
+        for name in ir_writes(instr, function):
+            for dest in [dest for dest, source in copies.items() if dest == name or source == name]:
+                del copies[dest]
+        if instr.op == "copy" and not is_temp(instr.dest) and instr.dest != instr.args[0] and \
+                (is_imm32(instr.args[0]) or not is_const(instr.args[0]) and not is_temp(instr.args[0])):
+            copies[instr.dest] = instr.args[0]
+
+    changed = True
+    while changed:
+        changed = False
+        for i, block in enumerate(function.blocks):
+            if i > 0:
+                reaching = [copies_out[pred] for pred in preds[block.label]]
+                known = [copies for copies in reaching if copies is not None]
+                if not known:
+                    continue
+                copies = dict(known[0])
+                for other in known[1:]:
+                    copies = {dest: source for dest, source in copies.items() if other.get(dest) == source}
+                copies_in[block.label] = copies
+            copies = dict(copies_in[block.label])  # type: ignore
+            for instr in block.instrs:
+                transfer(copies, instr)
+            if copies != copies_out[block.label]:
+                copies_out[block.label] = copies
+                changed = True
+
+    count = 0
+    for block in function.blocks:
+        copies = copies_in[block.label]
+        if copies is None:
+            continue  # unreachable
+        copies = dict(copies)
+        for i, instr in enumerate(block.instrs):
+            reads = IR_READS.get(instr.op, 0)
+            args = tuple(copies.get(arg, arg) for arg in instr.args[:reads]) + instr.args[reads:]
+            simplified = simplify_ir_instr(IRInstr(instr.op, instr.dest, args))
+            if simplified != instr:
+                count += 1
+                instr = simplified
+                block.instrs[i] = instr
+            transfer(copies, instr)
+    return count
+
+
+def may_fault_ir(instr: IRInstr) -> bool:
+    """Whether `instr` is a division by something else than a constant other than 0 and -1."""
+    return instr.op in ("div", "mod") and not (is_const(instr.args[1]) and int(instr.args[1]) not in (0, -1))
+
+
+def remove_dead_instrs(function: IRFunction) -> int:
+    """Drop the instructions that assign what is never read afterwards.
+
+    A division that may fault stays, assigning nothing.
+    """
+    live_out = ir_liveness(function)
+    count = 0
+    for block in function.blocks:
+        live = set(live_out[block.label])
+        kept = []
+        for instr in reversed(block.instrs):
+            if instr.dest and instr.dest not in live:
+                count += 1
+                if not may_fault_ir(instr):
+                    continue
+                instr = IRInstr(instr.op, "", instr.args)
+            live.difference_update(ir_writes(instr, function))
+            live.update(ir_reads(instr, function))
+            kept.append(instr)
+        kept.reverse()
+        block.instrs = kept
+    return count
+
+
+def fuse_branches(function: IRFunction) -> int:
+    """`%1 = gt a, b; br %1, T, F`  ->  `bgt a, b, T, F`"""
+    count = 0
+    for block in function.blocks:
+        if len(block.instrs) < 2:
+            continue
+        compare, branch = block.instrs[-2:]
+        if branch.op == "br" and compare.op in IR_FUSED_BRANCHES and compare.dest == branch.args[0] \
+                and is_temp(compare.dest):
+            block.instrs[-2:] = [IRInstr(IR_FUSED_BRANCHES[compare.op], "", compare.args + branch.args[1:])]
+            count += 1
+    return count
+
+
+def simplify_jumps(function: IRFunction) -> int:
+    """Decide constant branches, jump past empty blocks, merge straight lines and drop unreachable blocks."""
+    count = 0
+    for block in function.blocks:
+        last = block.instrs[-1] if block.instrs else None
+        if last is None or last.op not in ("br", "beq", "bgt"):
+            continue
+        targets = block.targets()
+        if last.op == "br" and is_const(last.args[0]):
+            taken = targets[0] if int(last.args[0]) != 0 else targets[1]
+        elif last.op != "br" and is_const(last.args[0]) and is_const(last.args[1]):
+            taken = targets[0] if fold_ir(last.op[1:], int(last.args[0]), int(last.args[1])) else targets[1]
+        elif targets[0] == targets[1]:
+            taken = targets[0]
+        else:
+            continue
+        block.instrs[-1] = IRInstr("jmp", "", (taken,))
+        count += 1
+
+    # an empty block that only jumps on stands for its target
+    forward = {block.label: block.instrs[0].args[0] for block in function.blocks[1:]
+               if len(block.instrs) == 1 and block.instrs[0].op == "jmp" and block.instrs[0].args[0] != block.label}
+
+    def final(label: str) -> str:
+        seen = {label}
+        while label in forward and forward[label] not in seen:
+            label = forward[label]
+            seen.add(label)
+        return label
+
+    for block in function.blocks:
+        if block.instrs and block.instrs[-1].op in IR_TERMINATORS:
+            last = block.instrs[-1]
+            targets = block.targets()
+            retargeted = [final(label) for label in targets]
+            if retargeted != targets:
+                block.instrs[-1] = IRInstr(last.op, "", last.args[:len(last.args) - len(targets)] + tuple(retargeted))
+                count += sum(1 for old, new in zip(targets, retargeted) if old != new)
+
+    reachable = {function.blocks[0].label}
+    by_label = {block.label: block for block in function.blocks}
+    work = [function.blocks[0]]
+    while work:
+        for target in work.pop().targets():
+            if target not in reachable:
+                reachable.add(target)
+                work.append(by_label[target])
+    count += sum(1 for block in function.blocks if block.label not in reachable)
+    function.blocks = [block for block in function.blocks if block.label in reachable]
+
+    # a block jumping to a block that nothing else enters takes its instructions
+    preds = function.predecessors()
+    merged: Set[str] = set()
+    for block in function.blocks:
+        if block.label in merged:
+            continue
+        while block.instrs and block.instrs[-1].op == "jmp":
+            target = block.instrs[-1].args[0]
+            if target == function.blocks[0].label or target == block.label or len(preds[target]) != 1:
+                break
+            block.instrs[-1:] = by_label[target].instrs
+            merged.add(target)
+            count += 1
+    function.blocks = [block for block in function.blocks if block.label not in merged]
+    return count
+
+
+IR_PASSES: List[Tuple[str, Callable[[IRFunction], int]]] = [
+    ("propagated copies", propagate_copies),
+    ("dead instructions", remove_dead_instrs),
+    ("fused branches", fuse_branches),
+    ("simplified jumps", simplify_jumps),
+]
+
+
+def run_passes(function: IRFunction, passes: List[Tuple[str, Callable[[IRFunction], int]]],
+               stats: Dict[str, int]) -> None:
+    """Run `passes` in order until none changes `function`, counting the changes of each in `stats`."""
+    for name, _ in passes:
+        stats.setdefault(name, 0)
+    changed = True
+    while changed:
+        changed = False
+        for name, ir_pass in passes:
+            count = ir_pass(function)
+            stats[name] += count
+            changed = changed or count > 0
+
+
+# PEEPHOLE #####
+# `compile_program` keeps rax, rbx, rcx and rdx as scratch registers that
+# never carry a value across a label, a jump or a call. The rules below rely
+# on that to decide when a scratch register is dead.
+
+class Instr(NamedTuple):
+    """One line of assembly: an instruction, a `label`, a `comment` or `raw` text.
+
+    A tuple of strings, so the garbage collector stops tracking it.
+    """
+    op: str
+    args: Tuple[str, ...] = ()
+
+
+SCRATCH_REGISTERS = {"rax", "rbx", "rcx", "rdx"}
+
+
+
+def register_families() -> Dict[str, str]:
+    """Map every register name to the 64 bits register it is part of."""
+    families = {}
+    for family, names in (("rax", "eax ax al"), ("rbx", "ebx bx bl"), ("rcx", "ecx cx cl"),
+                          ("rdx", "edx dx dl"), ("rsi", "esi si sil"), ("rdi", "edi di dil"),
+                          ("rbp", "ebp bp bpl"), ("rsp", "esp sp spl")):
+        for name in [family] + names.split():
+            families[name] = family
+    for number in range(8, 16):
+        for suffix in ("", "d", "w", "b"):
+            families[f"r{number}{suffix}"] = f"r{number}"
+    return families
+
+
+REGISTER_FAMILIES = register_families()
+# writing these zeroes or replaces the whole 64 bits register
+FULL_REGISTERS = {name for name in REGISTER_FAMILIES
+                  if name == REGISTER_FAMILIES[name] or name.startswith("e") or name.endswith("d")}
+JUMPS = {"jmp", "je", "jne", "jz", "jnz", "jg", "jge", "jl", "jle", "ja", "jae", "jb", "jbe"}
+CONDITIONS = {"e": "ne", "ne": "e", "z": "nz", "nz": "z", "g": "le", "le": "g", "l": "ge", "ge": "l"}
+SWAPPED_CONDITIONS = {"e": "e", "ne": "ne", "g": "l", "l": "g", "ge": "le", "le": "ge"}
+# instructions that read their first operand as well as writing it
+READ_WRITE = {"add", "sub", "and", "or", "xor", "imul", "cmp", "test", "sal", "sar", "shl", "shr"}
+
+
+def parse_asm(text: str) -> List[Instr]:
+    instrs = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith(";"):
+            instrs.append(Instr("comment", (stripped.lstrip("; "),)))
+        elif stripped.endswith(":") and " " not in stripped:
+            instrs.append(Instr("label", (stripped[:-1],)))
+        elif line[:1] not in (" ", "\t") or stripped == "":
+            instrs.append(Instr("raw", (line,)))
+        else:
+            code = stripped.split(";", 1)[0].strip()
+            op, _, rest = code.partition(" ")
+            args = tuple(arg.strip() for arg in rest.split(",")) if rest.strip() else ()
+            instrs.append(Instr(op, args))
+    return instrs
+
+
+def format_asm(instrs: List[Instr]) -> str:
+    lines = []
+    append = lines.append
+    # the same few instructions come back over and over
+    formatted: Dict[Instr, str] = {}
+    for instr in instrs:
+        line = formatted.get(instr)
+        if line is None:
+            op, args = instr
+            if op == "label":
+                line = args[0] + ":"
+            elif op == "comment":
+                line = "        ;; " + args[0]
+            elif op == "raw":
+                line = args[0]
+            elif args:
+                line = "        %-7s %s" % (op, ", ".join(args))
+            else:
+                line = "        " + op
+            formatted[instr] = line
+        append(line)
+    append("")
+    return "\n".join(lines)
+
+
+def registers_in(operand: str) -> Set[str]:
+    return {REGISTER_FAMILIES[word] for word in re.findall(r"\w+", operand) if word in REGISTER_FAMILIES}
+
+
+def is_register(operand: str) -> bool:
+    return operand in REGISTER_FAMILIES
+
+
+def is_memory(operand: str) -> bool:
+    return "[" in operand
+
+
+def is_imm32(operand: str) -> bool:
+    return re.fullmatch(r"-?\d+", operand) is not None and -2 ** 31 <= int(operand) < 2 ** 31
+
+
+def is_boundary(instr: Instr) -> bool:
+    return instr.op in ("label", "call", "ret", "raw") or instr.op in JUMPS and not is_fault_jump(instr)
+
+
+def is_fault_jump(instr: Instr) -> bool:
+    """Whether `instr` jumps to a `fault_N` stub of Codegen.fault, which reads no register and never returns."""
+    return instr.op in JUMPS and instr.args[0].startswith("fault_")
+
+
+def reads(instr: Instr) -> Set[str]:
+    if instr.op == "syscall":
+        return {"rax", "rdi", "rsi", "rdx"}
+    if instr.op in ("mul", "imul") and len(instr.args) == 1:
+        return {"rax"} | registers_in(instr.args[0])
+    if instr.op == "idiv":
+        return {"rax", "rdx"} | registers_in(instr.args[0])
+    if instr.op == "cqo":
+        return {"rax"}
+    if instr.op == "push":
+        return registers_in(instr.args[0])
+    if not instr.args:
+        return set()
+    read = set()
+    for arg in instr.args[1:]:
+        read |= registers_in(arg)
+    dest = instr.args[0]
+    if is_memory(dest) or instr.op in READ_WRITE and len(instr.args) == 2 or instr.op in ("neg", "not"):
+        read |= registers_in(dest)
+    if instr.op.startswith("set") or instr.op in JUMPS:
+        read = set()
+    return read
+
+
+def writes(instr: Instr) -> Set[str]:
+    """Registers fully overwritten by `instr`."""
+    if instr.op in ("mul", "imul", "idiv") and len(instr.args) == 1:
+        return {"rax", "rdx"}
+    if instr.op == "cqo":
+        return {"rdx"}
+    if instr.op == "pop" and instr.args[0] in FULL_REGISTERS:
+        return {REGISTER_FAMILIES[instr.args[0]]}
+    if instr.op in ("mov", "movzx", "lea", "imul", "add", "sub", "and") and instr.args[0] in FULL_REGISTERS:
+        return {REGISTER_FAMILIES[instr.args[0]]}
+    return set()
+
+
+def next_real(instrs: List[Instr], i: int) -> int:
+    """Index of the first instruction at or after `i` that is not a comment."""
+    while i < len(instrs) and instrs[i].op == "comment":
+        i += 1
+    return i
+
+
+def window(instrs: List[Instr], i: int, size: int) -> List[int]:
+    indices = []
+    while len(indices) < size:
+        i = next_real(instrs, i)
+        if i >= len(instrs):
+            return []
+        indices.append(i)
+        i += 1
+    return indices
+
+
+def dead_after(instrs: List[Instr], i: int, register: str) -> bool:
+    """Whether the value of `register` is never read after instrs[i]."""
+    register = REGISTER_FAMILIES[register]
+    i = next_real(instrs, i + 1)
+    while i < len(instrs):
+        instr = instrs[i]
+        if register in reads(instr):
+            return False
+        if register in writes(instr):
+            return True
+        if is_boundary(instr):
+            return register in SCRATCH_REGISTERS
+        i = next_real(instrs, i + 1)
+    return register in SCRATCH_REGISTERS
+
+
+def branch_condition(jump: str, test: Instr) -> bool | None:
+    """Whether `test` then `jump` branches when rax is nonzero."""
+    if not (test.op in ("and", "test") and test.args == ("rax", "rax")
+            or test.op == "cmp" and test.args == ("rax", "0")):
+        return None
+    if jump in ("jnz", "jne"):
+        return True
+    if jump in ("jz", "je"):
+        return False
+    return None
+
+
+def rule_fuse_branch(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """cmp, setcc al, movzx rax al, test rax, jcc  ->  cmp, jcc"""
+    cmp, setcc, movzx, test, jump = (instrs[i] for i in at)
+    if cmp.op != "cmp" or not setcc.op.startswith("set") or setcc.args != ("al",):
+        return None
+    if movzx.op != "movzx" or movzx.args != ("rax", "al"):
+        return None
+    when_true = branch_condition(jump.op, test)
+    if when_true is None or not dead_after(instrs, at[4], "rax"):
+        return None
+    condition = setcc.op[3:]
+    if not when_true:
+        condition = CONDITIONS[condition]
+    return [cmp, Instr("j" + condition, jump.args)]
+
+
+def rule_fold_operand(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """mov rbx, X; add rax, rbx  ->  add rax, X"""
+    mov, use = (instrs[i] for i in at)
+    if mov.op != "mov" or not is_register(mov.args[0]):
+        return None
+    scratch, value = mov.args
+    if REGISTER_FAMILIES[scratch] not in SCRATCH_REGISTERS or not dead_after(instrs, at[1], scratch):
+        return None
+    if use.op == "mul" and use.args == (scratch,):
+        if is_register(value) or is_memory(value):
+            return [Instr("mul", (value,))]
+        if is_imm32(value):
+            return [Instr("imul", ("rax", "rax", value))]
+        return None
+    if use.op not in ("add", "sub", "cmp", "and") or len(use.args) != 2 or use.args[1] != scratch:
+        return None
+    dest = use.args[0]
+    if dest == scratch or not (is_register(value) or is_imm32(value) or is_memory(value) and not is_memory(dest)):
+        return None
+    return [Instr(use.op, (dest, value))]
+
+
+def rule_compare_operand(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """mov rax, X; cmp rax, Y; jcc  ->  cmp X, Y; jcc  (or cmp Y, X; swapped jcc)"""
+    mov, cmp, jump = (instrs[i] for i in at)
+    if mov.op != "mov" or mov.args[0] != "rax" or cmp.op != "cmp" or cmp.args[0] != "rax":
+        return None
+    if jump.op not in JUMPS or jump.op == "jmp" or not dead_after(instrs, at[1], "rax"):
+        return None
+    value, other = mov.args[1], cmp.args[1]
+    if "rax" in registers_in(other):
+        return None
+    if is_register(value) or is_memory(value) and not is_memory(other):
+        return [Instr("cmp", (value, other)), jump]
+    if is_imm32(value) and (is_register(other) or is_memory(other)):
+        condition = SWAPPED_CONDITIONS.get(jump.op[1:])
+        if condition is None:
+            return None
+        return [Instr("cmp", (other, value)), Instr("j" + condition, jump.args)]
+    return None
+
+
+def rule_update_in_place(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """mov rax, V; add rax, X; mov V, rax  ->  add V, X"""
+    load, update, store = (instrs[i] for i in at)
+    if load.op != "mov" or load.args[0] != "rax" or store.op != "mov" or store.args != (load.args[1], "rax"):
+        return None
+    if update.op not in ("add", "sub") or update.args[0] != "rax" or not dead_after(instrs, at[2], "rax"):
+        return None
+    target, value = load.args[1], update.args[1]
+    if "rax" in registers_in(value) or is_memory(target) and not (is_register(value) or is_imm32(value)):
+        return None
+    if not (is_register(target) or is_memory(target)):
+        return None
+    return [Instr(update.op, (target, value))]
+
+
+def rule_dead_move(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """mov R, X with R never read again, or mov R, R"""
+    mov = instrs[at[0]]
+    if mov.op != "mov" or not is_register(mov.args[0]):
+        return None
+    if mov.args[0] == mov.args[1]:
+        return []
+    register = REGISTER_FAMILIES[mov.args[0]]
+    if register in SCRATCH_REGISTERS and dead_after(instrs, at[0], register):
+        return []
+    return None
+
+
+def rule_jump_to_next(instrs: List[Instr], at: List[int]) -> List[Instr] | None:
+    """jmp L straight into L:"""
+    jump = instrs[at[0]]
+    if jump.op != "jmp":
+        return None
+    i = next_real(instrs, at[0] + 1)
+    while i < len(instrs) and instrs[i].op == "label":
+        if instrs[i].args == jump.args:
+            return []
+        i = next_real(instrs, i + 1)
+    return None
+
+
+PEEPHOLE_RULES = [
+    ("fuse compare and branch", 5, rule_fuse_branch),
+    ("compare operand", 3, rule_compare_operand),
+    ("update in place", 3, rule_update_in_place),
+    ("fold operand", 2, rule_fold_operand),
+    ("dead move", 1, rule_dead_move),
+    ("jump to next", 1, rule_jump_to_next),
+]
+
+
+def peephole(instrs: List[Instr], stats: Dict[str, int]) -> List[Instr]:
+    """Rewrite the code of `main` with PEEPHOLE_RULES until none applies.
+
+    `stats` counts the instructions each rule removed.
+    """
+    for name, _, _ in PEEPHOLE_RULES:
+        stats.setdefault(name, 0)
+    start = next((i for i, instr in enumerate(instrs) if instr.op == "label" and instr.args == ("main",)), 0)
+    changed = True
+    while changed:
+        # every pass writes a new list, the rules only look ahead in the old one
+        changed = False
+        rewritten = instrs[:start]
+        i = start
+        while i < len(instrs):
+            if instrs[i].op in ("comment", "label", "raw"):
+                rewritten.append(instrs[i])
+                i += 1
+                continue
+            for name, size, rule in PEEPHOLE_RULES:
+                at = window(instrs, i, size)
+                if not at or any(instrs[j].op in ("label", "raw") for j in at):
+                    continue
+                replacement = rule(instrs, at)
+                if replacement is None:
+                    continue
+                stats[name] += len(at) - len(replacement)
+                rewritten += replacement
+                # the comments between the rewritten instructions stay after them
+                rewritten += [instr for instr in instrs[at[0] + 1:at[-1]] if instr.op == "comment"]
+                i = at[-1] + 1
+                changed = True
+                break
+            else:
+                rewritten.append(instrs[i])
+                i += 1
+        instrs = rewritten
+    return instrs
+
+
+OUTBUF_SIZE = 1 << 16
+
+# `put` formats rdi as a signed decimal and appends it to `outbuf`, `flush`
+# writes `outbuf` to stdout. `put` makes sure first that `outbuf` has room
+# for the longest number, then writes the digits backwards below rsp (a leaf
+# may use the 128 bytes of the red zone), two at a time from `digit_pairs`,
+# and copies them with three 8 bytes moves. The magnitude is the negation
+# taken as unsigned, so -2**63 needs no special case.
+RUNTIME = """\
+put:
+        mov     rax, QWORD [outlen]
+        lea     rcx, [rax+32]
+        cmp     rcx, OUTBUF_SIZE
+        jbe     .L1
+        push    rdi
+        call    flush
+        pop     rdi
+        xor     eax, eax
+.L1:
+        lea     r11, [outbuf+rax]
+        lea     rsi, [rsp-1]
+        mov     BYTE [rsi], 10
+        mov     rax, rdi
+        neg     rax
+        cmovs   rax, rdi
+        cmp     rax, 100
+        jb      .L3
+.L2:
+        mov     rcx, rax
+        shr     rax, 2
+        mov     rdx, 2951479051793528259
+        mul     rdx
+        shr     rdx, 2
+        imul    rax, rdx, 100
+        sub     rcx, rax
+        movzx   ecx, WORD [digit_pairs+rcx+rcx]
+        sub     rsi, 2
+        mov     WORD [rsi], cx
+        mov     rax, rdx
+        cmp     rax, 100
+        jae     .L2
+.L3:
+        cmp     rax, 10
+        jb      .L4
+        movzx   eax, WORD [digit_pairs+rax+rax]
+        sub     rsi, 2
+        mov     WORD [rsi], ax
+        jmp     .L5
+.L4:
+        add     eax, 48
+        sub     rsi, 1
+        mov     BYTE [rsi], al
+.L5:
+        test    rdi, rdi
+        jns     .L6
+        sub     rsi, 1
+        mov     BYTE [rsi], 45
+.L6:
+        mov     rax, QWORD [rsi]
+        mov     rcx, QWORD [rsi+8]
+        mov     rdx, QWORD [rsi+16]
+        mov     QWORD [r11], rax
+        mov     QWORD [r11+8], rcx
+        mov     QWORD [r11+16], rdx
+        mov     rax, rsp
+        sub     rax, rsi
+        add     QWORD [outlen], rax
+        ret
+flush:
+        mov     rdx, QWORD [outlen]
+        test    rdx, rdx
+        jz      .L7
+        mov     rsi, outbuf
+        mov     edi, 1
+        mov     eax, 1
+        syscall
+        mov     QWORD [outlen], 0
+.L7:
+        ret
+division_fault:
+        push    rsi
+        push    rdi
+        call    flush
+        pop     rdx
+        pop     rsi
+        mov     edi, 1
+        mov     eax, 1
+        syscall
+        mov     edi, 1
+        mov     eax, 60
+        syscall
+""" + 'digit_pairs: db "%s"\n' % "".join("%02d" % n for n in range(100))
+
+
+# the scratch registers of expressions, rax first since conditions end up there
+EXPR_REGISTERS = ["rax", "rcx", "rdx", "rbx"]
+LOW_BYTES = {"rax": "al", "rbx": "bl", "rcx": "cl", "rdx": "dl", "rsi": "sil", "rdi": "dil",
+             **{f"r{number}": f"r{number}b" for number in range(8, 16)}}
+
+
+def magic_divisor(d: int) -> Tuple[int, int]:
+    """Magic number M and shift s for dividing by 2 <= d < 2 ** 63 (Hacker's Delight, 10-1).
+
+    For any signed 64 bits a, the high half of the 128 bits a * M shifted
+    right by s, plus 1 when negative, is a / d rounded toward zero. M takes
+    up to 64 bits, imul reads it signed, as M - 2 ** 64, when the top bit is
+    set, and a must be added back to the high half then.
+    """
+    largest = 2 ** 63 - 1 - 2 ** 63 % d  # the largest dividend that leaves d - 1
+    p = 64
+    while 2 ** p <= largest * (d - 2 ** p % d):
+        p += 1
+    return 2 ** p // d + 1, p - 64
+
+
+class Codegen:
+    """Lower the IR of `main`, or of a module, into `self.asm`.
+
+    The `shared` variables of a program with modules have a global
+    `var_<name>` that they are stored to before every `use` and loaded back
+    from after it, and an `exported` module stores them all when it ends.
+    A `profile` build writes its counters out at exit, see PROFILE.
+    """
+
+    def __init__(self, var_dict: Dict[str, str], shared: List[str] = [], exported: bool = False,
+                 profile: bool = False):
+        self.asm: List[Instr] = []
+        self.interned: Dict[Instr, Instr] = {}
+        # the scratch registers of the current block: the free ones, those of
+        # its temporaries ("" once pushed), the pushed temporaries and the
+        # registers some temporaries should be computed in
+        self.free: List[str] = []
+        self.where: Dict[str, str] = {}
+        self.pushed: List[str] = []
+        self.hints: Dict[str, str] = {}
+        self.var_dict = var_dict
+        self.shared = shared
+        self.exported = exported
+        self.profile = profile
+        self.addr_num = 0
+        # the `fault_N` stubs, emitted after the code with `faults`
+        self.fault_stubs: List[Instr] = []
+
+    def emit(self, op: str, *args: str) -> None:
+        # tuple.__new__ skips the Python level __new__ of the NamedTuple
+        instr = tuple.__new__(Instr, (op, args))
+        # the same few instructions come back over and over, share them
+        self.asm.append(self.interned.setdefault(instr, instr))
+
+    def label(self, name: str) -> None:
+        self.asm.append(Instr("label", (name,)))
+
+    def comment(self, text: str) -> None:
+        self.asm.append(Instr("comment", (text,)))
+
+    def load_globals(self, names: List[str]) -> None:
+        for name in names:
+            if "[" in self.var_dict[name]:
+                self.emit("mov", "rax", f"QWORD [var_{name}]")
+                self.emit("mov", self.var_dict[name], "rax")
+            else:
+                self.emit("mov", self.var_dict[name], f"QWORD [var_{name}]")
+
+    def store_globals(self, names: List[str]) -> None:
+        for name in names:
+            if "[" in self.var_dict[name]:
+                self.emit("mov", "rax", self.var_dict[name])
+                self.emit("mov", f"QWORD [var_{name}]", "rax")
+            else:
+                self.emit("mov", f"QWORD [var_{name}]", self.var_dict[name])
+
+    def function(self, function: IRFunction) -> None:
+        """Lower the blocks of `function`, in order, the ones something jumps to under an `addr_N` label."""
+        labels: Dict[str, str] = {}
+        for block in function.blocks:
+            for target in block.targets():
+                if target not in labels:
+                    self.addr_num += 1
+                    labels[target] = "addr_%d" % self.addr_num
+        for i, block in enumerate(function.blocks):
+            if block.label in labels:
+                self.label(labels[block.label])
+            following = function.blocks[i + 1].label if i + 1 < len(function.blocks) else ""
+            self.block(block, labels, following)
+
+    def block(self, block: BasicBlock, labels: Dict[str, str], following: str) -> None:
+        """Lower one block, its temporaries in the scratch registers, pushing the oldest when they run out.
+
+        A temporary `put` reads, and the first temporary operand it is
+        computed from, go straight into rdi.
+        """
+        assert len(IR_BINARY) == 7, "Binary instructions changed in Codegen.block()"
+        self.free = list(EXPR_REGISTERS)
+        self.where = {}
+        self.pushed = []
+        self.hints = {}
+        for instr in reversed(block.instrs):
+            if instr.op == "put" and is_temp(instr.args[0]):
+                self.hints[instr.args[0]] = "rdi"
+            elif instr.dest in self.hints and instr.op in IR_BINARY_OPS:
+                first = next((arg for arg in instr.args if is_temp(arg)), None)
+                if first is not None:
+                    self.hints[first] = self.hints[instr.dest]
+        for i, instr in enumerate(block.instrs):
+            self.comment(format_ir_instr(instr))
+            if instr.op in ("div", "mod"):
+                self.divide(instr)
+            elif instr.op in IR_BINARY_OPS:
+                following_instr = block.instrs[i + 1] if i + 1 < len(block.instrs) else None
+                self.binary(instr, following_instr)
+            elif instr.op == "copy":
+                self.copy(instr)
+            elif instr.op == "put":
+                value = self.read(instr.args)[0]
+                if value != "rdi":
+                    self.emit("mov", "rdi", value)
+                self.emit("call", "put")
+            elif instr.op == "br":
+                value = self.read(instr.args[:1])[0]
+                if is_const(value):
+                    self.jump(instr.args[1] if int(value) != 0 else instr.args[2], labels, following)
+                    continue
+                if is_memory(value):
+                    self.emit("cmp", value, "0")
+                else:
+                    self.emit("test", value, value)
+                self.branch("nz", instr.args[1], instr.args[2], labels, following)
+            elif instr.op in ("beq", "bgt"):
+                a, b = self.read(instr.args[:2])
+                condition = "e" if instr.op == "beq" else "g"
+                if is_const(a) and is_const(b):
+                    taken = fold_ir(instr.op[1:], int(a), int(b))
+                    self.jump(instr.args[2] if taken else instr.args[3], labels, following)
+                    continue
+                if is_const(a):
+                    a, b, condition = b, a, SWAPPED_CONDITIONS[condition]
+                elif is_memory(a) and is_memory(b):
+                    self.emit("mov", EXPR_REGISTERS[0], a)
+                    a = EXPR_REGISTERS[0]
+                self.emit("cmp", a, b)
+                self.branch(condition, instr.args[2], instr.args[3], labels, following)
+            elif instr.op == "jmp":
+                self.jump(instr.args[0], labels, following)
+            elif instr.op == "count":
+                self.emit("add", f"QWORD [profile_counts+{8 * int(instr.args[0])}]", "1")
+            elif instr.op == "exit" and self.exported:
+                self.store_globals(self.shared)
+                self.emit("leave")
+                self.emit("ret")
+            elif instr.op == "exit":
+                if self.profile:
+                    self.emit("call", "profile_dump")
+                self.emit("call", "flush")
+                self.emit("mov", "rax", "SYS_EXIT")
+                self.emit("mov", "rdi", "0")
+                self.emit("syscall")
+            elif instr.op == "use":
+                self.store_globals(self.shared)
+                self.emit("call", "module_%s" % instr.args[0])
+                self.load_globals(self.shared)
+            else:
+                print(instr, "is unreachable")
+                assert False, "unreachable"
+
+    def take(self, temp: str = "", avoid: Tuple[str, ...] = ()) -> str:
+        """A free scratch register other than `avoid`, for `temp` if given, pushing the oldest temporary when none is."""
+        if temp in self.hints:
+            register = self.hints[temp]
+        else:
+            free = [register for register in self.free if register not in avoid] if avoid else self.free
+            if not free:
+                oldest = next(name for name in self.where if is_temp(name) and self.where[name] in EXPR_REGISTERS)
+                self.comment("-- spill --")
+                self.emit("push", self.where[oldest])
+                self.free.append(self.where[oldest])
+                free = [self.where[oldest]]
+                self.where[oldest] = ""
+                self.pushed.append(oldest)
+            register = free[0]
+            self.free.remove(register)
+        if temp:
+            self.where[temp] = register
+        return register
+
+    def read(self, args: Tuple[str, ...]) -> List[str]:
+        """Operands of `args`, popping the pushed temporaries, and free the registers of the temporaries.
+
+        A temporary under others on the stack is loaded from there instead,
+        leaving a hole that is dropped once nothing is pushed above it.
+        """
+        where = self.where
+        if self.pushed:
+            for temp in sorted((arg for arg in set(args) if where.get(arg) == ""),
+                               key=self.pushed.index, reverse=True):
+                where[temp] = self.free.pop(0)
+                depth = len(self.pushed) - 1 - self.pushed.index(temp)
+                if depth == 0:
+                    self.pushed.pop()
+                    self.emit("pop", where[temp])
+                else:
+                    self.pushed[-1 - depth] = ""
+                    self.emit("mov", where[temp], f"QWORD [rsp + {8 * depth}]")
+                holes = 0
+                while self.pushed and self.pushed[-1] == "":
+                    self.pushed.pop()
+                    holes += 1
+                if holes:
+                    self.emit("add", "rsp", str(8 * holes))
+        operands = [where.get(arg) or (arg if is_const(arg) else self.var_dict[arg]) for arg in args]
+        for arg in args:
+            register = where.pop(arg, None)
+            if register in EXPR_REGISTERS:
+                self.free.append(register)
+        return operands
+
+    def binary(self, instr: IRInstr, following: IRInstr | None) -> None:
+        """`dest = op a, b` in the register the result goes to, where `a` or `b` already is if it can."""
+        op, dest, args = instr
+        dying = [self.where[arg] for arg in args if self.where.get(arg)]
+        a, b = self.read(args)
+        store = ""
+        if is_temp(dest):
+            target = self.hints.get(dest) or (dying[0] if dying else self.take())
+            self.where[dest] = target
+        else:
+            target = self.var_dict[dest]
+            if is_memory(target):
+                store, target = target, dying[0] if dying else self.take()
+        if target in self.free:
+            self.free.remove(target)
+        if a == target:
+            self.combine(op, target, b, False)
+        elif b == target:
+            self.combine(op, target, a, True)
+        elif op == "mul" and is_imm32(b) and not is_const(a):
+            self.emit("imul", target, a, b)
+        elif op == "mul" and is_imm32(a) and not is_const(b):
+            self.emit("imul", target, b, a)
+        else:
+            self.emit("mov", target, a)
+            self.combine(op, target, b, False)
+        if store:
+            if following is not None and following.op in IR_BINARY_OPS and following.dest == dest \
+                    and dest in following.args:
+                # the next instruction updates it again, keep it in `target` until then
+                self.where[dest] = target
+            else:
+                self.emit("mov", store, target)
+                self.free.append(target)
+
+    def fault(self, pos: int, error: str) -> str:
+        """Label of a new stub stopping the program with `error` at `pos`, through `division_fault`."""
+        self.addr_num += 1
+        label = "fault_%d" % self.addr_num
+        file, l, c = unpack_pos(pos)
+        message = f"{file}:{l}:{c}: ERROR: {error}\n".encode()
+        self.fault_stubs += [Instr("label", (label,)),
+                             Instr("mov", ("rsi", f"{label}_message")),
+                             Instr("mov", ("edi", str(len(message)))),
+                             Instr("jmp", ("division_fault",)),
+                             Instr("raw", (db(f"{label}_message", message),))]
+        return label
+
+    def faults(self) -> None:
+        """Emit the stubs of `fault` so far."""
+        self.asm += self.fault_stubs
+        self.fault_stubs = []
+
+    def claim(self, register: str, keep: Tuple[str, ...]) -> None:
+        """Take scratch `register` for the current instruction, moving its temporary to a free
+        register other than `keep`, or pushing it when there is none."""
+        temp = next((name for name, where in self.where.items() if where == register), None)
+        if temp is None:
+            self.free.remove(register)
+            return
+        spare = next((other for other in self.free if other not in keep), None)
+        if spare is None:
+            self.comment("-- spill --")
+            self.emit("push", register)
+            self.where[temp] = ""
+            self.pushed.append(temp)
+        else:
+            self.emit("mov", spare, register)
+            self.free.remove(spare)
+            self.where[temp] = spare
+
+    def divide(self, instr: IRInstr) -> None:
+        """`dest = div a, b` or `dest = mod a, b`, computed in rax or rdx.
+
+        A constant divisor d other than 0 and -1 needs no idiv: a power of 2
+        is a shift of a rounded toward zero first, any other d a multiply by
+        magic_divisor(|d|). Otherwise idiv divides, after a jump to a stub
+        that stops the program like `sim` when the divisor is 0, see `fault`.
+        The smallest integer by -1 still faults.
+        """
+        op, dest, args = instr
+        a, b = self.read(args[:2])
+        if b == "0":
+            self.emit("jmp", self.fault(int(args[2]), "division by zero"))
+        elif not is_const(b):
+            if is_memory(b):
+                self.emit("cmp", b, "0")
+            else:
+                self.emit("test", b, b)
+            self.emit("jz", self.fault(int(args[2]), "division by zero"))
+        keep = (a, b, "rax", "rdx")
+        self.claim("rax", keep)
+        self.claim("rdx", keep)
+        spare = ""
+        d = int(b) if is_const(b) else 0
+        k = abs(d).bit_length() - 1
+        if d not in (0, -1) and abs(d) == 1 << k:
+            result = "rax"
+            if k == 0 and op == "mod":
+                self.emit("mov", "rax", "0")
+            elif a != "rax":
+                self.emit("mov", "rax", a)
+            if k > 0:
+                # a + 2 ** k - 1 when negative, so that the shift rounds toward zero
+                self.emit("cqo")
+                self.emit("shr", "rdx", str(64 - k))
+                self.emit("add", "rax", "rdx")
+                if op == "div":
+                    self.emit("sar", "rax", str(k))
+                    if d < 0:
+                        self.emit("neg", "rax")
+                else:
+                    self.emit("and", "rax", str((1 << k) - 1))
+                    self.emit("sub", "rax", "rdx")
+        elif d not in (0, -1):
+            result = "rdx"
+            magic, shift = magic_divisor(abs(d))
+            if a in ("rax", "rdx") or is_const(a):
+                spare = self.take(avoid=keep)
+                self.emit("mov", spare, a)
+                a = spare
+            self.emit("mov", "rax", str(wrap64(magic)))
+            self.emit("imul", a)
+            if magic >= 2 ** 63:
+                self.emit("add", "rdx", a)
+            if shift:
+                self.emit("sar", "rdx", str(shift))
+            self.emit("mov", "rax", "rdx")
+            self.emit("shr", "rax", "63")
+            self.emit("add", "rdx", "rax")
+            if op == "mod":
+                # a - q * |d|, with q = a / |d|
+                self.emit("imul", "rdx", "rdx", str(-abs(d)))
+                self.emit("add", "rdx", a)
+            elif d < 0:
+                self.emit("neg", "rdx")
+        else:
+            result = "rax" if op == "div" else "rdx"
+            if is_const(b) or b in ("rax", "rdx"):
+                spare = self.take(avoid=keep)
+                self.emit("mov", spare, b)
+                b = spare
+            if a != "rax":
+                self.emit("mov", "rax", a)
+            self.emit("cqo")
+            self.emit("idiv", b)
+        self.free.append("rdx" if result == "rax" else "rax")
+        if spare:
+            self.free.append(spare)
+        if not dest:
+            self.free.append(result)
+        elif is_temp(dest) and dest not in self.hints:
+            self.where[dest] = result
+        else:
+            self.emit("mov", self.hints[dest] if is_temp(dest) else self.var_dict[dest], result)
+            self.free.append(result)
+            if is_temp(dest):
+                self.where[dest] = self.hints[dest]
+
+    def combine(self, op: str, target: str, value: str, swapped: bool) -> None:
+        """target := target OP value, or value OP target when `swapped`."""
+        if op == "add":
+            self.emit("add", target, value)
+        elif op == "sub":
+            if swapped:
+                self.emit("neg", target)
+                self.emit("add", target, value)
+            else:
+                self.emit("sub", target, value)
+        elif op == "mul":
+            if is_imm32(value):
+                self.emit("imul", target, target, value)
+            else:
+                self.emit("imul", target, value)
+        elif op in ("eq", "gt"):
+            self.emit("cmp", target, value)
+            condition = "e" if op == "eq" else "l" if swapped else "g"
+            self.emit("set" + condition, LOW_BYTES[target])
+            self.emit("movzx", target, LOW_BYTES[target])
+        else:
+            print(op, "is unreachable")
+            assert False, "unreachable"
+
+    def copy(self, instr: IRInstr) -> None:
+        value = self.read(instr.args)[0]
+        if is_temp(instr.dest):
+            register = self.take(instr.dest)
+            if value != register:
+                self.emit("mov", register, value)
+            return
+        dest = self.var_dict[instr.dest]
+        if is_memory(dest) and (is_memory(value) or is_const(value) and not is_imm32(value)):
+            scratch = self.take()
+            self.emit("mov", scratch, value)
+            self.free.append(scratch)
+            value = scratch
+        if value != dest:
+            self.emit("mov", dest, value)
+
+    def branch(self, condition: str, then: str, otherwise: str, labels: Dict[str, str], following: str) -> None:
+        """Jump to `then` on `condition` and to `otherwise` else, falling through into `following` if it is either."""
+        if then == following:
+            self.emit("j" + CONDITIONS[condition], labels[otherwise])
+        else:
+            self.emit("j" + condition, labels[then])
+            self.jump(otherwise, labels, following)
+
+    def jump(self, target: str, labels: Dict[str, str], following: str) -> None:
+        if target != following:
+            self.emit("jmp", labels[target])
+
+
+def runtime_asm(buffered: bool) -> List[Instr]:
+    runtime = parse_asm(RUNTIME)
+    if not buffered:
+        ret = next(i for i, instr in enumerate(runtime) if instr.op == "ret")
+        runtime.insert(ret, Instr("call", ("flush",)))
+    return runtime
+
+
+def generate_program(program: Program, buffered: bool = True, ir_stats: Dict[str, int] | None = None,
+                     ir_file: TextIO | None = None, profile_path: str = "") -> List[Instr]:
+    """Assembly of `program` and its runtime, as a list of instructions.
+
+    `put` appends to a static buffer that is flushed when full and at exit,
+    or on every call when `buffered` is False. Unless `ir_stats` is None
+    the IR goes through `IR_PASSES` first, and it is written to `ir_file`
+    if given. With a `profile_path` the program counts what it runs and
+    writes the counts there at exit.
+    """
+    profile: List[Tuple[POS, str, int]] | None = [] if profile_path else None
+    function = IRBuilder(set(), profile).function(program)
+    if ir_stats is not None:
+        run_passes(function, IR_PASSES, ir_stats)
+    if ir_file is not None:
+        ir_file.write(format_ir(function))
+    var_dict, frame_size, undefined = allocate_ir_registers(function)
+    asm: List[Instr] = []
+    for chunk in program_chunks([function], var_dict, frame_size, undefined, buffered, profile, profile_path):
+        asm += chunk
+    return asm
+
+
+# past this many different instructions, Codegen and Assembler forget the
+# ones they share or encoded so far
+INTERNED_LIMIT = 1 << 16
+
+
+def program_chunks(fragments: Iterable[IRFunction], var_dict: Dict[str, str], frame_size: int,
+                   undefined: Set[str], buffered: bool, profile: List[Tuple[POS, str, int]] | None = None,
+                   profile_path: str = "") -> Iterator[List[Instr]]:
+    """Yield the assembly of the program with the register allocation `var_dict`.
+
+    The runtime and the start of `main` come first, then the code of every
+    fragment of `main`, the whole of it or one top level statement at a
+    time, as soon as it is lowered. The counters of the fragments built for
+    `profile` come last, with `profile_dump`.
+    """
+    yield parse_asm("BITS 64\n"
+                    "%%define SYS_EXIT 60\n"
+                    "%%define OUTBUF_SIZE %d\n"
+                    "segment .text\n"
+                    "global _start\n" % OUTBUF_SIZE) + runtime_asm(buffered)
+    codegen = Codegen(var_dict, profile=profile is not None)
+    codegen.label("main")
+    codegen.emit("push", "rbp")
+    codegen.emit("mov", "rbp", "rsp")
+    if frame_size > 0:
+        codegen.emit("sub", "rsp", str(frame_size))
+    for name in sorted(undefined):
+        codegen.emit("mov", var_dict[name], "0")
+    for fragment in fragments:
+        codegen.function(fragment)
+        yield codegen.asm
+        codegen.asm = []
+        if len(codegen.interned) > INTERNED_LIMIT:
+            codegen.interned.clear()
+    codegen.faults()
+    codegen.label("_start")
+    codegen.emit("call", "main")
+    if profile is None:
+        yield codegen.asm + parse_asm("segment .bss\n"
+                                      "outbuf: resb OUTBUF_SIZE\n"
+                                      "outlen: resq 1\n")
+    else:
+        yield codegen.asm + profile_asm(profile, profile_path)
+
+
+def generate_runtime(buffered: bool = True) -> List[Instr]:
+    """Assembly of the object that `put`, `flush` and `_start` of a program with modules live in."""
+    asm = parse_asm("BITS 64\n"
+                    "%%define OUTBUF_SIZE %d\n"
+                    "segment .text\n"
+                    "global _start, put, flush, division_fault\n"
+                    "extern main\n" % OUTBUF_SIZE)
+    asm += runtime_asm(buffered)
+    asm += parse_asm("_start:\n"
+                     "        call    main\n"
+                     "segment .bss\n"
+                     "outbuf: resb OUTBUF_SIZE\n"
+                     "outlen: resq 1\n")
+    return asm
+
+
+def generate_module(program: Program, symbol: str, modules: List[str],
+                    ir_stats: Dict[str, int] | None = None) -> List[Instr]:
+    """Assembly of the object of one module, the function `symbol`.
+
+    `main` exits at its end while the `module_<name>` of the other modules
+    return. `modules` are the modules `program` uses. Unless `ir_stats` is
+    None the IR goes through `IR_PASSES` first.
+    """
+    exported = symbol != "main"
+    shared = read_vars(program, assigned_vars(program))
+    function = IRBuilder(set(shared)).function(program, shared, exported)
+    if ir_stats is not None:
+        run_passes(function, IR_PASSES, ir_stats)
+    var_dict, frame_size, undefined = allocate_ir_registers(function)
+    header = ["BITS 64", "%define SYS_EXIT 60", "segment .text", f"global {symbol}", "extern put, flush, division_fault"]
+    header += [f"extern module_{name}" for name in sorted(set(modules))]
+    header += [f"common var_{name} 8" for name in sorted(shared)]
+    asm = [Instr("raw", (line,)) for line in header]
+    codegen = Codegen(var_dict, sorted(shared), exported)
+    codegen.label(symbol)
+    codegen.emit("push", "rbp")
+    codegen.emit("mov", "rbp", "rsp")
+    if frame_size > 0:
+        codegen.emit("sub", "rsp", str(frame_size))
+    # the variables some other module may have assigned
+    codegen.load_globals(sorted(undefined))
+    codegen.function(function)
+    codegen.faults()
+    return asm + codegen.asm
+
+
+def compile_program(file_name: str, program: Program, buffered: bool = True,
+                    peephole_stats: Dict[str, int] | None = None, ir_stats: Dict[str, int] | None = None,
+                    ir_path: str = "", profile_path: str = "") -> List[Instr]:
+    """Generate the assembly of `program`, write it to `file_name` at once and return it.
+
+    Unless `ir_stats` is None the IR goes through `IR_PASSES`, and unless
+    `peephole_stats` is None the code goes through `peephole`. The IR is
+    written to `ir_path` if given. The executable writes its profile to
+    `profile_path` if given.
+    """
+    with PausedGC():
+        if ir_path:
+            with open(ir_path, "w") as ir_file:
+                asm = generate_program(program, buffered, ir_stats, ir_file, profile_path)
+        else:
+            asm = generate_program(program, buffered, ir_stats, profile_path=profile_path)
+        if peephole_stats is not None:
+            asm = peephole(asm, peephole_stats)
+        text = format_asm(asm)
+    with open(file_name, "w") as out:
+        out.write(text)
+    return asm
+
+
+def stream_compile(prog_path: str, asm_path: str, executable: str = "", buffered: bool = True,
+                   ir_path: str = "", profile_path: str = "") -> int:
+    """Compile `prog_path` holding one top level statement at a time, return the instruction count.
+
+    A first pass over the program allocates the registers, a second one
+    builds the IR of every statement, writes it to `ir_path` if given, and
+    writes its assembly to `asm_path` and, for the built-in backend, its
+    machine code to `executable` right away. The executable writes its
+    profile to `profile_path` if given.
+    """
+    with PausedGC():
+        intervals, undefined = stream_intervals(stream_program(prog_path))
+    var_dict, frame_size = linear_scan(intervals)
+    del intervals
+    profile: List[Tuple[POS, str, int]] | None = [] if profile_path else None
+    builder = IRBuilder(set(), profile)
+    ir_file = open(ir_path, "w") if ir_path else None
+
+    def fragments() -> Iterator[IRFunction]:
+        for op in stream_program(prog_path):
+            fragment = builder.function([op])
+            if ir_file is not None:
+                ir_file.write(format_ir(fragment))
+            yield fragment
+
+    count = 0
+    writer = ExecutableWriter(executable) if executable else None
+    with open(asm_path, "w") as out, PausedGC():
+        for chunk in program_chunks(fragments(), var_dict, frame_size, undefined, buffered, profile, profile_path):
+            out.write(format_asm(chunk))
+            if writer is not None:
+                writer.add(chunk)
+            count += sum(1 for instr in chunk if instr.op not in ("label", "comment", "raw"))
+    if writer is not None:
+        writer.finish()
+    if ir_file is not None:
+        ir_file.close()
+    return count
+
+
+# X86-64 ENCODER #####
+# The built-in backend of `com`: `Assembler` encodes the instructions of
+# `compile_program` into machine code and `ExecutableWriter` lays it out as a
+# static ELF64 executable, one text and one bss segment, so neither yasm nor
+# ld is needed. Jumps and calls always take a rel32, and the addresses of
+# labels and bss symbols are patched in by `ExecutableWriter` once known.
+# The modules of a program go through `link_object` into ELF objects for ld.
+
+def x86_registers() -> Dict[str, Tuple[int, int]]:
+    """Map register names to their number and size in bits."""
+    registers = {}
+    for number, name in enumerate(["ax", "cx", "dx", "bx", "sp", "bp", "si", "di"]):
+        registers["r" + name] = (number, 64)
+        registers["e" + name] = (number, 32)
+        registers[name] = (number, 16)
+    for number, name in enumerate(["al", "cl", "dl", "bl", "spl", "bpl", "sil", "dil"]):
+        registers[name] = (number, 8)
+    for number in range(8, 16):
+        for suffix, bits in (("", 64), ("d", 32), ("w", 16), ("b", 8)):
+            registers[f"r{number}{suffix}"] = (number, bits)
+    return registers
+
+
+X86_REGISTERS = x86_registers()
+OPERAND_SIZES = {"BYTE": 8, "WORD": 16, "DWORD": 32, "QWORD": 64}
+CONDITION_CODES = {"o": 0, "no": 1, "b": 2, "c": 2, "nae": 2, "ae": 3, "nb": 3, "nc": 3,
+                   "e": 4, "z": 4, "ne": 5, "nz": 5, "be": 6, "na": 6, "a": 7, "nbe": 7,
+                   "s": 8, "ns": 9, "p": 10, "pe": 10, "np": 11, "po": 11, "l": 12, "nge": 12,
+                   "ge": 13, "nl": 13, "le": 14, "ng": 14, "g": 15, "nle": 15}
+ALU_OPS = {"add": 0, "or": 1, "and": 4, "sub": 5, "xor": 6, "cmp": 7}
+SHIFT_OPS = {"sal": 4, "shl": 4, "shr": 5, "sar": 7}
+# one operand instructions of the F6/F7 group
+UNARY_OPS = {"not": 2, "neg": 3, "mul": 4, "imul": 5, "div": 6, "idiv": 7}
+FIXED_OPS = {"leave": b"\xc9", "ret": b"\xc3", "nop": b"\x90", "syscall": b"\x0f\x05",
+             "cdqe": b"\x48\x98", "cqo": b"\x48\x99"}
+ELF_BASE = 0x400000
+PAGE_SIZE = 0x1000
+# the ELF header and two program headers, the text follows right after
+ELF_HEADER_SIZE = 64 + 2 * 56
+TEXT_ADDR = ELF_BASE + ELF_HEADER_SIZE
+
+
+class Reg(NamedTuple):
+    number: int
+    bits: int
+
+
+class Mem(NamedTuple):
+    bits: int    # 0 when the other operand gives the size
+    base: int    # register number, -1 for none
+    index: int   # register number, -1 for none
+    disp: int
+    symbol: str  # the displacement is relative to this symbol unless ""
+
+
+Operand = Reg | Mem | int | str  # str is the address of a symbol
+
+
+class Assembler:
+    """Encode instructions into `code`, remembering the addresses to patch in `fixups`."""
+
+    def __init__(self) -> None:
+        self.code = bytearray()
+        self.labels: Dict[str, int] = {}
+        self.bss: Dict[str, int] = {}
+        self.bss_size = 0
+        self.defines: Dict[str, str] = {}
+        self.globals: Set[str] = set()
+        self.externs: Set[str] = set()
+        self.commons: Dict[str, int] = {}
+        self.in_bss = False
+        # (offset of a 32 bits field, symbol, addend, relative to the next instruction)
+        self.fixups: List[Tuple[int, str, int, bool]] = []
+        self.instr: Instr = Instr("")
+        # the same few instructions come back over and over, like in format_asm
+        self.encoded: Dict[Instr, Tuple[bytes, List[Tuple[int, str, int, bool]]]] = {}
+
+    def error(self, message: str) -> None:
+        print(f"ERROR: {message} in `{format_asm([self.instr]).strip()}`, try --yasm")
+        exit(1)
+
+    def assemble(self, instrs: List[Instr]) -> None:
+        for instr in instrs:
+            self.instr = instr
+            op, args = instr
+            if op == "comment":
+                continue
+            if op == "raw":
+                self.directive(args[0])
+            elif self.in_bss:
+                self.error("only reservations can go in the bss segment")
+            elif op == "label":
+                if args[0] in self.labels:
+                    self.error(f"label `{args[0]}` is defined twice")
+                self.labels[args[0]] = len(self.code)
+            elif instr in self.encoded:
+                code, fixups = self.encoded[instr]
+                start = len(self.code)
+                self.code += code
+                for at, symbol, addend, relative in fixups:
+                    self.fixups.append((start + at, symbol, addend, relative))
+            else:
+                start, first_fixup = len(self.code), len(self.fixups)
+                self.encode(op, [self.operand(arg) for arg in args])
+                self.encoded[instr] = (bytes(self.code[start:]), [
+                    (at - start, symbol, addend, relative)
+                    for at, symbol, addend, relative in self.fixups[first_fixup:]])
+
+    def directive(self, line: str) -> None:
+        words = line.split()
+        if len(words) == 0 or words[0] == "BITS" or words[0].startswith(";"):
+            return
+        if words[0] in ("global", "extern") and len(words) > 1:
+            names = {name.strip() for name in line.split(None, 1)[1].split(",")}
+            (self.globals if words[0] == "global" else self.externs).update(names)
+        elif words[0] == "common" and len(words) == 3:
+            size = self.value(words[2])
+            if type(size) != int:
+                self.error(f"`{words[2]}` is not a number")
+            self.commons[words[1]] = size  # type: ignore
+        elif words[0] == "%define" and len(words) == 3:
+            self.defines[words[1]] = words[2]
+        elif words[0] in ("segment", "section") and len(words) == 2:
+            self.in_bss = words[1] == ".bss"
+        elif not self.in_bss and len(words) > 2 and words[0].endswith(":") and words[1] == "db":
+            if words[0][:-1] in self.labels:
+                self.error(f"label `{words[0][:-1]}` is defined twice")
+            self.labels[words[0][:-1]] = len(self.code)
+            # strings and byte values, separated by commas
+            for item in re.findall(r'"[^"]*"|[^,\s]+', line.split(None, 2)[2]):
+                if item[0] == '"':
+                    self.code += item[1:-1].encode()
+                    continue
+                byte = self.value(item)
+                if type(byte) != int or not 0 <= byte < 256:  # type: ignore
+                    self.error(f"`{item}` is not a byte")
+                self.code.append(byte)  # type: ignore
+        elif self.in_bss and len(words) == 3 and words[0].endswith(":") and words[1] in ("resb", "resw", "resd", "resq"):
+            count = self.value(words[2])
+            if type(count) != int:
+                self.error(f"`{words[2]}` is not a number")
+            self.bss[words[0][:-1]] = self.bss_size
+            self.bss_size += count * {"resb": 1, "resw": 2, "resd": 4, "resq": 8}[words[1]]  # type: ignore
+        else:
+            self.error("unsupported directive")
+
+    def value(self, text: str) -> int | str:
+        while text in self.defines:
+            text = self.defines[text]
+        if re.fullmatch(r"-?\d+", text):
+            return int(text)
+        if re.fullmatch(r"[A-Za-z_.][\w.]*", text):
+            return text
+        self.error(f"cannot read `{text}`")
+        return 0
+
+    def operand(self, text: str) -> Operand:
+        bits = 0
+        size, _, rest = text.partition(" ")
+        if size in OPERAND_SIZES:
+            bits, text = OPERAND_SIZES[size], rest.strip()
+        if text in X86_REGISTERS:
+            return Reg(*X86_REGISTERS[text])
+        if not text.startswith("["):
+            return self.value(text)
+        if not text.endswith("]"):
+            self.error(f"cannot read `{text}`")
+        base, index, disp, symbol = -1, -1, 0, ""
+        sign = 1
+        for term in re.findall(r"[+-]|[^+\-\s]+", text[1:-1]):
+            if term in "+-":
+                sign = 1 if term == "+" else -sign
+                continue
+            if term in X86_REGISTERS and X86_REGISTERS[term][1] == 64 and sign == 1:
+                if base < 0:
+                    base = X86_REGISTERS[term][0]
+                elif index < 0 and X86_REGISTERS[term][0] != 4:
+                    index = X86_REGISTERS[term][0]
+                else:
+                    self.error("too many registers in an address")
+            else:
+                value = self.value(term)
+                if type(value) == int:
+                    disp += sign * value  # type: ignore
+                elif symbol == "" and sign == 1:
+                    symbol = value  # type: ignore
+                else:
+                    self.error(f"cannot use `{term}` in an address")
+            sign = 1
+        return Mem(bits, base, index, disp, symbol)
+
+    def emit(self, opcode: bytes, reg: int, rm: Reg | Mem, bits: int, imm: bytes = b"") -> None:
+        """Emit opcode with a ModRM byte, `reg` in its reg field and `rm` as the r/m operand."""
+        rex = 0x48 if bits == 64 else 0
+        if reg & 8:
+            rex |= 0x44
+        if bits == 8 and (reg >= 4 or type(rm) == Reg and rm.number >= 4):
+            rex |= 0x40  # spl, bpl, sil and dil instead of ah, ch, dh and bh
+        r = (reg & 7) << 3
+        disp_at = -1
+        if type(rm) == Reg:
+            if rm.number & 8:
+                rex |= 0x41
+            tail = bytes([0xC0 | r | rm.number & 7])
+        elif rm.base < 0:
+            # absolute address, through a SIB byte since mod 00 rm 101 means rip relative
+            index = 4
+            if rm.index >= 0:
+                index = rm.index & 7
+                if rm.index & 8:
+                    rex |= 0x42
+            tail = bytes([0x04 | r, index << 3 | 5]) + (rm.disp & 0xFFFFFFFF).to_bytes(4, "little")
+            disp_at = 2
+        else:
+            if rm.base & 8:
+                rex |= 0x41
+            if rm.symbol == "" and rm.disp == 0 and rm.base & 7 != 5:
+                mod, disp = 0, b""
+            elif rm.symbol == "" and -128 <= rm.disp < 128:
+                mod, disp = 1, (rm.disp & 0xFF).to_bytes(1, "little")
+            else:
+                mod, disp = 2, (rm.disp & 0xFFFFFFFF).to_bytes(4, "little")
+            if rm.index < 0 and rm.base & 7 != 4:
+                tail = bytes([mod << 6 | r | rm.base & 7]) + disp
+                disp_at = 1
+            else:
+                index = 4
+                if rm.index >= 0:
+                    index = rm.index & 7
+                    if rm.index & 8:
+                        rex |= 0x42
+                tail = bytes([mod << 6 | r | 4, index << 3 | rm.base & 7]) + disp
+                disp_at = 2
+        if bits == 16:
+            self.code.append(0x66)
+        if rex:
+            self.code.append(rex)
+        self.code += opcode
+        if type(rm) == Mem and rm.symbol:
+            self.fixups.append((len(self.code) + disp_at, rm.symbol, rm.disp, False))
+        self.code += tail
+        self.code += imm
+
+    def immediate(self, value: int, size: int) -> bytes:
+        if not -(1 << (8 * size - 1)) <= value < 1 << (8 * size):
+            self.error(f"{value} does not fit in {8 * size} bits")
+        return (value & ((1 << (8 * size)) - 1)).to_bytes(size, "little")
+
+    def emit_imm(self, opcode: bytes, reg: int, rm: Reg | Mem, bits: int, value: int | str, size: int) -> None:
+        """Like emit, with a trailing immediate of `size` bytes."""
+        if type(value) == str:
+            self.emit(opcode, reg, rm, bits, bytes(size))
+            if size != 4:
+                self.error("symbols need 32 bits")
+            self.fixups.append((len(self.code) - 4, value, 0, False))  # type: ignore
+        else:
+            self.emit(opcode, reg, rm, bits, self.immediate(value, size))  # type: ignore
+
+    def size(self, operands: List[Operand]) -> int:
+        for operand in operands:
+            if type(operand) in (Reg, Mem) and operand.bits:  # type: ignore
+                return operand.bits  # type: ignore
+        self.error("operand size not specified")
+        return 0
+
+    def jump(self, opcode: bytes, target: Operand) -> None:
+        if type(target) != str:
+            self.error("can only jump to a label")
+        self.code += opcode
+        self.fixups.append((len(self.code), target, 0, True))  # type: ignore
+        self.code += bytes(4)
+
+    def encode(self, op: str, operands: List[Operand]) -> None:
+        assert len(ALU_OPS) == 6 and len(UNARY_OPS) == 6, "Instruction set changed in Assembler.encode()"
+        kinds = tuple("r" if type(o) == Reg else "m" if type(o) == Mem else "i" for o in operands)
+        if op in FIXED_OPS and kinds == ():
+            self.code += FIXED_OPS[op]
+        elif op == "rep" and operands == ["movsb"]:
+            self.code += b"\xf3\xa4"
+        elif op in ALU_OPS and len(kinds) == 2 and kinds != ("m", "m") and kinds[0] != "i":
+            dst, src = operands
+            bits = self.size(operands)
+            n = ALU_OPS[op]
+            if kinds[1] == "i":
+                if bits == 8:
+                    self.emit_imm(b"\x80", n, dst, bits, src, 1)  # type: ignore
+                elif type(src) == int and -128 <= src < 128:
+                    self.emit_imm(b"\x83", n, dst, bits, src, 1)  # type: ignore
+                else:
+                    self.emit_imm(b"\x81", n, dst, bits, self.imm32(src), 2 if bits == 16 else 4)  # type: ignore
+            elif kinds[1] == "r":
+                self.emit(bytes([8 * n + (0 if bits == 8 else 1)]), src.number, dst, bits)  # type: ignore
+            else:
+                self.emit(bytes([8 * n + (2 if bits == 8 else 3)]), dst.number, src, bits)  # type: ignore
+        elif op == "test" and kinds in (("r", "r"), ("m", "r"), ("r", "i"), ("m", "i")):
+            dst, src = operands
+            bits = self.size(operands)
+            if kinds[1] == "r":
+                self.emit(b"\x84" if bits == 8 else b"\x85", src.number, dst, bits)  # type: ignore
+            else:
+                self.emit_imm(b"\xf6" if bits == 8 else b"\xf7", 0, dst, bits,  # type: ignore
+                              self.imm32(src), min(bits // 8, 4))  # type: ignore
+        elif op == "mov" and len(kinds) == 2 and kinds != ("m", "m") and kinds[0] != "i":
+            dst, src = operands
+            bits = self.size(operands)
+            if kinds == ("r", "i") and bits == 64 and type(src) == int and not -2 ** 31 <= src < 2 ** 31:
+                if 0 <= src < 2 ** 32:
+                    # writing the 32 bits register zeroes the top half
+                    self.emit_imm_reg(0xB8, dst.number, 32, src, 4)  # type: ignore
+                else:
+                    self.emit_imm_reg(0xB8, dst.number, 64, src, 8)  # type: ignore
+            elif kinds == ("r", "i") and bits != 64:
+                self.emit_imm_reg(0xB0 if bits == 8 else 0xB8, dst.number, bits, src, bits // 8)  # type: ignore
+            elif kinds[1] == "i":
+                self.emit_imm(b"\xc6" if bits == 8 else b"\xc7", 0, dst, bits,  # type: ignore
+                              self.imm32(src), min(bits // 8, 4))  # type: ignore
+            elif kinds[1] == "r":
+                self.emit(b"\x88" if bits == 8 else b"\x89", src.number, dst, bits)  # type: ignore
+            else:
+                self.emit(b"\x8a" if bits == 8 else b"\x8b", dst.number, src, bits)  # type: ignore
+        elif op == "lea" and kinds == ("r", "m"):
+            self.emit(b"\x8d", operands[0].number, operands[1], operands[0].bits)  # type: ignore
+        elif op in ("movzx", "movsx") and kinds in (("r", "r"), ("r", "m")):
+            dst, src = operands
+            source_bits = src.bits or 8  # type: ignore
+            opcode = {"movzx": 0xB6, "movsx": 0xBE}[op] + (source_bits == 16)
+            self.emit(bytes([0x0F, opcode]), dst.number, src, dst.bits)  # type: ignore
+        elif op == "movsxd" and kinds in (("r", "r"), ("r", "m")):
+            self.emit(b"\x63", operands[0].number, operands[1], 64)  # type: ignore
+        elif op in UNARY_OPS and kinds in (("r",), ("m",)):
+            bits = self.size(operands)
+            self.emit(b"\xf6" if bits == 8 else b"\xf7", UNARY_OPS[op], operands[0], bits)  # type: ignore
+        elif op == "imul" and kinds in (("r", "r"), ("r", "m")):
+            self.emit(b"\x0f\xaf", operands[0].number, operands[1], operands[0].bits)  # type: ignore
+        elif op == "imul" and kinds in (("r", "r", "i"), ("r", "m", "i")):
+            dst, src, value = operands
+            if type(value) == int and -128 <= value < 128:
+                self.emit_imm(b"\x6b", dst.number, src, dst.bits, value, 1)  # type: ignore
+            else:
+                self.emit_imm(b"\x69", dst.number, src, dst.bits, self.imm32(value), 4)  # type: ignore
+        elif op in SHIFT_OPS and kinds in (("r", "i"), ("m", "i")):
+            bits = self.size(operands)
+            self.emit_imm(b"\xc0" if bits == 8 else b"\xc1", SHIFT_OPS[op], operands[0], bits,  # type: ignore
+                          operands[1], 1)  # type: ignore
+        elif op in SHIFT_OPS and len(kinds) == 2 and operands[1] == Reg(1, 8):
+            bits = self.size(operands[:1])
+            self.emit(b"\xd2" if bits == 8 else b"\xd3", SHIFT_OPS[op], operands[0], bits)  # type: ignore
+        elif op.startswith("set") and op[3:] in CONDITION_CODES and kinds in (("r",), ("m",)):
+            self.emit(bytes([0x0F, 0x90 + CONDITION_CODES[op[3:]]]), 0, operands[0], 8)  # type: ignore
+        elif op.startswith("cmov") and op[4:] in CONDITION_CODES and kinds in (("r", "r"), ("r", "m")):
+            self.emit(bytes([0x0F, 0x40 + CONDITION_CODES[op[4:]]]), operands[0].number,  # type: ignore
+                      operands[1], operands[0].bits)  # type: ignore
+        elif op == "jmp" and kinds == ("i",):
+            self.jump(b"\xe9", operands[0])
+        elif op == "call" and kinds == ("i",):
+            self.jump(b"\xe8", operands[0])
+        elif op.startswith("j") and op[1:] in CONDITION_CODES and kinds == ("i",):
+            self.jump(bytes([0x0F, 0x80 + CONDITION_CODES[op[1:]]]), operands[0])
+        elif op in ("push", "pop") and kinds == ("r",) and operands[0].bits == 64:  # type: ignore
+            number = operands[0].number  # type: ignore
+            if number & 8:
+                self.code.append(0x41)
+            self.code.append((0x50 if op == "push" else 0x58) + (number & 7))
+        else:
+            self.error("unsupported instruction")
+
+    def imm32(self, value: Operand) -> int | str:
+        if type(value) == int and not -2 ** 31 <= value < 2 ** 31:
+            self.error(f"{value} does not fit in a signed 32 bits immediate")
+        return value  # type: ignore
+
+    def emit_imm_reg(self, opcode: int, number: int, bits: int, value: int | str, size: int) -> None:
+        """mov reg, imm with the register in the low bits of the opcode."""
+        rex = 0x48 if bits == 64 else 0
+        if number & 8:
+            rex |= 0x41
+        if bits == 8 and number >= 4:
+            rex |= 0x40
+        if bits == 16:
+            self.code.append(0x66)
+        if rex:
+            self.code.append(rex)
+        self.code.append(opcode + (number & 7))
+        if type(value) == str:
+            if size != 4:
+                self.error("symbols need 32 bits")
+            self.fixups.append((len(self.code), value, 0, False))  # type: ignore
+            self.code += bytes(4)
+        else:
+            self.code += self.immediate(value, size)
+
+
+class ExecutableWriter:
+    """Write a static ELF64 executable at `path`, entry point `_start`, one chunk of code at a time.
+
+    The code of every chunk goes to the file as soon as it is assembled. The
+    addresses of labels known by then are patched in right away, the others
+    and the bss symbols once `finish` knows the layout. Only the `addr_N`
+    labels of codegen are local to their chunk, so a chunk is a whole
+    top level statement.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(bytes(ELF_HEADER_SIZE))
+        self.asm = Assembler()
+        self.size = 0
+        self.labels: Dict[str, int] = {}
+        # (offset in the text of a 32 bits field, symbol, addend, relative to the next instruction)
+        self.pending: List[Tuple[int, str, int, bool]] = []
+
+    def add(self, instrs: List[Instr]) -> None:
+        asm = self.asm
+        asm.code, asm.labels, asm.fixups = bytearray(), {}, []
+        asm.assemble(instrs)
+        for name, offset in asm.labels.items():
+            if name in self.labels:
+                print(f"ERROR: label `{name}` is defined twice")
+                exit(1)
+            if not name.startswith("addr_"):
+                self.labels[name] = self.size + offset
+        code = asm.code
+        for at, symbol, addend, relative in asm.fixups:
+            target = asm.labels.get(symbol)
+            target = self.labels.get(symbol) if target is None else self.size + target
+            if target is None:
+                self.pending.append((self.size + at, symbol, addend, relative))
+                continue
+            value = target + addend - (self.size + at + 4 if relative else -TEXT_ADDR)
+            code[at:at + 4] = (value & 0xFFFFFFFF).to_bytes(4, "little")
+        self.file.write(code)
+        self.size += len(code)
+        if len(asm.encoded) > INTERNED_LIMIT:
+            asm.encoded.clear()
+
+    def finish(self) -> None:
+        asm = self.asm
+        bss_addr = (TEXT_ADDR + self.size + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+        addresses = {name: TEXT_ADDR + offset for name, offset in self.labels.items()}
+        for name, offset in asm.bss.items():
+            if name in addresses:
+                print(f"ERROR: symbol `{name}` is defined twice")
+                exit(1)
+            addresses[name] = bss_addr + offset
+        if "_start" not in self.labels:
+            print("ERROR: no `_start` label to start the executable at")
+            exit(1)
+        for at, symbol, addend, relative in self.pending:
+            if symbol not in addresses:
+                print(f"ERROR: undefined symbol `{symbol}`")
+                exit(1)
+            value = addresses[symbol] + addend
+            if relative:
+                value -= TEXT_ADDR + at + 4
+            self.file.seek(ELF_HEADER_SIZE + at)
+            self.file.write((value & 0xFFFFFFFF).to_bytes(4, "little"))
+        header = struct.pack("<4s5B7xHHIQQQIHHHHHH", b"\x7fELF", 2, 1, 1, 0, 0,
+                             2, 0x3E, 1, addresses["_start"], 64, 0, 0, 64, 56, 2, 64, 0, 0)
+        text = struct.pack("<IIQQQQQQ", 1, 5, 0, ELF_BASE, ELF_BASE,
+                           ELF_HEADER_SIZE + self.size, ELF_HEADER_SIZE + self.size, PAGE_SIZE)
+        bss = struct.pack("<IIQQQQQQ", 1, 6, 0, bss_addr, bss_addr, 0, asm.bss_size, PAGE_SIZE)
+        self.file.seek(0)
+        self.file.write(header + text + bss)
+        self.file.close()
+        os.chmod(self.tmp_path, 0o755)
+        os.replace(self.tmp_path, self.path)
+
+
+# relocation types of the x86-64 psABI, SHN_COMMON for `common` symbols
+R_X86_64_PC32 = 2
+R_X86_64_32S = 11
+SHN_COMMON = 0xFFF2
+
+
+def link_object(asm: Assembler) -> bytes:
+    """Lay out a relocatable ELF64 object with the code of `asm`, for ld.
+
+    Jumps to labels of the object are patched right away. Every other
+    address becomes a relocation against the text or bss section, or against
+    a `global`, `extern` or `common` symbol.
+    """
+    strings = bytearray(b"\0")
+
+    def string(name: str) -> int:
+        offset = len(strings)
+        strings.extend(name.encode() + b"\0")
+        return offset
+
+    # null symbol, then the text and bss sections, then the globals
+    symbols = [struct.pack("<IBBHQQ", 0, 0, 0, 0, 0, 0),
+               struct.pack("<IBBHQQ", 0, 3, 0, 1, 0, 0),
+               struct.pack("<IBBHQQ", 0, 3, 0, 2, 0, 0)]
+    indices: Dict[str, int] = {}
+    for name in sorted(asm.globals | asm.externs | set(asm.commons)):
+        if name in asm.commons:
+            section, value, size = SHN_COMMON, 8, asm.commons[name]
+        elif name in asm.labels:
+            section, value, size = 1, asm.labels[name], 0
+        elif name in asm.bss:
+            section, value, size = 2, asm.bss[name], 0
+        elif name in asm.externs:
+            section, value, size = 0, 0, 0
+        else:
+            print(f"ERROR: global symbol `{name}` is never defined")
+            exit(1)
+        indices[name] = len(symbols)
+        symbols.append(struct.pack("<IBBHQQ", string(name), 1 << 4 | (1 if section == SHN_COMMON else 0),
+                                   0, section, value, size))
+
+    code = asm.code
+    relocations = []
+    for at, symbol, addend, relative in asm.fixups:
+        if symbol in asm.labels and relative:
+            code[at:at + 4] = ((asm.labels[symbol] + addend - at - 4) & 0xFFFFFFFF).to_bytes(4, "little")
+            continue
+        if symbol in asm.labels:
+            index, addend = 1, asm.labels[symbol] + addend
+        elif symbol in asm.bss:
+            index, addend = 2, asm.bss[symbol] + addend
+        elif symbol in indices:
+            index = indices[symbol]
+        else:
+            print(f"ERROR: undefined symbol `{symbol}`, declare it `extern`")
+            exit(1)
+        if relative:
+            # relative to the end of the 4 bytes field
+            relocations.append(struct.pack("<QQq", at, index << 32 | R_X86_64_PC32, addend - 4))
+        else:
+            relocations.append(struct.pack("<QQq", at, index << 32 | R_X86_64_32S, addend))
+
+    section_names = bytearray(b"\0")
+    sections = []
+    body = bytearray()
+
+    def section(name: str, kind: int, flags: int, data: bytes, size: int = -1, link: int = 0, info: int = 0,
+                align: int = 1, entry_size: int = 0) -> None:
+        body.extend(bytes(-(64 + len(body)) % align))
+        offset = 64 + len(body)
+        if kind != 8:  # SHT_NOBITS takes no room in the file
+            body.extend(data)
+        sections.append(struct.pack("<IIQQQQIIQQ", len(section_names), kind, flags, 0, offset,
+                                    len(data) if size < 0 else size, link, info, align, entry_size))
+        section_names.extend(name.encode() + b"\0")
+
+    sections.append(bytes(64))
+    section(".text", 1, 6, code, align=16)
+    section(".bss", 8, 3, b"", size=asm.bss_size, align=16)
+    section(".symtab", 2, 0, b"".join(symbols), link=4, info=3, align=8, entry_size=24)
+    section(".strtab", 3, 0, strings)
+    section(".rela.text", 4, 0x40, b"".join(relocations), link=3, info=1, align=8, entry_size=24)
+    section(".shstrtab", 3, 0, b"")
+    # the section names are complete only now, `.shstrtab` included
+    body.extend(section_names)
+    sections[-1] = struct.pack("<IIQQQQIIQQ", len(section_names) - len(b".shstrtab\0"), 3, 0, 0,
+                               64 + len(body) - len(section_names), len(section_names), 0, 0, 1, 0)
+    body.extend(bytes(-(64 + len(body)) % 8))
+    header = struct.pack("<4s5B7xHHIQQQIHHHHHH", b"\x7fELF", 2, 1, 1, 0, 0,
+                         1, 0x3E, 1, 0, 0, 64 + len(body), 0, 64, 0, 0, 64, len(sections), len(sections) - 1)
+    return header + bytes(body) + b"".join(sections)
+
+
+def write_object(path: str, asm: List[Instr]) -> None:
+    assembler = Assembler()
+    with PausedGC():
+        assembler.assemble(asm)
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "wb") as file:
+        file.write(link_object(assembler))
+    os.replace(tmp_path, path)
+
+
+def write_executable(path: str, asm: List[Instr]) -> None:
+    writer = ExecutableWriter(path)
+    with PausedGC():
+        writer.add(asm)
+    writer.finish()
+
+
+# BYTECODE #####
+# Every instruction is one opcode word followed by its operands in a flat
+# `array('i')`. Integers live in the constant table and variables in
+# numbered slots, both resolved once by `compile_bytecode`.
+
+BC_HALT = iota(True)
+BC_CONST = iota()      # push consts[k]
+BC_LOAD = iota()       # push slots[n]
+BC_STORE = iota()      # slots[n] = pop
+BC_ADD = iota()
+BC_SUB = iota()
+BC_MUL = iota()
+BC_DIV = iota()        # consts[k] is the position reported when it faults
+BC_MOD = iota()        # likewise
+BC_EQ = iota()
+BC_GT = iota()
+BC_PUT = iota()
+BC_JMP = iota()        # pc = target
+BC_JZ = iota()         # pc = target if pop == 0
+BC_JNZ = iota()        # pc = target if pop != 0
+# superinstructions
+BC_ADD_CONST = iota()  # slots[n] += consts[k], for `x := x + INT` and `x := x - INT`
+BC_EQ_JZ = iota()      # pc = target if not a = b
+BC_EQ_JNZ = iota()     # pc = target if a = b
+BC_GT_JZ = iota()      # pc = target if not a > b
+BC_GT_JNZ = iota()     # pc = target if a > b
+BC_LOAD_PUT = iota()   # put slots[n]
+COUNT_BC = iota()
+
+assert COUNT_BC == 21, "number of expected bytecode instructions"
+
+I64_MIN = -2 ** 63
+I64_MAX = 2 ** 63 - 1
+
+
+def wrap64(value: int) -> int:
+    """Wrap `value` to a signed 64 bits integer, like the generated code does."""
+    return ((value - I64_MIN) & 0xFFFFFFFFFFFFFFFF) + I64_MIN
+
+
+def divide(left: int, right: int) -> Tuple[int, int]:
+    """Quotient and remainder of `left` by `right` like idiv: the quotient
+    rounds toward zero and the remainder takes the sign of `left`."""
+    quotient = abs(left) // abs(right)
+    if (left < 0) != (right < 0):
+        quotient = -quotient
+    return quotient, left - quotient * right
+
+
+def division_error(left: int, right: int) -> str:
+    """Why idiv faults on `left` by `right`, "" when it does not."""
+    if right == 0:
+        return "division by zero"
+    if right == -1 and left == I64_MIN:
+        return "division overflow"
+    return ""
+
+
+def checked_divide(left: int, right: int, pos: POS) -> Tuple[int, int]:
+    """divide(), stopping the program with an error where the generated code faults."""
+    error = division_error(left, right)
+    if error:
+        file, l, c = unpack_pos(pos)
+        print(f"{file}:{l}:{c}: ERROR: {error}")
+        exit(1)
+    return divide(left, right)
+
+
+class Bytecode:
+
+    def __init__(self) -> None:
+        self.code = array('i')
+        self.consts: List[int] = []
+        self.const_index: Dict[int, int] = {}
+        self.var_names: List[str] = []
+        self.slots: Dict[str, int] = {}
+
+    def emit(self, *words: int) -> int:
+        """Append an instruction and return the index of its last word."""
+        self.code.extend(words)
+        return len(self.code) - 1
+
+    def patch(self, at: int, target: int) -> None:
+        self.code[at] = target
+
+    def const(self, value: int) -> int:
+        if value not in self.const_index:
+            self.const_index[value] = len(self.consts)
+            self.consts.append(value)
+        return self.const_index[value]
+
+    def slot(self, name: str, pos: POS, define: bool = False) -> int:
+        if name not in self.slots:
+            if not define:
+                file, l, c = unpack_pos(pos)
+                print(f"{file}:{l}:{c}: ERROR: variable `{name}` is used before being assigned")
+                exit(1)
+            self.slots[name] = len(self.var_names)
+            self.var_names.append(name)
+        return self.slots[name]
+
+
+BYTECODE_BINARY: Dict[int, int] = {
+    OP_PLUS: BC_ADD,
+    OP_MINUS: BC_SUB,
+    OP_MULT: BC_MUL,
+    OP_SLASH: BC_DIV,
+    OP_MOD: BC_MOD,
+    OP_EQUAL: BC_EQ,
+    OP_GT: BC_GT,
+}
+
+BYTECODE_BRANCH: Dict[Tuple[int, bool], int] = {
+    (OP_EQUAL, False): BC_EQ_JZ,
+    (OP_EQUAL, True): BC_EQ_JNZ,
+    (OP_GT, False): BC_GT_JZ,
+    (OP_GT, True): BC_GT_JNZ,
+}
+
+
+def bytecode_expr(bc: Bytecode, node: AST | Lexeme) -> None:
+    assert COUNT_OPS == 17, "Op count changed in bytecode_expr()"
+    if type(node) == tuple:
+        if node[0] == VAR:
+            bc.emit(BC_LOAD, bc.slot(node[1], node[2]))  # type: ignore
+        else:
+            bc.emit(BC_CONST, bc.const(wrap64(node[1])))  # type: ignore
+        return
+    assert isinstance(node, AST)
+    if node.op_type in (VAR, INT):
+        bytecode_expr(bc, node.left_side)  # type: ignore
+    elif node.op_type in BYTECODE_BINARY:
+        bytecode_expr(bc, node.left_side)  # type: ignore
+        bytecode_expr(bc, node.right_side)  # type: ignore
+        if node.op_type in (OP_SLASH, OP_MOD):
+            bc.emit(BYTECODE_BINARY[node.op_type], bc.const(node.left_side[2]))  # type: ignore
+        else:
+            bc.emit(BYTECODE_BINARY[node.op_type])
+    else:
+        print(node, "is not an expression")
+        assert False, "unreachable"
+
+
+def bytecode_branch(bc: Bytecode, cond: AST, jump_if: bool) -> int:
+    """Emit a jump taken when `cond` is `jump_if`, return the word to patch."""
+    if (cond.op_type, jump_if) in BYTECODE_BRANCH:
+        bytecode_expr(bc, cond.left_side)  # type: ignore
+        bytecode_expr(bc, cond.right_side)  # type: ignore
+        return bc.emit(BYTECODE_BRANCH[cond.op_type, jump_if], -1)
+    bytecode_expr(bc, cond)
+    return bc.emit(BC_JNZ if jump_if else BC_JZ, -1)
+
+
+def bytecode_block(bc: Bytecode, program: List[AST]) -> None:
+    assert COUNT_OPS == 17, "Op count changed in bytecode_block()"
+    for op in program:
+        if op.op_type == EOF:
+            bc.emit(BC_HALT)
+        elif op.op_type == OP_ASSIGN:
+            name, value = op.left_side[1], op.right_side  # type: ignore
+            if (type(value) == AST and value.op_type in (OP_PLUS, OP_MINUS)  # type: ignore
+                    and value.left_side[0] == VAR and value.left_side[1] == name  # type: ignore
+                    and value.right_side.op_type == INT):  # type: ignore
+                step = wrap64(value.right_side.left_side[1])  # type: ignore
+                if value.op_type == OP_MINUS:  # type: ignore
+                    step = wrap64(-step)
+                bc.emit(BC_ADD_CONST, bc.slot(name, op.left_side[2]), bc.const(step))  # type: ignore
+            else:
+                bytecode_expr(bc, value)  # type: ignore
+                bc.emit(BC_STORE, bc.slot(name, op.left_side[2], define=True))  # type: ignore
+        elif op.op_type == OP_PUT:
+            if op.left_side.op_type == VAR:  # type: ignore
+                lexeme = op.left_side.left_side  # type: ignore
+                bc.emit(BC_LOAD_PUT, bc.slot(lexeme[1], lexeme[2]))
+            else:
+                bytecode_expr(bc, op.left_side)  # type: ignore
+                bc.emit(BC_PUT)
+        elif op.op_type == OP_IF:
+            skip = bytecode_branch(bc, op.left_side, False)  # type: ignore
+            bytecode_block(bc, op.right_side)  # type: ignore
+            bc.patch(skip, len(bc.code))
+        elif op.op_type == OP_WHILE:
+            enter = bc.emit(BC_JMP, -1)
+            body = len(bc.code)
+            bytecode_block(bc, op.right_side)  # type: ignore
+            bc.patch(enter, len(bc.code))
+            again = bytecode_branch(bc, op.left_side, True)  # type: ignore
+            bc.patch(again, body)
+        else:
+            print(op, "is unreachable")
+            assert False, "unreachable"
+
+
+def compile_bytecode(program: Program) -> Bytecode:
+    """Translate `program` to flat bytecode for `run_bytecode`."""
+    bc = Bytecode()
+    bytecode_block(bc, program)
+    if not program or program[-1].op_type != EOF:
+        bc.emit(BC_HALT)
+    return bc
+
+
+def run_bytecode(bc: Bytecode, out: TextIO = sys.stdout) -> None:
+    """Run `bc` on a value stack, writing what `put` prints to `out`."""
+    assert COUNT_BC == 21, "Bytecode count changed in run_bytecode()"
+    code = bc.code
+    consts = bc.consts
+    slots = [0] * len(bc.var_names)
+    stack: List[int] = []
+    push = stack.append
+    pop = stack.pop
+    lines: List[str] = []
+    write = lines.append
+    pc = 0
+    while True:
+        op = code[pc]
+        if op == BC_LOAD:
+            push(slots[code[pc + 1]])
+            pc += 2
+        elif op == BC_CONST:
+            push(consts[code[pc + 1]])
+            pc += 2
+        elif op == BC_ADD_CONST:
+            n = code[pc + 1]
+            value = slots[n] + consts[code[pc + 2]]
+            slots[n] = value if I64_MIN <= value <= I64_MAX else wrap64(value)
+            pc += 3
+        elif op == BC_GT_JNZ:
+            b = pop()
+            pc = code[pc + 1] if pop() > b else pc + 2
+        elif op == BC_GT_JZ:
+            b = pop()
+            pc = pc + 2 if pop() > b else code[pc + 1]
+        elif op == BC_EQ_JNZ:
+            b = pop()
+            pc = code[pc + 1] if pop() == b else pc + 2
+        elif op == BC_EQ_JZ:
+            b = pop()
+            pc = pc + 2 if pop() == b else code[pc + 1]
+        elif op == BC_STORE:
+            slots[code[pc + 1]] = pop()
+            pc += 2
+        elif op == BC_LOAD_PUT:
+            write("%d\n" % slots[code[pc + 1]])
+            if len(lines) >= 4096:
+                out.write("".join(lines))
+                lines.clear()
+            pc += 2
+        elif op == BC_ADD:
+            b = pop()
+            value = pop() + b
+            push(value if I64_MIN <= value <= I64_MAX else wrap64(value))
+            pc += 1
+        elif op == BC_SUB:
+            b = pop()
+            value = pop() - b
+            push(value if I64_MIN <= value <= I64_MAX else wrap64(value))
+            pc += 1
+        elif op == BC_MUL:
+            b = pop()
+            value = pop() * b
+            push(value if I64_MIN <= value <= I64_MAX else wrap64(value))
+            pc += 1
+        elif op == BC_EQ:
+            b = pop()
+            push(int(pop() == b))
+            pc += 1
+        elif op == BC_GT:
+            b = pop()
+            push(int(pop() > b))
+            pc += 1
+        elif op == BC_PUT:
+            write("%d\n" % pop())
+            if len(lines) >= 4096:
+                out.write("".join(lines))
+                lines.clear()
+            pc += 1
+        elif op == BC_JMP:
+            pc = code[pc + 1]
+        elif op == BC_JZ:
+            pc = code[pc + 1] if pop() == 0 else pc + 2
+        elif op == BC_JNZ:
+            pc = code[pc + 1] if pop() != 0 else pc + 2
+        elif op == BC_DIV or op == BC_MOD:
+            b = pop()
+            a = pop()
+            if division_error(a, b):
+                out.write("".join(lines))
+                out.flush()
+            push(checked_divide(a, b, consts[code[pc + 1]])[op == BC_MOD])
+            pc += 2
+        elif op == BC_HALT:
+            break
+        else:
+            assert False, "unreachable"
+    out.write("".join(lines))
+    out.flush()
+
+
+# JIT #####
+# `sim --jit` turns the whole program into the source of one Python function,
+# with Stem variables as Python locals, and lets CPython compile it.
+
+JIT_VERSION = 4
+
+JIT_BINARY: Dict[int, str] = {
+    OP_PLUS: "+",
+    OP_MINUS: "-",
+    OP_MULT: "*",
+    OP_SLASH: "/",
+    OP_MOD: "%",
+    OP_EQUAL: "==",
+    OP_GT: ">",
+}
+
+
+def cache_dir() -> str:
+    """Directory for on-disk caches, `$STEM_CACHE_DIR` or ~/.cache/stem."""
+    return os.environ.get("STEM_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "stem")
+
+
+class JitTranslator:
+
+    def __init__(self) -> None:
+        self.lines: List[str] = ["def stem_program(write):"]
+        self.defined: Dict[str, bool] = {}
+
+    def var(self, lexeme: Lexeme) -> str:
+        name, pos = lexeme[1], lexeme[2]
+        if name not in self.defined:
+            file, l, c = unpack_pos(pos)
+            print(f"{file}:{l}:{c}: ERROR: variable `{name}` is used before being assigned")
+            exit(1)
+        return f"v_{name}"
+
+    def expr(self, node: AST | Lexeme) -> Tuple[str, bool]:
+        """Return Python source for `node` and whether it may leave 64 bits."""
+        assert COUNT_OPS == 17, "Op count changed in JitTranslator.expr()"
+        if type(node) == tuple:
+            if node[0] == VAR:
+                return self.var(node), False  # type: ignore
+            return str(wrap64(node[1])), False  # type: ignore
+        assert isinstance(node, AST)
+        if node.op_type in (VAR, INT):
+            return self.expr(node.left_side)  # type: ignore
+        if node.op_type in JIT_BINARY:
+            left, left_grows = self.expr(node.left_side)  # type: ignore
+            right, right_grows = self.expr(node.right_side)  # type: ignore
+            if node.op_type in (OP_SLASH, OP_MOD):
+                # the quotient of 64 bits operands fits, or it faults
+                if left_grows:
+                    left = f"_wrap({left})"
+                if right_grows:
+                    right = f"_wrap({right})"
+                # a cached translation runs without the table of source files, see unpack_pos
+                where = "%s:%d:%d" % unpack_pos(node.left_side[2])  # type: ignore
+                return f"_divide({left}, {right}, {where!r})[{int(node.op_type == OP_MOD)}]", False
+            if node.op_type in (OP_EQUAL, OP_GT):
+                # comparisons see the wrapped operands, and yield 0 or 1
+                if left_grows:
+                    left = f"_wrap({left})"
+                if right_grows:
+                    right = f"_wrap({right})"
+                return f"({left} {JIT_BINARY[node.op_type]} {right})", False
+            return f"({left} {JIT_BINARY[node.op_type]} {right})", True
+        print(node, "is not an expression")
+        assert False, "unreachable"
+
+    def block(self, program: List[AST], indent: str) -> None:
+        assert COUNT_OPS == 17, "Op count changed in JitTranslator.block()"
+        emit = self.lines.append
+        start = len(self.lines)
+        for op in program:
+            if op.op_type == EOF:
+                emit(f"{indent}return")
+            elif op.op_type == OP_ASSIGN:
+                value, grows = self.expr(op.right_side)  # type: ignore
+                self.defined[op.left_side[1]] = True  # type: ignore
+                name = f"v_{op.left_side[1]}"  # type: ignore
+                emit(f"{indent}{name} = {value}")
+                if grows:
+                    emit(f"{indent}if not {I64_MIN} <= {name} <= {I64_MAX}: {name} = _wrap({name})")
+            elif op.op_type == OP_PUT:
+                value, grows = self.expr(op.left_side)  # type: ignore
+                if grows:
+                    value = f"_wrap({value})"
+                emit(f"{indent}write('%d\\n' % {value})")
+            elif op.op_type == OP_IF:
+                cond, grows = self.expr(op.left_side)  # type: ignore
+                emit(f"{indent}if {f'_wrap({cond})' if grows else cond}:")
+                self.block(op.right_side, indent + "    ")  # type: ignore
+            elif op.op_type == OP_WHILE:
+                cond, grows = self.expr(op.left_side)  # type: ignore
+                emit(f"{indent}while {f'_wrap({cond})' if grows else cond}:")
+                self.block(op.right_side, indent + "    ")  # type: ignore
+            else:
+                print(op, "is unreachable")
+                assert False, "unreachable"
+        if len(self.lines) == start:
+            emit(f"{indent}pass")
+
+
+def jit_translate(program: Program) -> str:
+    """Return the Python source of `stem_program(write)` running `program`.
+
+    The variables that may be read before any assignment, as in a branch
+    that never ran, start at 0 like in `sim` and `com`.
+    """
+    translator = JitTranslator()
+    nodes: List[FlowNode] = []
+    flow_block(nodes, program, set())
+    nodes.append(FlowNode(set(), set()))
+    for name in sorted(solve_liveness(nodes)[0].live_in):
+        translator.lines.append(f"    v_{name} = 0")
+    translator.block(program, "    ")
+    return "\n".join(translator.lines) + "\n"
+
+
+jit_cache: Dict[str, CodeType] = {}
+
+
+def jit_compile(prog_path: str, optimize: bool = False) -> CodeType:
+    """Translate and compile `prog_path`, reusing the code cached for the hash of its files and modules."""
+    # the paths too, for the errors the code reports
+    hasher = hashlib.sha256(b"%d:%s:%d:%s:" % (JIT_VERSION, sys.version.encode(), optimize, prog_path.encode()))
+    for path in program_files(prog_path):
+        try:
+            with open(path, "rb") as file:
+                source = file.read()
+        except OSError:
+            source = b""  # the lexer reports it
+        hasher.update(b"%s:%d:" % (path.encode(), len(source)) + source)
+    key = hasher.hexdigest()
+    if key in jit_cache:
+        return jit_cache[key]
+    cached_path = os.path.join(cache_dir(), "jit", key + ".marshal")
+    try:
+        with open(cached_path, "rb") as file:
+            code = marshal.load(file)
+    except (OSError, EOFError, ValueError, TypeError):
+        program = load_program_from_file(prog_path)
+        if optimize:
+            program = optimize_program(program, {})
+        code = compile(jit_translate(program), prog_path, "exec")
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        tmp_path = f"{cached_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as file:
+            marshal.dump(code, file)
+        os.replace(tmp_path, cached_path)
+    jit_cache[key] = code
+    return code
+
+
+def run_jit(code: CodeType, out: TextIO = sys.stdout) -> None:
+    """Run the code object from `jit_compile`, writing what `put` prints to `out`."""
+    def divide_checked(left: int, right: int, where: str) -> Tuple[int, int]:
+        error = division_error(left, right)
+        if error:
+            out.flush()
+            print(f"{where}: ERROR: {error}")
+            exit(1)
+        return divide(left, right)
+
+    namespace = {"_wrap": wrap64, "_divide": divide_checked}
+    exec(code, namespace)
+    namespace["stem_program"](out.write)  # type: ignore
+    out.flush()
+
+
+# BUILD CACHE #####
+# `com` stores what it built under cache_dir()/build/<key>/, where the key
+# hashes the source, COMPILER_VERSION, the backend and the flags that change
+# the code.
+# The mtime of an entry is its last use, the oldest go first once the
+# entries take more than `$STEM_CACHE_SIZE` bytes.
+
+COMPILER_VERSION = 10  # bump whenever the generated code changes
+BUILD_CACHE_SIZE = 64 << 20
+
+
+def build_cache_dir() -> str:
+    return os.path.join(cache_dir(), "build")
+
+
+def scan_source(path: str, optimize: bool, buffered: bool, yasm: bool) -> Tuple[str, bool] | None:
+    """The build key of the program at `path` and whether it uses modules, None if it cannot be read.
+
+    The file goes by in chunks of whole lines, so its size does not matter.
+    """
+    key = hashlib.sha256(b"%d:%d:%d:%d:" % (COMPILER_VERSION, optimize, buffered, yasm))
+    uses, last_line = False, ""
+    try:
+        with open(path, "rb") as file:
+            while chunk := file.read(LEX_CHUNK_SIZE) + file.readline():
+                key.update(chunk)
+                text = chunk.decode(errors="replace")
+                # the last line comes again for a `use` split over two lines
+                uses = uses or len(module_uses(last_line + text)) > 0
+                last_line = text[text.rfind("\n", 0, len(text) - 1) + 1:]
+    except OSError:
+        return None
+    return key.hexdigest(), uses
+
+
+def build_cache_limit() -> int:
+    limit = os.environ.get("STEM_CACHE_SIZE")
+    if limit is None:
+        return BUILD_CACHE_SIZE
+    if not limit.isdigit():
+        print(f"ERROR: STEM_CACHE_SIZE must be a number of bytes, got `{limit}`")
+        exit(1)
+    return int(limit)
+
+
+def read_cache_stats() -> Dict[str, int]:
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+    try:
+        with open(os.path.join(build_cache_dir(), "stats")) as file:
+            for line in file:
+                name, count = line.split()
+                if name in stats:
+                    stats[name] = int(count)
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+def count_cache_event(name: str, count: int = 1) -> None:
+    """Add `count` to the persistent counter `name`, concurrent updates may get lost."""
+    stats = read_cache_stats()
+    stats[name] += count
+    path = os.path.join(build_cache_dir(), "stats")
+    os.makedirs(build_cache_dir(), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        for key, value in stats.items():
+            file.write(f"{key} {value}\n")
+    os.replace(tmp_path, path)
+
+
+def cache_entries() -> List[Tuple[float, int, str]]:
+    """(last use, size in bytes, path) of every complete entry."""
+    entries = []
+    try:
+        names = os.listdir(build_cache_dir())
+    except OSError:
+        return entries
+    for name in names:
+        path = os.path.join(build_cache_dir(), name)
+        if len(name) != 64 or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            pass
+    return entries
+
+
+def cache_fetch(key: str, output: str) -> bool:
+    """Copy the artifacts cached for `key` to `output`, return whether there were any."""
+    entry = os.path.join(build_cache_dir(), key)
+    if not os.path.isdir(entry):
+        count_cache_event("misses")
+        return False
+    try:
+        for name in os.listdir(entry):
+            shutil.copy(os.path.join(entry, name), output + name[len("out"):])
+        os.utime(entry)
+    except OSError:
+        # evicted by another build while we were copying
+        count_cache_event("misses")
+        return False
+    count_cache_event("hits")
+    return True
+
+
+def cache_store(key: str, output: str, artifacts: List[str]) -> None:
+    """Cache `output` with each of the `artifacts` extensions, then evict down to the limit."""
+    entry = os.path.join(build_cache_dir(), key)
+    tmp_entry = f"{entry}.{os.getpid()}"
+    os.makedirs(tmp_entry, exist_ok=True)
+    for ext in artifacts:
+        shutil.copy(output + ext, os.path.join(tmp_entry, "out" + ext))
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another build stored the same key first
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    evict_cache(build_cache_limit())
+
+
+def evict_cache(limit: int) -> int:
+    """Remove the least recently used entries until they fit in `limit` bytes."""
+    entries = sorted(cache_entries())
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        evicted += 1
+    if evicted > 0:
+        count_cache_event("evictions", evicted)
+    return evicted
+
+
+def print_cache_stats() -> None:
+    stats = read_cache_stats()
+    entries = cache_entries()
+    lookups = stats["hits"] + stats["misses"]
+    print(f"cache: {build_cache_dir()}")
+    print(f"entries: {len(entries)}, {sum(size for _, size, _ in entries)} bytes of {build_cache_limit()}")
+    print(f"hits: {stats['hits']}, misses: {stats['misses']}", end="")
+    if lookups > 0:
+        print(f", hit rate {stats['hits'] / lookups:.1%}", end="")
+    print(f", evictions: {stats['evictions']}")
+
+
+# INSTRUMENTATION #####
+# `--time-phases` records the wall time, the CPU time and, with `--trace-mem`,
+# the tracemalloc peak of every phase of `main`. The CPU time of a phase
+# includes the subprocesses it waited for, which report their own peak RSS
+# instead. Disabled, `Phases.phase` returns a context manager that does
+# nothing.
+
+class NoPhase:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+
+NO_PHASE = NoPhase()
+
+
+class Phase:
+
+    def __init__(self, phases: 'Phases', name: str):
+        self.phases = phases
+        self.name = name
+
+    def __enter__(self) -> None:
+        if self.phases.trace_mem:
+            tracemalloc.reset_peak()
+        self.children = len(child_usages)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+
+    def __exit__(self, *exc: object) -> None:
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        record: Dict[str, object] = {"phase": self.name, "wall": wall, "cpu": cpu}
+        if self.phases.trace_mem:
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        children = child_usages[self.children:]
+        if children:
+            record["cpu"] = cpu + sum(usage.ru_utime + usage.ru_stime for usage in children)
+            # ru_maxrss is in KiB on Linux, and counts the pages the child
+            # shared with the compiler between fork and exec
+            record["child_max_rss_bytes"] = max(usage.ru_maxrss for usage in children) * 1024
+        self.phases.records.append(record)
+
+
+class Phases:
+    """Collects a record per phase and counts of what the phases produced."""
+
+    def __init__(self, enabled: bool, trace_mem: bool):
+        self.enabled = enabled
+        self.trace_mem = trace_mem
+        self.records: List[Dict[str, object]] = []
+        self.counts: Dict[str, int] = {}
+        if trace_mem:
+            tracemalloc.start()
+
+    def phase(self, name: str) -> Phase | NoPhase:
+        if not self.enabled:
+            return NO_PHASE
+        return Phase(self, name)
+
+    def count(self, name: str, value: int) -> None:
+        if self.enabled:
+            self.counts[name] = value
+
+    def report(self, json_path: str) -> None:
+        if not self.enabled:
+            return
+        if json_path:
+            with open(json_path, "w") as file:
+                json.dump({"phases": self.records, "counts": self.counts}, file, indent=2)
+            print(f"[INFO] Wrote phase times to {json_path}")
+            return
+        print(f"{'phase':<10} {'wall s':>9} {'cpu s':>9}" + (f" {'peak mem':>10}" if self.trace_mem else ""))
+        for record in self.records:
+            line = f"{record['phase']:<10} {record['wall']:>9.4f} {record['cpu']:>9.4f}"
+            if self.trace_mem:
+                line += f" {format_bytes(record['peak_bytes']):>10}"  # type: ignore
+            if "child_max_rss_bytes" in record:
+                line += f"   subprocess max RSS {format_bytes(record['child_max_rss_bytes'])}"  # type: ignore
+            print(line)
+        total_wall = sum(record["wall"] for record in self.records)  # type: ignore
+        total_cpu = sum(record["cpu"] for record in self.records)  # type: ignore
+        print(f"{'total':<10} {total_wall:>9.4f} {total_cpu:>9.4f}")
+        if self.counts:
+            print(", ".join(f"{name}: {value}" for name, value in self.counts.items()))
+
+
+def format_bytes(count: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024  # type: ignore
+    return f"{count:.1f} GiB"
+
+
+class TokenReplay:
+    """Hands tokens lexed beforehand to `parse`, like a Lexer: the last one,
+    EOF, comes again however many times it is asked for."""
+
+    def __init__(self, tokens: List[Lexeme]):
+        self.tokens = tokens
+        self.index = 0
+
+    def next(self) -> Lexeme:
+        lexeme = self.tokens[self.index]
+        if self.index < len(self.tokens) - 1:
+            self.index += 1
+        return lexeme
+
+
+def lex_file(prog_path: str) -> List[Lexeme]:
+    if source_cache is not None:
+        return source_cache.tokens(prog_path)
+    with open(prog_path, "r") as file:
+        lexer = Lexer(file.read(), prog_path)
+    with PausedGC():
+        tokens = [lexer.next()]
+        while tokens[-1][0] != EOF:
+            tokens.append(lexer.next())
+    return tokens
+
+
+def count_nodes(node: AST | Lexeme | List[AST] | None) -> int:
+    if type(node) == list:
+        return sum(count_nodes(child) for child in node)  # type: ignore
+    if not isinstance(node, AST):
+        return 0
+    return 1 + count_nodes(node.left_side) + count_nodes(node.right_side)
+
+
+# MODULES #####
+# `com` builds a program that uses modules one object per module under
+# <output>.modules/: the runtime, `main` for the program and a function
+# `module_<name>` for every module. The variables go through a `common`
+# global `var_<name>` at every call, so an object depends only on its own
+# source and the flags, and the module graph decides which objects the
+# executable is made of. manifest.json records the hash each object was
+# built from; the stale ones are rebuilt on a pool of workers before one ld.
+
+MODULE_USE_RE = re.compile(r"//[^\n]*|\buse\s+([^\W\d_][^\W_]*)\s*;")
+
+
+class Module(NamedTuple):
+    symbol: str      # `main`, `module_<name>` or `runtime`
+    path: str        # "" for the runtime
+    digest: str      # what the object is built from, see module_graph
+    uses: List[str]  # names of the modules it uses
+
+
+def module_uses(source: str) -> List[Tuple[str, int]]:
+    """Names of the modules `source` uses, with the offset of each name."""
+    if "use" not in source:
+        return []
+    return [(match.group(1), match.start(1)) for match in MODULE_USE_RE.finditer(source) if match.group(1)]
+
+
+def module_graph(prg_path: str, flags: bytes) -> Dict[str, Module]:
+    """Every module `prg_path` needs by symbol, `main` being `prg_path` itself.
+
+    A digest hashes `flags` with the symbol and source of its module.
+    """
+    modules: Dict[str, Module] = {}
+    paths: Dict[str, str] = {}
+
+    def visit(symbol: str, path: str, users: List[str]) -> None:
+        if symbol in modules:
+            return
+        with open(path, "r") as file:
+            source = file.read()
+        uses = module_uses(source)
+        digest = hashlib.sha256(flags + b":%s:" % symbol.encode() + source.encode()).hexdigest()
+        modules[symbol] = Module(symbol, path, digest, [name for name, _ in uses])
+        for name, offset in uses:
+            used = module_path(path, name)
+            line = source.count("\n", 0, offset) + 1
+            col = offset - source.rfind("\n", 0, offset)
+            if used in users + [path]:
+                print(f"{path}:{line}:{col}: ERROR: module `{name}` uses itself through "
+                      + " -> ".join(users[users.index(used):] + [path, used] if used in users else [path, used]))
+                exit(1)
+            if paths.setdefault(name, used) != used:
+                print(f"{path}:{line}:{col}: ERROR: two modules are named `{name}`, {paths[name]} and {used}")
+                exit(1)
+            if not os.path.isfile(used):
+                print(f"{path}:{line}:{col}: ERROR: cannot find module `{name}` at {used}")
+                exit(1)
+            visit(f"module_{name}", used, users + [path])
+
+    visit("main", os.path.normpath(prg_path), [])
+    return modules
+
+
+def build_module(module: Module, directory: str, optimize: bool, buffered: bool, yasm: bool) -> None:
+    """Write the assembly and the object of `module` into `directory`."""
+    if module.symbol == "runtime":
+        asm = generate_runtime(buffered)
+    else:
+        program = load_module(module.path)
+        if optimize:
+            program = optimize_program(program, {}, exported=module.symbol != "main")
+        asm = generate_module(program, module.symbol, module.uses, {} if optimize else None)
+        if optimize:
+            asm = peephole(asm, {})
+    base = os.path.join(directory, module.symbol)
+    with open(f"{base}.asm", "w") as out:
+        out.write(format_asm(asm))
+    if yasm:
+        if run_and_write(["yasm", "-f", "elf64", "-o", f"{base}.o", f"{base}.asm"]) != 0:
+            exit(1)
+    else:
+        write_object(f"{base}.o", asm)
+
+
+def build_module_job(job: Tuple[Module, str, bool, bool, bool]) -> Tuple[str, bool, float, str]:
+    """Build one object in a worker, return its symbol, success, seconds and log."""
+    return (job[0].symbol,) + captured(build_module, *job)  # type: ignore
+
+
+def build_modules(prg_path: str, output: str, phases: Phases, optimize: bool, buffered: bool,
+                  yasm: bool, jobs: int) -> None:
+    """Rebuild the stale objects of `prg_path` and its modules, then link `output` if anything changed."""
+    directory = f"{output}.modules"
+    manifest_path = os.path.join(directory, "manifest.json")
+    try:
+        with open(manifest_path, "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = {}
+    with phases.phase("modules"):
+        modules = module_graph(prg_path, b"%d:%d:%d" % (COMPILER_VERSION, optimize, yasm))
+        runtime = hashlib.sha256(b"runtime:%d:%d:%d" % (COMPILER_VERSION, buffered, yasm)).hexdigest()
+        modules["runtime"] = Module("runtime", "", runtime, [])
+    objects = [os.path.join(directory, f"{symbol}.o") for symbol in modules]
+    stale = [module for module, path in zip(modules.values(), objects)
+             if manifest.get(module.symbol) != module.digest or not os.path.isfile(path)]
+    phases.count("modules", len(modules) - 1)
+    phases.count("stale_objects", len(stale))
+    print(f"[INFO] {len(stale)} of {len(modules)} objects to build"
+          + "".join(f"\n[INFO]     {module.symbol} {module.path}".rstrip() for module in stale))
+
+    if stale:
+        os.makedirs(directory, exist_ok=True)
+        sys.stdout.flush()  # the workers inherit the buffer
+        batch = [(module, directory, optimize, buffered, yasm) for module in stale]
+        with phases.phase("compile"):
+            if jobs > 1 and len(batch) > 1:
+                with ProcessPoolExecutor(min(jobs, len(batch))) as pool:
+                    results = list(pool.map(build_module_job, batch))
+            else:
+                results = [build_module_job(job) for job in batch]
+        failed = False
+        for (symbol, ok, seconds, log), module in zip(results, stale):
+            print(f"[INFO] {symbol} {'built' if ok else 'FAILED'} in {seconds:.3f}s")
+            for line in log.splitlines():
+                if not ok or not line.startswith("[INFO]"):
+                    print(f"    {line}")
+            if ok:
+                manifest[module.symbol] = module.digest
+            failed = failed or not ok
+        with open(manifest_path, "w") as file:
+            json.dump(manifest, file, indent=2)
+        if failed:
+            exit(1)
+
+    if not stale and manifest.get("link") == objects and os.path.isfile(output):
+        print(f"[INFO] {output} is up to date")
+        return
+    with phases.phase("ld"):
+        status = run_and_write(["ld", "-o", output] + objects)
+    if status != 0:
+        exit(1)
+    manifest["link"] = objects
+    with open(manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+# PROFILE #####
+# `com --profile` counts how many times every statement, `if` branch and
+# `while` back-edge runs, by source position, in the 64 bits counters of
+# `profile_counts`. A block of statements always runs to its end, so all of
+# its statements share one counter, with the branch it is the body of: one
+# `add` to memory per block entered. At exit `profile_dump` writes
+# `profile_header`, which holds the hash of every source file and says which
+# counter every position has, then the counters to <output>.prof, and
+# `report` prints the sources with the counts, unless one of them changed.
+
+PROFILE_MAGIC = "stem profile 2"
+
+# open <profile_path> for writing, write the header and the counters, close it
+PROFILE_DUMP = """\
+profile_dump:
+        mov     eax, 2
+        mov     rdi, profile_path
+        mov     esi, 577
+        mov     edx, 420
+        syscall
+        test    rax, rax
+        js      .L8
+        mov     rdi, rax
+        mov     eax, 1
+        mov     rsi, profile_header
+        mov     edx, %d
+        syscall
+        mov     eax, 1
+        mov     rsi, profile_counts
+        mov     edx, %d
+        syscall
+        mov     eax, 3
+        syscall
+.L8:
+        ret
+"""
+
+
+def statement_pos(op: AST) -> POS:
+    """Position of the leftmost lexeme of `op`, the assigned variable or the start of its expression."""
+    node: AST | Lexeme = op.left_side  # type: ignore
+    while type(node) != tuple:
+        node = node.left_side  # type: ignore
+    return node[2]  # type: ignore
+
+
+def db(label: str, data: bytes) -> str:
+    """`label: db ...` with the printable runs of `data` as strings and the other bytes as numbers."""
+    # runs of the printable characters but `"`, or single other bytes
+    items = [f'"{run.decode()}"' if re.match(rb'[ !#-~]', run) else str(run[0])
+             for run in re.findall(rb'[ !#-~]+|[^ !#-~]', data)]
+    return f"{label}: db {', '.join(items)}"
+
+
+def source_hash(path: str) -> str:
+    """sha256 of the file at `path`, read in chunks, empty if it cannot be read."""
+    hasher = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            while chunk := file.read(LEX_CHUNK_SIZE):
+                hasher.update(chunk)
+    except OSError:
+        return ""
+    return hasher.hexdigest()
+
+
+def profile_asm(profile: List[Tuple[POS, str, int]], profile_path: str) -> List[Instr]:
+    """`profile_dump`, the header it writes to `profile_path` and the bss of a program counting for `profile`."""
+    counters = max((counter for _, _, counter in profile), default=-1) + 1
+    points = []
+    files: Dict[str, str] = {}
+    for pos, kind, counter in profile:
+        file, l, c = unpack_pos(pos)
+        file = os.path.abspath(file)
+        if file not in files:
+            files[file] = source_hash(file)
+        points.append(f"{kind} {l} {c} {counter} {file}")
+    lines = [PROFILE_MAGIC, f"{len(files)} {len(points)} {counters}"]
+    lines += [f"{digest or '-'} {file}" for file, digest in files.items()]
+    lines += points
+    header = ("\n".join(lines) + "\n").encode()
+    return parse_asm(PROFILE_DUMP % (len(header), 8 * counters) +
+                     db("profile_path", profile_path.encode() + b"\0") + "\n" +
+                     db("profile_header", header) + "\n"
+                     "segment .bss\n"
+                     "outbuf: resb OUTBUF_SIZE\n"
+                     "outlen: resq 1\n"
+                     f"profile_counts: resq {counters}\n")
+
+
+def read_profile(path: str) -> Tuple[Dict[str, str], List[Tuple[str, int, int, str, int]]]:
+    """The sha256 of every source file as it was compiled, and (file, line, column, kind, count)
+    of every position in the profile at `path`.
+
+    -O may copy a statement, the counts of all the copies add up.
+    """
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+    except OSError as error:
+        print(f"ERROR: cannot read {path}: {error.strerror}")
+        exit(1)
+    lines = data.split(b"\n", 2)
+    if len(lines) < 3 or lines[0] != PROFILE_MAGIC.encode() or not re.fullmatch(rb"\d+ \d+ \d+", lines[1]):
+        print(f"ERROR: {path} is not a profile written by a `com --profile` executable of this version")
+        exit(1)
+    files, count, counters = map(int, lines[1].split())
+    points = lines[2].split(b"\n", files + count)
+    if len(points) != files + count + 1 or len(points[-1]) != 8 * counters:
+        print(f"ERROR: {path} is truncated")
+        exit(1)
+    values = struct.unpack(f"<{counters}Q", points[-1])
+    hashes: Dict[str, str] = {}
+    for source in points[:files]:
+        digest, file = source.decode().split(" ", 1)
+        hashes[file] = "" if digest == "-" else digest
+    counts: Dict[Tuple[str, int, int, str], int] = {}
+    for point in points[files:-1]:
+        kind, l, c, counter, file = point.decode().split(" ", 4)
+        key = (file, int(l), int(c), kind)
+        counts[key] = counts.get(key, 0) + values[int(counter)]
+    return hashes, [key + (count,) for key, count in counts.items()]
+
+
+def report_profile(path: str) -> None:
+    """Print every source file of the profile at `path`, each line with how many times its statements ran.
+
+    A line with an `if` also says how many times it went into the branch,
+    one with a `while` how many times the loop went round. A source that
+    changed since it was compiled is an error, its lines would not match.
+    """
+    hashes, points = read_profile(path)
+    for file, digest in hashes.items():
+        current = source_hash(file)  # empty when it cannot be read, reported below
+        if current and current != digest:
+            print(f"ERROR: {os.path.relpath(file)} changed since the build that wrote {path}, "
+                  "build and run it again with --profile")
+            exit(1)
+    statements: Dict[str, Dict[int, int]] = {}
+    notes: Dict[str, Dict[int, List[str]]] = {}
+    for file, l, _, kind, count in points:
+        statements.setdefault(file, {})
+        notes.setdefault(file, {})
+        if kind == "statement":
+            statements[file][l] = max(statements[file].get(l, 0), count)
+        else:
+            notes[file].setdefault(l, []).append(f"{kind} {count}")
+    for file in statements:
+        try:
+            with open(file) as source:
+                text = source.read().splitlines()
+        except OSError as error:
+            print(f"ERROR: cannot read {file}: {error.strerror}")
+            exit(1)
+        print(f"{os.path.relpath(file)}:")
+        for l, line in enumerate(text, 1):
+            count = str(statements[file][l]) if l in statements[file] else ""
+            note = "  // " + ", ".join(notes[file][l]) if l in notes[file] else ""
+            print(f"{count:>12} | {line}{note}")
+
+
+# BATCH #####
+# `com` with several programs, or a directory of them, compiles them in a
+# pool of worker processes. Each worker pays the interpreter start up once,
+# runs yasm and ld or the built-in backend for its own files, and sends
+# back what it printed instead of writing it over the other workers.
+
+def find_programs(paths: List[str]) -> List[str]:
+    """The given programs, with every directory replaced by the .stm files under it."""
+    programs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            programs.append(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            programs += [os.path.join(root, name) for name in sorted(files) if name.endswith(".stm")]
+    return programs
+
+
+def batch_output(prg_path: str, output_dir: str) -> str:
+    name = os.path.splitext(prg_path)[0]
+    if output_dir:
+        return os.path.join(output_dir, os.path.basename(name))
+    return name
+
+
+def captured(fn: Callable[..., None], *args: object) -> Tuple[bool, float, str]:
+    """Call fn(*args) in a worker, return whether it succeeded, its seconds and what it printed."""
+    global in_paren, in_bracket
+    in_paren = in_bracket = 0
+    stdout = sys.stdout
+    sys.stdout = log = io.StringIO()
+    start = time.perf_counter()
+    ok = True
+    try:
+        fn(*args)
+    except SystemExit as exit_:
+        ok = exit_.code in (None, 0)
+    except Exception as exception:
+        print(f"ERROR: {type(exception).__name__}: {exception}")
+        ok = False
+    finally:
+        sys.stdout = stdout
+    return ok, time.perf_counter() - start, log.getvalue()
+
+
+def compile_one(job: Tuple[str, str, bool, bool, bool, bool]) -> Tuple[str, bool, float, str]:
+    """Compile one program of a batch, return its path, success, seconds and log."""
+    prg_path, output, optimize, buffered, use_cache, yasm = job
+    return (prg_path,) + captured(run, "com", prg_path, Phases(False, False), False, optimize,  # type: ignore
+                                  buffered, False, use_cache, yasm, output)
+
+
+def compile_batch(programs: List[str], output_dir: str, jobs: int, optimize: bool,
+                  buffered: bool, use_cache: bool, yasm: bool) -> bool:
+    """Compile `programs` on `jobs` processes, print a summary, return whether all built."""
+    outputs = [batch_output(prg_path, output_dir) for prg_path in programs]
+    if len(set(outputs)) != len(outputs):
+        duplicate = next(output for output in outputs if outputs.count(output) > 1)
+        print(f"ERROR: two programs would both be written to {duplicate}")
+        exit(1)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    print(f"[INFO] Compiling {len(programs)} programs on {jobs} workers")
+    sys.stdout.flush()  # the workers inherit the buffer
+    batch = [(prg_path, output, optimize, buffered, use_cache, yasm) for prg_path, output in zip(programs, outputs)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(compile_one, batch))
+    wall = time.perf_counter() - start
+
+    width = max(len(prg_path) for prg_path in programs)
+    failed = 0
+    for (prg_path, ok, seconds, log), output in zip(results, outputs):
+        status = "ok" if ok else "FAILED"
+        if ok and "[INFO] Cache hit" in log:
+            status = "cached"
+        print(f"{prg_path:<{width}} {status:>7} {seconds:>8.3f}s  {output if ok else ''}")
+        if not ok:
+            failed += 1
+            for line in log.splitlines():
+                if not line.startswith("[INFO]"):
+                    print(f"    {line}")
+    busy = sum(seconds for _, _, seconds, _ in results)
+    print(f"[INFO] {len(programs) - failed} built, {failed} failed in {wall:.3f}s "
+          f"({busy:.3f}s of work on {jobs} workers)")
+    return failed == 0
+
+
+# WATCH #####
+# `watch` keeps one process warm. It rebuilds the programs it watches when
+# one of their files changes, and runs the `com` and `cache` command lines
+# that editors send over a Unix socket, one JSON object per line:
+#     {"cwd": "/home/me/project", "argv": ["com", "-O", "main.stm"]}
+# answered with one line of JSON:
+#     {"ok": true, "seconds": 0.004, "log": "[INFO] Started lexing and parsing\n..."}
+# Meanwhile `SourceCache` keeps the tokens and the AST of every file it read.
+WATCH_INTERVAL = 0.05  # seconds between two looks at the watched files
+WATCH_SUBCOMMANDS = ("com", "cache")
+
+
+class SourceCache:
+    """Tokens and ASTs by file, reused as long as the text of the file is the same."""
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, Tuple[str, List[Lexeme], Program | None]] = {}
+
+    def entry(self, path: str) -> Tuple[str, List[Lexeme], Program | None]:
+        with open(path, "r") as file:
+            src = file.read()
+        key = os.path.abspath(path)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != src:
+            lexer = Lexer(src, path)
+            with PausedGC():
+                tokens = [lexer.next()]
+                while tokens[-1][0] != EOF:
+                    tokens.append(lexer.next())
+            entry = self.entries[key] = (src, tokens, None)
+        return entry
+
+    def tokens(self, path: str) -> List[Lexeme]:
+        return self.entry(path)[1]
+
+    def program(self, path: str) -> Program:
+        src, tokens, program = self.entry(path)
+        if program is None:
+            program = parse_program(TokenReplay(tokens), path)  # type: ignore
+            self.entries[os.path.abspath(path)] = (src, tokens, program)
+        return program
+
+
+# set by `watch`, for `load_module` and `lex_file`
+source_cache: SourceCache | None = None
+
+
+def program_files(prg_path: str) -> List[str]:
+    """`prg_path` and the files of the modules it uses, the missing ones included."""
+    files = [os.path.normpath(prg_path)]
+    for path in files:
+        try:
+            with open(path, "r") as file:
+                source = file.read()
+        except OSError:
+            continue
+        for name, _ in module_uses(source):
+            module = module_path(path, name)
+            if module not in files:
+                files.append(module)
+    return files
+
+
+def file_stamps(paths: List[str]) -> List[Tuple[int, int] | None]:
+    stamps: List[Tuple[int, int] | None] = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+def listen(socket_path: str) -> socket.socket:
+    """A Unix socket listening on `socket_path`, replacing the file a `watch` that died left there."""
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print(f"ERROR: another `watch` listens on {socket_path}")
+            exit(1)
+        except OSError:
+            os.remove(socket_path)
+        finally:
+            probe.close()
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.settimeout(WATCH_INTERVAL)
+    return server
+
+
+def run_request(cwd: str, argv: List[str]) -> None:
+    if argv[:1] != [] and argv[0] not in WATCH_SUBCOMMANDS:
+        print(f"ERROR: `watch` only runs {' and '.join(WATCH_SUBCOMMANDS)}, not {argv[0]}")
+        exit(1)
+    os.chdir(cwd)
+    sys.argv = ["stem.py"] + argv
+    main()
+
+
+def serve_request(connection: socket.socket) -> None:
+    """Run the command line of one request in this process and send back what it printed."""
+    with connection, connection.makefile("rb") as requests:
+        try:
+            request = json.loads(requests.readline())
+            cwd, argv = str(request.get("cwd", ".")), [str(arg) for arg in request["argv"]]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            ok, seconds, log = False, 0.0, 'ERROR: expected {"cwd": <directory>, "argv": [<argument>...]}\n'
+        else:
+            previous = os.getcwd(), sys.argv
+            try:
+                ok, seconds, log = captured(run_request, cwd, argv)
+            finally:
+                os.chdir(previous[0])
+                sys.argv = previous[1]
+        try:
+            connection.sendall(json.dumps({"ok": ok, "seconds": seconds, "log": log}).encode() + b"\n")
+        except OSError:
+            pass  # the client went away
+
+
+def watch(paths: List[str], optimize: bool, buffered: bool, use_cache: bool, yasm: bool, output: str,
+          socket_path: str) -> None:
+    """Rebuild `paths` whenever one of their files changes and serve requests on `socket_path`, until ^C."""
+    global source_cache
+    source_cache = SourceCache()
+    programs = find_programs(paths)
+    single = len(paths) == 1 and not os.path.isdir(paths[0])
+    outputs = [output or "output" if single else batch_output(prg_path, output) for prg_path in programs]
+    if output and not single:
+        os.makedirs(output, exist_ok=True)
+    files = [program_files(prg_path) for prg_path in programs]
+    stamps: List[List[Tuple[int, int] | None] | None] = [None] * len(programs)
+    server = listen(socket_path)
+    # stop on kill like on ^C, removing the socket
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"[INFO] Watching {len(programs)} programs, listening on {socket_path}")
+    sys.stdout.flush()
+    try:
+        while True:
+            for i, prg_path in enumerate(programs):
+                current = file_stamps(files[i])
+                if current == stamps[i]:
+                    continue
+                # a change may add or drop a `use`
+                files[i] = program_files(prg_path)
+                stamps[i] = file_stamps(files[i])
+                ok, seconds, log = captured(run, "com", prg_path, Phases(False, False), False, optimize, buffered,
+                                            False, use_cache, yasm, outputs[i])
+                status = "ok" if ok else "FAILED"
+                if ok and "[INFO] Cache hit" in log:
+                    status = "cached"
+                print(f"[INFO] {prg_path} {status} in {seconds:.3f}s")
+                for line in log.splitlines():
+                    if not ok and not line.startswith("[INFO]"):
+                        print(f"    {line}")
+                sys.stdout.flush()
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                continue
+            serve_request(connection)
+    except KeyboardInterrupt:
+        print("[INFO] Stopped watching")
+    finally:
+        server.close()
+        os.remove(socket_path)
+
+
+def usage() -> None:
+    print("ERROR: usage ./stem.py [SUBCOMMAND] <program>")
+    print("       ./stem.py com [FLAGS] <program|directory>...")
+    print("SUBCOMMANDS:")
+    print("    com: compile the program")
+    print("    sim: simulate the program")
+    print("        --jit: run the program as generated Python code")
+    print("    watch: rebuild the programs whenever they change, and serve `com` over a Unix socket")
+    print("        --socket <path>: where to listen, default $STEM_CACHE_DIR/watch.sock")
+    print("    cache: print the build cache statistics")
+    print("        --clear: empty the build cache")
+    print("    report [profile]: print the sources with the counts of a `com --profile` executable")
+    print("        from <profile>, default <name>.prof of -o")
+    print("FLAGS:")
+    print("    -O: fold and propagate constants, run the IR passes and the peephole optimizer")
+    print("    --stats: report how many instructions each peephole rule removed")
+    print("    --dump-ir: `com` also writes the IR of a single program to <name>.ir, bypassing the cache")
+    print("    -o <name>: `com` writes <name>.asm, <name>.o and the executable <name>, default output")
+    print("        with several programs, the directory for their outputs, default next to each program")
+    print("    --unbuffered: `com` writes the output of every `put` right away")
+    print("    --yasm: `com` assembles and links with yasm and ld instead of the built-in backend")
+    print("    --no-cache: `com` always builds the executable, and does not store the result")
+    print("    --profile: the executable of `com` counts the statements it runs and writes the counts")
+    print("        to <name>.prof at exit, bypassing the cache")
+    print("    -j <n>: `com` builds several programs, a directory of them or the modules of one")
+    print("        on <n> processes")
+    print("    --time-phases: print the wall and CPU time of every phase, and what they produced")
+    print("    --phases-json <file>: write the phase times to <file> as JSON instead")
+    print("    --trace-mem: also record the peak memory of every phase with tracemalloc")
+
+
+def shift(lst: List[str]) -> Tuple[str, List[str]]:
+    return lst[0], lst[1:]
+
+
+def main() -> None:
+    argv = sys.argv
+    assert len(argv) > 1
+    prg_name, argv = shift(argv)
+    if len(argv) < 1:
+        usage()
+        exit(1)
+
+    subcommand, argv = shift(argv)
+    jit = False
+    optimize = False
+    buffered = True
+    show_stats = False
+    dump_ir = False
+    profile = False
+    use_cache = True
+    yasm = False
+    clear = False
+    time_phases = False
+    trace_mem = False
+    phases_json = ""
+    socket_path = ""
+    output = ""
+    jobs = os.cpu_count() or 1
+    paths = []
+    while len(argv) > 0:
+        arg, argv = shift(argv)
+        if arg == "--jit":
+            jit = True
+        elif arg == "-O":
+            optimize = True
+        elif arg == "--unbuffered":
+            buffered = False
+        elif arg == "--stats":
+            show_stats = True
+        elif arg == "--dump-ir":
+            dump_ir = True
+        elif arg == "--profile":
+            profile = True
+        elif arg == "--yasm":
+            yasm = True
+        elif arg == "--no-cache":
+            use_cache = False
+        elif arg == "--clear":
+            clear = True
+        elif arg == "--time-phases":
+            time_phases = True
+        elif arg == "--trace-mem":
+            trace_mem = True
+        elif arg == "-j":
+            if len(argv) == 0 or not argv[0].isdigit() or int(argv[0]) < 1:
+                print("ERROR: expected a number of workers after -j")
+                usage()
+                exit(1)
+            jobs, argv = int(argv[0]), argv[1:]
+        elif arg == "--phases-json":
+            if len(argv) == 0:
+                print("ERROR: expected a file name after --phases-json")
+                usage()
+                exit(1)
+            phases_json, argv = shift(argv)
+        elif arg == "--socket":
+            if len(argv) == 0:
+                print("ERROR: expected a path after --socket")
+                usage()
+                exit(1)
+            socket_path, argv = shift(argv)
+        elif arg == "-o":
+            if len(argv) == 0:
+                print("ERROR: expected a name after -o")
+                usage()
+                exit(1)
+            output, argv = shift(argv)
+        elif arg.startswith("-"):
+            print(f"ERROR: unknown flag {arg}")
+            usage()
+            exit(1)
+        else:
+            paths.append(arg)
+    if subcommand == "cache":
+        if len(paths) > 0:
+            usage()
+            exit(1)
+        if clear:
+            evict_cache(0)
+        print_cache_stats()
+        return
+    if subcommand == "report":
+        if len(paths) > 1:
+            usage()
+            exit(1)
+        report_profile(paths[0] if paths else f"{output or 'output'}.prof")
+        return
+    if profile and (subcommand != "com" or len(paths) != 1 or os.path.isdir(paths[0])):
+        print("ERROR: --profile takes `com` of a single program")
+        exit(1)
+    if subcommand == "watch":
+        if jit or time_phases or trace_mem or phases_json or show_stats or dump_ir:
+            print("ERROR: `watch` takes the flags of `com` that change the executable only")
+            exit(1)
+        watch(paths, optimize, buffered, use_cache, yasm, output, socket_path or os.path.join(cache_dir(), "watch.sock"))
+        return
+    if subcommand == "com" and (len(paths) > 1 or len(paths) == 1 and os.path.isdir(paths[0])):
+        if time_phases or trace_mem or phases_json or show_stats or dump_ir:
+            print("ERROR: --time-phases, --trace-mem, --phases-json, --stats and --dump-ir take a single program")
+            exit(1)
+        programs = find_programs(paths)
+        if len(programs) == 0:
+            print("ERROR: no .stm programs to compile")
+            exit(1)
+        # -o names the directory for the outputs, which go next to each program otherwise
+        if not compile_batch(programs, output, jobs, optimize, buffered, use_cache, yasm):
+            exit(1)
+        return
+    if len(paths) != 1:
+        usage()
+        exit(1)
+    prg_path = paths[0]
+
+    phases = Phases(time_phases or trace_mem or phases_json != "", trace_mem)
+    run(subcommand, prg_path, phases, jit, optimize, buffered, show_stats, use_cache, yasm, output or "output", jobs,
+        dump_ir, profile)
+    phases.report(phases_json)
+
+
+def link_with_yasm(output: str, phases: Phases) -> None:
+    with phases.phase("yasm"):
+        status = run_and_write(["yasm", "-f", "elf64", "-o", f"{output}.o", f"{output}.asm"])
+    if status != 0:
+        exit(1)
+    with phases.phase("ld"):
+        status = run_and_write(["ld", "-o", output, f"{output}.o"])
+    if status != 0:
+        exit(1)
+
+
+def run(subcommand: str, prg_path: str, phases: Phases, jit: bool, optimize: bool, buffered: bool,
+        show_stats: bool, use_cache: bool, yasm: bool, output: str, jobs: int = 1, dump_ir: bool = False,
+        profile: bool = False) -> None:
+    key = ""
+    ir_path = f"{output}.ir" if dump_ir else ""
+    profile_path = os.path.abspath(f"{output}.prof") if profile else ""
+    if subcommand == "com":
+        scanned = scan_source(prg_path, optimize, buffered, yasm)  # None lets the lexer report it
+        if scanned is not None and scanned[1]:
+            if dump_ir or profile:
+                print("ERROR: --dump-ir and --profile do not take a program with modules")
+                exit(1)
+            # the modules keep their own objects instead of the build cache
+            build_modules(prg_path, output, phases, optimize, buffered, yasm, jobs)
+            return
+        # a cache hit would not write the IR, and the profile goes to an absolute path
+        if use_cache and not dump_ir and not profile and scanned is not None:
+            with phases.phase("cache"):
+                key = scanned[0]
+                hit = cache_fetch(key, output)
+            if hit:
+                print(f"[INFO] Cache hit {key[:12]}, wrote {output}")
+                return
+        if not optimize and not phases.enabled and scanned is not None and os.path.getsize(prg_path) > LEX_CHUNK_SIZE:
+            # peephole and the phases need the whole program, the rest can go one statement at a time
+            print("[INFO] Started streaming the program through codegen")
+            stream_compile(prg_path, f"{output}.asm", "" if yasm else output, buffered, ir_path, profile_path)
+            if yasm:
+                link_with_yasm(output, phases)
+            if key:
+                cache_store(key, output, [".asm", ".o", ""] if yasm else [".asm", ""])
+            return
+
+    if subcommand == "sim" and jit:
+        with phases.phase("jit"):
+            code = jit_compile(prg_path, optimize)
+        print("[INFO] Started simulating")
+        sys.stdout.flush()
+        with phases.phase("simulate"):
+            run_jit(code, open(sys.stdout.fileno(), "w", 1 << 16, closefd=False))
+        return
+
+    print("[INFO] Started lexing and parsing")
+    if phases.enabled:
+        # lex everything first to time the lexer apart from the parser
+        with phases.phase("lex"):
+            tokens = lex_file(prg_path)
+        phases.count("tokens", len(tokens))
+        with phases.phase("parse"):
+            program = parse_program(TokenReplay(tokens), prg_path)  # type: ignore
+            program = inline_modules(program, prg_path)
+        del tokens
+        phases.count("ast_nodes", count_nodes(program))
+    else:
+        program = load_program_from_file(prg_path)
+
+    if optimize:
+        stats: Dict[str, int] = {}
+        with phases.phase("optimize"):
+            program = optimize_program(program, stats)
+        for name, count in stats.items():
+            print(f"[INFO] -O: {count} {name}")
+
+    if subcommand == "sim":
+        with phases.phase("bytecode"):
+            bc = compile_bytecode(program)
+        phases.count("bytecode_words", len(bc.code))
+        print("[INFO] Started simulating")
+        with phases.phase("simulate"):
+            run_bytecode(bc)
+    elif subcommand == "com":
+        print("[INFO] Started generating")
+        peephole_stats: Dict[str, int] | None = {} if optimize else None
+        ir_stats: Dict[str, int] | None = {} if optimize else None
+        with phases.phase("codegen"):
+            asm = compile_program(f"{output}.asm", program, buffered=buffered, peephole_stats=peephole_stats,
+                                  ir_stats=ir_stats, ir_path=ir_path, profile_path=profile_path)
+        if ir_stats is not None:
+            for name, count in ir_stats.items():
+                print(f"[INFO] -O: {count} {name}")
+        phases.count("instructions", sum(1 for instr in asm if instr.op not in ("label", "comment", "raw")))
+        if show_stats and peephole_stats is not None:
+            for name, count in peephole_stats.items():
+                print(f"[INFO] peephole: {name} removed {count} instructions")
+        if yasm:
+            link_with_yasm(output, phases)
+        else:
+            print("[INFO] Started assembling")
+            with phases.phase("assemble"):
+                write_executable(output, asm)
+        if key:
+            with phases.phase("cache"):
+                cache_store(key, output, [".asm", ".o", ""] if yasm else [".asm", ""])
 
     else:
         print(f"ERROR: unknown subcommand {subcommand}")